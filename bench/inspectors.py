@@ -0,0 +1,65 @@
+'''
+Per-file cost of the inspectors over a corpus of files
+
+    python bench/inspectors.py [-i image] [-r 5] FILE...
+
+Reports the mean time per file for each extension.  For the image
+inspector the old two pass approach (PIL then a second open for a full
+exifread parse) is timed alongside for comparison.
+'''
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os.path
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from librarian.inspectors import Inspector
+
+def two_pass(filename):
+    from PIL import Image
+    import exifread
+
+    im = Image.open(filename)
+    im.size, im.mode
+    with open(filename, 'rb') as f:
+        exifread.process_file(f, details=False)
+
+def timed(fn, filename, repeat):
+    # warm the page cache and any lazy imports
+    fn(filename)
+
+    start = time.time()
+    for i in range(repeat):
+        fn(filename)
+    return (time.time() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspector benchmark")
+    parser.add_argument('-i', '--inspector', default='image')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('files', nargs='+')
+    options = parser.parse_args()
+
+    inspector = Inspector(options.inspector)
+
+    results = defaultdict(lambda: defaultdict(list))
+    for filename in options.files:
+        if not inspector.applicable(filename):
+            continue
+        _, ext = os.path.splitext(filename.lower())
+        results[ext]['inspect'].append(timed(inspector.inspect_file, filename, options.repeat))
+        if options.inspector == 'image':
+            results[ext]['two pass'].append(timed(two_pass, filename, options.repeat))
+
+    print("{0:8s} {1:>6s} {2:>12s} {3:>12s}".format('ext', 'files', 'inspect', 'two pass'))
+    for ext, r in sorted(results.items()):
+        cols = [ "{0:10.2f}ms".format(1000 * sum(r[k]) / len(r[k])) if r[k] else "{0:>12s}".format('-')
+                for k in ('inspect', 'two pass') ]
+        print("{0:8s} {1:6d} {2} {3}".format(ext, len(r['inspect']), *cols))
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,19 @@ import os.path
 import logging
 import sys
 import json
+import threading
+import time
 #from gevent import subprocess
+from multiprocessing.pool import ThreadPool
 import subprocess
 
+from gevent import threadpool
+
 from .backends import xapian_indexer as backend
-from .annex import Annex, parse_meta_log, parse_location_log
+from .backends import sharded
+from .annex import Annex, AnnexError, parse_meta_log, parse_location_log
+from .keys import parse_key
+from .hashcache import HashCache, stat_key
 
 from . import progress
 
@@ -21,7 +29,30 @@ logger = logging.getLogger(__name__);
 
 DEFAULT_CONFIG = {
     'BRANCHES': ['master'],
-    'INDEXERS': ['file', 'image'],
+    'INDEXERS': ['file', 'image', 'phash'],
+    'THUMB_WORKERS': 4,
+    'HASH_WORKERS': 4,
+
+    # split the index across this many databases, None keeps what is there
+    'SHARDS': None,
+
+    # budget for the full text the poppler inspector extracts from a PDF
+    'PDF_MAX_PAGES': 100,
+    'PDF_MAX_TEXT': 64 * 1024, # bytes
+    'PDF_WORKERS': 4, # pdftotext processes per PDF
+
+    # seconds before retrying a background fetch that failed
+    'FETCH_RETRY': 300,
+
+    # garbage collection of documents that have been dropped (see gc)
+    'GC_RETENTION': 90, # days
+    'GC_PURGE': False,
+    'GC_AFTER_SYNC': False,
+
+    # used by the server, see librarian.green
+    'GIT_CONCURRENCY': 8,
+    'FETCH_CONCURRENCY': 2,
+    'FETCH_TIMEOUT': 300,
 }
 
 class Librarian:
@@ -29,7 +60,9 @@ class Librarian:
     Curator of annex metadata
     '''
 
-    def __init__(self, path, config=None):
+    _fetch_pool = None
+
+    def __init__(self, path, config=None, annex=None):
         self.base_path = os.path.abspath(path)
         if not os.path.exists(self.base_path):
             raise IOError("No such directory: {}".format(self.base_path))
@@ -38,7 +71,7 @@ class Librarian:
         if config: 
             self.config.update(config)
 
-        self.annex = Annex(self.base_path)
+        self.annex = annex or Annex(self.base_path)
 
         librarian_path = os.path.join(self.base_path, '.git', 'librarian')
         if not os.path.exists(librarian_path):
@@ -48,7 +81,33 @@ class Librarian:
         if not os.path.exists(self.cache_dir):
             os.mkdir(self.cache_dir, 0o700)
 
-        self.db = backend.XapianIndexer(os.path.join(librarian_path, 'db'))
+        self.hashes_path = os.path.join(librarian_path, 'hashes.db')
+
+        # keys being fetched from remotes in the background
+        self._fetching = {}
+        self._fetch_failed = {}
+        self._fetch_lock = threading.Lock()
+
+        # renders thumbnails on native threads without blocking the server
+        self._pool = threadpool.ThreadPool(self.config['THUMB_WORKERS'])
+
+        self.librarian_path = librarian_path
+        self.db = self.open_index()
+
+    def open_index(self):
+        '''
+        The index, sharded if SHARDS says so or if it already is
+        '''
+        path = os.path.join(self.librarian_path, 'db')
+        shards_path = os.path.join(self.librarian_path, 'shards')
+
+        shards = self.config['SHARDS']
+        if shards is None:
+            shards = sharded.count_shards(shards_path)
+
+        if shards is None or (shards == 1 and not os.path.exists(shards_path)):
+            return backend.XapianIndexer(path)
+        return sharded.ShardedIndexer(shards_path, shards, path)
 
     def relative_path(self, p):
         return os.path.join(self.base_path, p)
@@ -71,10 +130,12 @@ class Librarian:
         for commit in commits:
             for filename, stat in self.annex.file_modifications(commit):
 
-                filename=os.path.basename(filename)
-                if filename in ('uuid.log', 'group.log', 'numcopies.log', 'transitions.log'):
+                # uuid.log, remote.log etc are about the repository not a key
+                if '/' not in filename:
                     continue
 
+                filename=os.path.basename(filename)
+
                 data = None
 
                 if filename.endswith('.log.met'):
@@ -108,28 +169,67 @@ class Librarian:
             for commit in commits:
                 for filename, stat in self.annex.file_modifications(commit):
                     key, p = self._key_for_branch_file('master', filename, stat)
-
-                    data = self.db.get_or_create_data(key)
-                    branches = data.setdefault('git', {}).setdefault('branch', {})
-
-                    if p is None:
-                        del(branches[branch])
-                    else:
-                        branches[branch] = p
-                    self.db.put_data(key, data)
+                    self.db.update_branch(key, branch, p)
 
                 self.set_head(branch, commit)
                 pbar.tick(commit)
 
+        if self.config['GC_AFTER_SYNC']:
+            self._gc(self.config['GC_RETENTION'], self.config['GC_PURGE'])
+
         self.db.unset_writable()
         return self.get_head('git-annex')
 
-    def get_details(self, filename, include_terms=False):
-        result = {}
+    def gc(self, retention=None, purge=None, compact=True):
+        '''
+        Garbage collects documents dropped from every branch or with deleted
+        content more than retention days ago (see XapianIndexer.gc), then
+        compacts the database.  Returns a report of what was collected, the
+        space reclaimed and the time to fetch the default page before and
+        after.
+        '''
+        if retention is None:
+            retention = self.config['GC_RETENTION']
+        if purge is None:
+            purge = self.config['GC_PURGE']
+
+        report = {
+            'size_before': self.db.size(),
+            'latency_before': self.db.benchmark(),
+        }
+
+        self.db.set_writable()
+        try:
+            report['collected'], report['stamped'] = self._gc(retention, purge)
+        finally:
+            self.db.unset_writable()
+
+        if compact:
+            self.db.compact()
+
+        report.update(size_after=self.db.size(), latency_after=self.db.benchmark())
+        return report
+
+    def _gc(self, retention, purge):
+        before = time.strftime(backend.ISO_8601, time.gmtime(time.time() - retention * 86400))
+        return self.db.gc(before, purge)
+
+    def apply_info(self, commit, parent, written):
+        '''
+        Indexes .info data we have just committed to the git-annex branch,
+        moving the head on if nothing else has been committed since the
+        last sync so a full sync isn't needed.
+        '''
+        self.db.set_writable()
+        for key, data in written:
+            self.db.update_data(key, data)
+
+        if self.get_head('git-annex') == parent:
+            self.set_head('git-annex', commit)
+        self.db.unset_writable()
 
+    def get_details(self, filename, include_terms=False):
         key = self.annex.key_for_link(filename)
-        p = self.annex.git_line('annex', 'examinekey', '--format', "${hashdirlower}${key}", key)
-
         data = self.db.get_data(key, include_terms)
 
         return data
@@ -139,27 +239,72 @@ class Librarian:
             logger.warning("Deleted meta for %s", key)
             return {"meta": {"state": ["untagged"]}}
 
-        meta = parse_meta_log(self.annex.git_lines('cat-file', 'blob', stat['blob']))
-        
+        meta = parse_meta_log(self.annex.cat_file(stat['blob']).decode('utf-8').splitlines())
+        return self._meta_data(meta)
+
+    def _meta_data(self, meta):
         meta['state'] = ['tagged'] if len(meta.get('tag', [])) > 0 else ['untagged']
         return {"meta": meta}
 
-    def _process_log(self, key, stat):
+    def update_metadata(self, keys, add=None, remove=None, set_fields=None):
+        '''
+        Change metadata for a list of keys and write the results straight
+        into the index.  The next sync will see the same metadata in the
+        git-annex branch and index it again to the same result.
+        Returns the number of keys updated.
+        '''
+        pbar = progress.getProgress()
+        pbar.init(len(keys), "Updating metadata...")
 
+        result = self.annex.update_metadata(keys, add, remove, set_fields, pbar.tick)
 
-        # TODO: add content location?
-        if stat['action'] == 'A':
-            return {"annex": {
-                'added': stat['date'][:19],
-                'extension': stat['ext'],
-            }}
+        self.db.set_writable()
+        try:
+            for key, fields in result:
+                self.db.update_data(key, self._meta_data(fields))
+        finally:
+            self.db.unset_writable()
+
+        return len(result)
+
+    def _process_log(self, key, stat):
 
         if stat['action'] == 'D':
             logger.warning("Deleted logfile for %s:", key)
             return {"annex": {"state": "deleted"}}
 
+        annex = self.db.get_or_create_data(key).get('annex') or {}
+
+        if stat['action'] == 'A':
+            annex.update({
+                'added': stat['date'][:19],
+                'extension': stat['ext'],
+            })
+
+            # most backends record the size so we get it without inspecting
+            try:
+                size = parse_key(key).get('size')
+                if size is not None:
+                    annex['size'] = "{0:d}kB".format(size // 1000)
+            except ValueError:
+                pass
+
+        annex['present'] = self._locations(stat['blob'])
+        return {"annex": annex}
+
+    def _locations(self, blob):
+        '''
+        Repositories with the content according to a location log, with
+        "here" added if this is one of them
+        '''
+        lines = self.annex.cat_file(blob).decode('utf-8').splitlines()
+        present = parse_location_log(lines)
+        if self.annex.uuid in present:
+            present.append('here')
+        return present
+
     def _process_info(self, key, stat):
-        data = self.annex.git_json('cat-file', 'blob', stat['blob'])
+        data = json.loads(self.annex.cat_file(stat['blob']).decode('utf-8'))
         return data
 
     def _key_for_branch_file(self, branch, filename, stat):
@@ -170,7 +315,7 @@ class Librarian:
 
         if stat['_mode'] == ':120000' and stat['action'] == 'D':
             logger.debug("Deleted branch file: %s", filename)
-            key = os.path.basename(self.annex.git_line('cat-file', 'blob', stat['parent']))
+            key = os.path.basename(self.annex.cat_file(stat['parent']).decode('utf-8').strip())
 
             return key, None
 
@@ -185,44 +330,210 @@ class Librarian:
         return self.db.get_data(key)
 
 
-    def thumb_for_key(self, key):
-        filepath = os.path.join(self.cache_dir, key + "-thumb.jpg");
+    def missing(self, filenames):
+        '''
+        Iterator of the files whose content isn't in the library.  Keys are
+        cached against each file's stat so unchanged files aren't hashed
+        again, and the rest are hashed in parallel.
+        '''
+        known = self.db.keys()
+
+        with HashCache(self.hashes_path) as cache:
+            stats = {}
+            for filename in filenames:
+                stat = stat_key(filename)
+                key = cache.get(stat)
+                if key is None:
+                    stats[filename] = stat
+                elif key not in known:
+                    yield filename
+
+            if not stats:
+                return
+
+            logger.info("Hashing %d files", len(stats))
+            for filename, key in self.annex.calckeys(list(stats), self.config['HASH_WORKERS']):
+                if key is None:
+                    yield filename
+                    continue
+                cache.put(stats[filename], key)
+                if key not in known:
+                    yield filename
+
+    def revision(self):
+        return self.db.get_revision()
+
+    def has_thumb(self, key):
+        return os.path.exists(self._cache_path(key, 'thumb'))
+
+    def thumb_for_key(self, key, wait=True):
+        return self._render(key, 'thumb', '150x150', wait)
+
+    def preview_for_key(self, key, wait=True):
+        return self._render(key, 'preview', '640x640', wait)
+
+    def thumbs_for_keys(self, keys):
+        '''
+        Resolve thumbnails for a list of keys, rendering missing ones in parallel.
+        Returns an iterator of (key, filename) tuples in the order requested,
+        filename is None if the thumbnail could not be rendered or the content
+        is still being fetched (see fetching).
+        '''
+        return zip(keys, self._pool.imap(self._safe_thumb, keys))
+
+    def _safe_thumb(self, key):
+        try:
+            return self.thumb_for_key(key, False)
+        except Exception:
+            logger.exception("Failed to render thumbnail: %s", key)
+            return None
+
+    def file_for_key(self, key, wait=True):
+        '''
+        Path to the content for a key.  Without wait content that isn't here
+        is fetched in the background and None is returned.
+        '''
+        if self.annex.is_local(key):
+            return self.annex.content_for_key(key)
+
+        if not wait:
+            self.fetch_in_background(key)
+            return None
+
+        return self.annex.resolve_key(key)
+
+    def annex_for(self, key):
+        'Annex holding a key, see Federation'
+        return self.annex
+
+    def prefetch(self, key):
+        '''
+        Start fetching the content for a key in the background unless it is
+        here already, returns its fetch_status
+        '''
+        if not self.annex.is_local(key):
+            self.fetch_in_background(key)
+        return self.fetch_status(key)
+
+    def fetching(self, key):
+        'Whether a key is being fetched in the background'
+        with self._fetch_lock:
+            return key in self._fetching
+
+    def fetch_status(self, key):
+        '''
+        Where the content for a key is, as a dict with a state of "local",
+        "remote", "failed" or "fetching" - the last with bytes done and
+        the total so far.
+        '''
+        if self.annex.is_local(key):
+            return {'state': 'local'}
+
+        with self._fetch_lock:
+            self._expire_failed()
+            if key in self._fetching:
+                return dict(self._fetching[key], state='fetching')
+            if key in self._fetch_failed:
+                failed, error = self._fetch_failed[key]
+                return {'state': 'failed', 'error': error, 'failed': failed}
+
+        return {'state': 'remote'}
+
+    def fetch_in_background(self, key):
+        '''
+        Start getting the content for a key from a remote without waiting for
+        it.  Raises AnnexError if the last attempt failed recently.
+        '''
+        with self._fetch_lock:
+            if key in self._fetching:
+                return
+
+            self._expire_failed()
+            if key in self._fetch_failed:
+                raise AnnexError("Unable to fetch key: " + key)
+
+            try:
+                total = parse_key(key).get('size')
+            except ValueError:
+                total = None
+            self._fetching[key] = {'bytes': 0, 'total': total, 'started': time.time()}
+
+            if self._fetch_pool is None:
+                self._fetch_pool = ThreadPool(self.config['FETCH_CONCURRENCY'])
+
+        logger.info("Fetching %s in the background", key)
+        self._fetch_pool.apply_async(self._fetch, (key, ))
+
+    def _expire_failed(self):
+        'Forget failures old enough to retry, needs the fetch lock'
+        cutoff = time.time() - self.config['FETCH_RETRY']
+        for key in [ k for k, (failed, error) in self._fetch_failed.items() if failed < cutoff ]:
+            del self._fetch_failed[key]
+
+    def _fetch(self, key):
+        with self._fetch_lock:
+            status = self._fetching[key]
+
+        def progress(done, total):
+            status['bytes'] = done
+            if total is not None:
+                status['total'] = total
+
+        try:
+            self.annex.get_key(key, progress)
+            failed = None
+        except Exception as e:
+            logger.exception("Failed to fetch %s", key)
+            failed = (time.time(), str(e))
+
+        with self._fetch_lock:
+            del self._fetching[key]
+            if failed is None:
+                self._fetch_failed.pop(key, None)
+            else:
+                self._fetch_failed[key] = failed
+
+    def _cache_path(self, key, name):
+        return os.path.join(self.cache_dir, "{0}-{1}.jpg".format(key, name))
+
+    def _render(self, key, name, size, wait=True):
+        '''
+        Path to a rendered thumbnail or preview.  Without wait content that
+        isn't here is fetched in the background and None is returned.
+        '''
+        filepath = self._cache_path(key, name)
 
         if os.path.exists(filepath):
             return filepath
 
-        original = self.annex.resolve_key(key)
-        subprocess.check_call([
-            'convert', 
-            '-format', 'jpg', 
-            '-thumbnail', '150x150',
-            '-unsharp', '0x.5',
-            '-auto-orient',
-            original + "[0]",
-            filepath
-        ])
-
-
-        return filepath
-
-    def preview_for_key(self, key):
-        filepath = os.path.join(self.cache_dir, key + "-preview.jpg");
-
-        if os.path.exists(filepath):
-            return filepath
+        original = self.file_for_key(key, wait)
+        if original is None:
+            return None
 
-        original = self.annex.resolve_key(key)
+        tmppath = "{0}.{1:d}.tmp".format(filepath, threading.current_thread().ident)
         subprocess.check_call([
             'convert', 
             '-format', 'jpg', 
-            '-thumbnail', '640x640',
+            '-thumbnail', size,
             '-unsharp', '0x.5',
             '-auto-orient',
             original + "[0]",
-            filepath
+            'jpg:' + tmppath
         ])
+        # renders can run in parallel so never expose a partial file
+        os.rename(tmppath, filepath)
 
         return filepath
 
+    def close(self):
+        '''
+        Stops the thumbnail and fetch workers and any long lived git processes
+        '''
+        self._pool.kill()
+        if self._fetch_pool is not None:
+            self._fetch_pool.terminate()
+        self._fetch_pool = None
+        self.annex.close()
+
     def __repr__(self):
         return "<Annex Librarian: {0}>".format(self.base_path)
@@ -12,7 +12,17 @@ import json
 import sys
 import base64
 import io
+import codecs
+import threading
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from .keys import content_location, info_location
 
 try:
     subprocess.DEVNULL
@@ -27,6 +37,13 @@ def noop(*args):
 class AnnexError(Exception):
     pass
 
+class GitError(AnnexError):
+    pass
+
+class BatchError(AnnexError):
+    'A batch process died or stopped responding'
+    pass
+
 def key_for_content(content):
     _, key = os.path.split(content)
     return key
@@ -34,44 +51,227 @@ def key_for_content(content):
 DEBUG = logger.isEnabledFor(logging.INFO)
 
 class GitBatch:
+    '''
+    A git or git-annex command running in --batch mode.
 
-    def __init__(self, cmd, is_json=False):
+    Used as a context manager for a one off batch, or started and kept
+    running with start() and stop() - see Annex.batch_execute.
+    '''
+
+    def __init__(self, cmd, is_json=False, popen=subprocess.Popen):
         self.is_json = is_json
         self.cmd = cmd
+        self.popen = popen
+        self.p = None
+        self.lock = threading.Lock()
 
     def __enter__(self):
-        err = None if DEBUG else subprocess.DEVNULL
-        self.p = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=err, bufsize=0)
-        logger.debug(u"Spawned %r", self.cmd)
+        self.start()
         return self
 
     def __exit__(self, *args):
-        self.p.stdin.close()
-        self.p.stdout.close()
-        self.p.wait()
+        self.stop()
+
+    def start(self):
+        err = None if DEBUG else subprocess.DEVNULL
+        self.p = self.popen(self.cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=err, bufsize=0)
+        logger.debug(u"Spawned %r", self.cmd)
+
+    def alive(self):
+        return self.p is not None and self.p.poll() is None
+
+    def stop(self):
+        p, self.p = self.p, None
+        p.stdin.close()
+        p.stdout.close()
+        p.wait()
 
-        if self.p.returncode != 0:
-            raise subprocess.CalledProcessError(self.p.returncode, " ".join(self.cmd), u"Batch failed")
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, " ".join(self.cmd), u"Batch failed")
         logger.debug(u"Finished batch")
 
-    def execute(self, line, is_json=False):
-        if self.is_json:
-            line = json.dumps(line)
+    def kill(self):
+        '''
+        Stop without caring how it went, for processes that have failed
+        '''
+        p, self.p = self.p, None
+        if p is None:
+            return
+        for f in (p.stdin, p.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+
+    def _send(self, line):
         logger.debug(u"Executing %r", line)
         self.p.stdin.write(bytes(line, 'utf-8'))
         self.p.stdin.write(b'\n')
 
-        result = self.p.stdout.readline().rstrip()
+    def _readline(self):
+        result = self.p.stdout.readline()
+        if not result:
+            raise BatchError(u"Batch process exited: " + " ".join(self.cmd))
+        return result
+
+    def execute(self, line, is_json=False):
+        if self.is_json:
+            line = json.dumps(line)
+        self._send(line)
+
+        result = self._readline().rstrip()
         if self.is_json or is_json:
             result = json.loads(result)
         logger.log(5, u"Received %r", result)
         return result
 
     def close(self):
-        raise RuntimeError("Depreciated call to close()")
+        self.stop()
+
+class CatFileBatch(GitBatch):
+    '''
+    git cat-file --batch, execute returns the contents of an object
+    '''
+
+    def __init__(self, git):
+        GitBatch.__init__(self, git + ('cat-file', '--batch'))
+
+    def execute(self, line, is_json=False):
+        self._send(line)
+
+        header = self._readline().decode('utf-8').split()
+        if header[-1] == 'missing':
+            raise GitError(u"No such object: " + line)
+
+        # unbuffered so reads can come back short
+        remaining = int(header[2]) + 1
+        chunks = []
+        while remaining:
+            chunk = self.p.stdout.read(remaining)
+            if not chunk:
+                raise BatchError(u"Short read from cat-file")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)[:-1]
+
+class InfoWriter:
+    '''
+    Writes .info files to the git-annex branch from a single git fast-import
+    session, committing whenever checkpoint() is called.
+
+    Each commit is made on top of whatever the branch is at the time so
+    git-annex can carry on using the branch in between.  If the branch moves
+    while a commit is being made the ref isn't updated and the files are
+    kept for the next checkpoint - the final one tries again on top of the
+    new tip and gives up with an AnnexError naming the files not written.
+    '''
+
+    # attempts at the final checkpoint before giving up
+    FINAL_TRIES = 5
+
+    def __init__(self, annex, message="Inspecting files."):
+        self.annex = annex
+        self.message = message
+        self.pending = []
+
+    def __enter__(self):
+        self.user = self.annex.git_line('config', 'user.name')
+        self.email = self.annex.git_line('config', 'user.email')
+
+        self.cmd = self.annex.git_cmd(('fast-import', '--date-format=now', '--quiet'))
+        self._start()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self.checkpoint(True)
+        finally:
+            self._stop()
+
+        if exc_type is None and self.p.returncode != 0:
+            raise subprocess.CalledProcessError(self.p.returncode, " ".join(self.cmd), u"fast-import failed")
+
+    def _start(self):
+        self.p = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.s = codecs.getwriter('utf-8')(self.p.stdin)
+        self.marks = 0
+
+    def _stop(self):
+        self.s.close()
+        self.p.stdout.close()
+        self.p.wait()
+
+    def write(self, key, data):
+        self.pending.append((key, data))
+
+    def checkpoint(self, final=False):
+        '''
+        Commits the pending .info files, returning (commit, parent, written)
+        or None if there was nothing to commit or the branch moved.  If final
+        a branch that moved is retried and AnnexError raised if the files
+        still couldn't be written.
+        '''
+        for attempt in range(self.FINAL_TRIES if final else 1):
+            if not self.pending:
+                return None
+            result = self._commit()
+            if result is not None:
+                return result
+
+        if final:
+            raise AnnexError(u"git-annex branch kept moving, {0:d} .info files not written: {1}".format(
+                len(self.pending), u", ".join(key for key, data in self.pending)))
+        return None
+
+    def _commit(self):
+        parent = self.annex.git_line('rev-parse', 'refs/heads/git-annex')
+        self.marks += 1
+
+        s = self.s
+        s.write(u"commit refs/heads/git-annex\n")
+        s.write(u"mark :{0}\n".format(self.marks))
+        s.write(u"committer {0} <{1}> now\n".format(self.user, self.email))
+        s.write(u"data {0}\n{1}\n".format(len(self.message.encode('utf-8')), self.message))
+        s.write(u"from {0}\n".format(parent))
+
+        for key, data in self.pending:
+            location = info_location(key)
+            logger.debug("Writing to %s", location)
+            s.write(u"M 100644 inline {0}\n".format(location))
+            s.write(u"data <<EOT\n")
+            s.write(json.dumps(data))
+            s.write(u"\nEOT\n")
+
+        s.write(u"\ncheckpoint\n\n")
+        s.write(u"get-mark :{0}\n".format(self.marks))
+        s.flush()
+
+        commit = self.p.stdout.readline().decode('utf-8').strip()
+        if not commit:
+            raise AnnexError("fast-import exited unexpectedly")
+
+        tip = self.annex.git_line('rev-parse', 'refs/heads/git-annex')
+        if tip != commit:
+            logger.warning("git-annex branch moved, will retry %d files", len(self.pending))
+
+            # fast-import exits with an error once it has failed to update a
+            # ref, and its branch isn't the real one any more, so start again
+            self._stop()
+            self._start()
+            return None
+
+        written, self.pending = self.pending, []
+        logger.debug("Committed %d files as %s", len(written), commit)
+        return commit, parent, written
 
 class Annex:
 
+    _uuid = None
+
     def __init__(self, path):
         self.repo = os.path.abspath(path)
         
@@ -81,9 +281,24 @@ class Annex:
 
         self.git_options = {'work_dir': self.repo};
 
+        # long lived batch processes, see batch_execute
+        self._batches = {}
+        self._batches_lock = threading.Lock()
+
     def relative_path(self, p):
         return os.path.join(self.repo, p);
 
+    @property
+    def uuid(self):
+        'UUID of this repository'
+        if self._uuid is None:
+            self._uuid = self.git_line('config', 'annex.uuid')
+        return self._uuid
+
+    def is_local(self, key):
+        'Whether the content for a key is in this repository'
+        return os.path.exists(self.content_for_key(key))
+
     def git_cmd(self, args, options=None):
         opts = self.git_options.copy();
         if options: opts.update(options);
@@ -93,13 +308,22 @@ class Annex:
 
         return cmd + args
 
+    def _popen(self, cmd, **kwargs):
+        return subprocess.Popen(cmd, **kwargs)
+
     def git_raw(self, *args, **kwargs):
         #cmd = self.git_cmd + args
         cmd = self.git_cmd(args, kwargs)
         logger.debug("Executing %r", cmd)
 
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        sout, serr = p.communicate()
+        p = self._popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            sout, serr = p.communicate()
+        except BaseException:
+            # cancelled (e.g. a gevent Timeout) so don't leave git running
+            p.kill()
+            p.wait()
+            raise
 
         if p.returncode != 0:
             if DEBUG:
@@ -133,7 +357,104 @@ class Annex:
         extra = (u'--json', u'--batch') if is_json else (u'--batch', )
         #cmd = self.git_cmd + tuple(args) + extra
         cmd = self.git_cmd(tuple(args) + extra)
-        return GitBatch(cmd, is_json)
+        return GitBatch(cmd, is_json, self._popen)
+
+    def _pooled(self, name, make):
+        with self._batches_lock:
+            batch = self._batches.get(name)
+            if batch is None:
+                batch = self._batches[name] = make()
+            return batch
+
+    def _execute(self, batch, line):
+        with batch.lock:
+            for attempt in range(2):
+                if not batch.alive():
+                    batch.kill()
+                    batch.start()
+                try:
+                    return batch.execute(line)
+                except (BatchError, IOError, OSError) as e:
+                    logger.warning(u"Restarting %r: %s", batch.cmd, e)
+                    batch.kill()
+
+        raise BatchError(u"Batch process keeps failing: " + " ".join(batch.cmd))
+
+    def batch_execute(self, args, line, is_json=False):
+        '''
+        Runs a line through a long lived `args --batch` process, started on
+        first use and restarted if it dies.  Each process has its own lock
+        so this can be called from any thread.
+
+        Only for commands that don't change anything - git-annex commits its
+        journal when a command exits so commands like get and metadata should
+        still use a git_batch per operation.
+        '''
+        extra = (u'--json', u'--batch') if is_json else (u'--batch', )
+        batch = self._pooled((tuple(args), is_json),
+                lambda: GitBatch(self.git_cmd(tuple(args) + extra), is_json))
+        return self._execute(batch, line)
+
+    def cat_file(self, obj):
+        '''
+        Contents of a git object (a blob id, <branch>:<path> etc) as bytes
+        from a long lived `git cat-file --batch`
+        '''
+        batch = self._pooled(('cat-file', ), lambda: CatFileBatch(self.git_cmd(())))
+        return self._execute(batch, obj)
+
+    def calckey(self, filename):
+        'Key the file would have if it was added to the annex'
+        return self.batch_execute(['annex', 'calckey'], filename).decode('utf-8')
+
+    def calckeys(self, filenames, workers=4):
+        '''
+        Iterator of (filename, key) for a lot of files, hashing them with
+        several calckey processes at once.  Results come back in whatever
+        order they finish, key is None if the file couldn't be hashed.
+        '''
+        free = Queue()
+        batches = [ GitBatch(self.git_cmd(('annex', 'calckey', '--batch'))) for i in range(workers) ]
+
+        def calc(filename):
+            batch = free.get()
+            try:
+                key = batch.execute(filename).decode('utf-8')
+            finally:
+                free.put(batch)
+            if not key:
+                logger.warning(u"Could not hash %s", filename)
+            return filename, key or None
+
+        pool = ThreadPool(workers)
+        try:
+            for batch in batches:
+                batch.start()
+                free.put(batch)
+
+            for result in pool.imap_unordered(calc, filenames):
+                yield result
+        finally:
+            pool.terminate()
+            for batch in batches:
+                batch.kill()
+
+    def close(self):
+        '''
+        Stops any long lived batch processes
+        '''
+        with self._batches_lock:
+            batches, self._batches = list(self._batches.values()), {}
+
+        for batch in batches:
+            with batch.lock:
+                try:
+                    if batch.alive():
+                        batch.stop()
+                except subprocess.CalledProcessError:
+                    logger.warning(u"Batch exited with an error: %r", batch.cmd)
+                finally:
+                    batch.kill()
 
     def content_for_link(self, link):
         l = self.relative_path(link)
@@ -148,24 +469,22 @@ class Annex:
         f = os.path.realpath(self.relative_path(link))
         return os.path.basename(f)
 
+    def content_for_key(self, key):
+        '''
+        Path the content for a key will be at, whether present or not
+        '''
+        try:
+            return self.relative_path(content_location(key))
+        except ValueError:
+            raise AnnexError("Invalid key: " + key)
+
     def resolve_key(self, key):
         '''
         Convert key to annexed file path.
         Retrieves content from remotes if required
         Returns <string> path to content.
         '''
-        try:
-            p = self.git_line(u'annex', u'examinekey', u'--format', u'.git/annex/objects/${hashdirmixed}${key}/${key}', key)
-            p = self.relative_path(p)
-        except subprocess.CalledProcessError:
-            raise AnnexError("Invalid key: " + key)
-
-        try:
-            if not os.path.exists(p):
-                self.git_raw('annex', 'get', '--key', key)
-            return p
-        except subprocess.CalledProcessError:
-            raise AnnexError("Unable to locate key: " + key)
+        return self.resolve_keys([key])[0][1]
 
     def resolve_keys(self, keys, tick=noop):
         '''
@@ -175,11 +494,69 @@ class Annex:
         '''
         
         result = []
-        for key in keys:
-            result.append((key, self.resolve_key(key)))
+        for key, p, fetched in self.iter_resolve_keys(keys):
+            result.append((key, p))
             tick()
         return result
 
+    def iter_resolve_keys(self, keys):
+        '''
+        Generator version of resolve_keys.
+        Yields (key, filename, fetched) tuples as soon as each one is available.
+        '''
+        for key in keys:
+            p = self.content_for_key(key)
+            fetched = not os.path.exists(p)
+
+            if fetched:
+                try:
+                    self.git_raw('annex', 'get', '--key', key)
+                except subprocess.CalledProcessError:
+                    raise AnnexError("Unable to locate key: " + key)
+
+            yield key, p, fetched
+
+    def get_key(self, key, progress=noop):
+        '''
+        Get the content for a key from a remote, calling progress(done, total)
+        with byte counts as it goes.  Returns the path to the content.
+        '''
+        cmd = self.git_cmd(('annex', 'get', '--key', key, '--json', '--json-progress'))
+        logger.debug("Executing %r", cmd)
+
+        p = self._popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        success = False
+        complete = False
+        try:
+            for line in iter(p.stdout.readline, b''):
+                try:
+                    status = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                if 'byte-progress' in status:
+                    progress(status['byte-progress'], status.get('total-size'))
+                    complete = status['byte-progress'] == status.get('total-size')
+                elif 'success' in status:
+                    success = status['success']
+            p.wait()
+        except BaseException:
+            p.kill()
+            p.wait()
+            raise
+        finally:
+            p.stdout.close()
+
+        # nothing is reported if the content was already here
+        path = self.content_for_key(key)
+        if p.returncode != 0 or not (success or os.path.exists(path)):
+            raise AnnexError("Unable to locate key: " + key)
+
+        # small files can arrive without any progress being reported
+        if success and not complete:
+            size = os.path.getsize(path)
+            progress(size, size)
+        return path
+
     def resolve_link(self, link):
         '''
         Resolves a branch symlink to its annexed file.
@@ -192,27 +569,89 @@ class Annex:
         '''
         Resolve a list of symlinks to the annexed files they refer to.
         Retrieves content from remotes if required.
-        Returns a list of (key, filename) tuples.
+        Returns a list of (link, filename) tuples in the order given.
         '''
 
         items = [ (link, self.content_for_link(link)) for link in links ]
 
-        missing = [ link for link, f in items if not os.path.exists(f) ]
+        for link, f, fetched in self.iter_resolve_links(links):
+            tick(os.path.basename(link) if fetched else "")
 
-        for i in range(len(items) - len(missing)): tick()
+        return items
+
+    def iter_resolve_links(self, links):
+        '''
+        Generator version of resolve_links.
+        Yields (link, filename, fetched) tuples as soon as each one is available,
+        content already present comes first.
+        '''
+
+        items = [ (link, self.content_for_link(link)) for link in links ]
+
+        missing = []
+        for link, f in items:
+            if os.path.exists(f):
+                yield link, f, False
+            else:
+                missing.append((link, f))
 
         if missing:
-            e = None
             with self.git_batch(['annex', 'get', '--json']) as batch:
-                for link in missing:
+                for link, f in missing:
                     result = batch.execute(link)
                     if not result:
                         raise AnnexError("Unable to locate file: " + link)
-                    tick(os.path.basename(link))
+                    yield link, f, True
 
-        
-        return items
+    def drop_key(self, key):
+        '''
+        Drops local content for a key if enough copies exist elsewhere.
+        Returns True if the content was dropped.
+        '''
+        try:
+            self.git_raw('annex', 'drop', '--key', key)
+            return True
+        except subprocess.CalledProcessError:
+            logger.warning("Unable to drop %s", key)
+            return False
     
+    def update_metadata(self, keys, add=None, remove=None, set_fields=None, tick=noop):
+        '''
+        Change metadata on a list of keys using a single batch process.
+        add, remove and set_fields are dicts of field => list of values,
+        set_fields replacing whatever the field had.
+        Returns a list of (key, fields) tuples with the resulting metadata.
+        '''
+        result = []
+
+        with self.git_batch(['annex', 'metadata'], True) as batch:
+            for key in keys:
+                try:
+                    current = batch.execute({'key': key})
+                except ValueError:
+                    raise AnnexError("Unable to read metadata for key: " + key)
+
+                fields = clean_metadata(current['fields'])
+                for field, values in (set_fields or {}).items():
+                    fields[field] = list(values)
+                for field, values in (add or {}).items():
+                    existing = fields.setdefault(field, [])
+                    existing.extend([ v for v in values if v not in existing ])
+                for field, values in (remove or {}).items():
+                    fields[field] = [ v for v in fields.get(field, []) if v not in values ]
+
+                try:
+                    updated = batch.execute({'key': key, 'fields': fields})
+                except ValueError:
+                    updated = {}
+                if not updated.get('success'):
+                    raise AnnexError("Unable to update metadata for key: " + key)
+
+                result.append((key, clean_metadata(updated['fields'])))
+                tick()
+
+        return result
+
     def get_commit_list(self, branch, start, end=None):
         '''
         Returns a list of commits 
@@ -290,14 +729,60 @@ def parse_meta_log(lines):
 
     return { k: list(v.keys()) for k, v in result.items() if v }
 
+def clean_metadata(fields):
+    '''
+    Strips the lastchanged pseudo fields and empty values from
+    metadata reported by git-annex
+    '''
+    return { k: list(v) for k, v in fields.items() if v and not k.endswith('lastchanged') }
+
+def parse_metadata_args(args):
+    '''
+    Converts `git annex metadata` style arguments (-t, -u and -s with
+    =, += or -=) into add, remove and set_fields dicts for update_metadata
+    '''
+    add, remove, set_fields = {}, {}, {}
+    args = list(args)
+
+    while args:
+        opt = args.pop(0)
+        try:
+            value = args.pop(0)
+        except IndexError:
+            raise ValueError("Missing value for " + opt)
+
+        if opt in ('-t', '--tag'):
+            add.setdefault('tag', []).append(value)
+        elif opt in ('-u', '--untag'):
+            remove.setdefault('tag', []).append(value)
+        elif opt in ('-s', '--set'):
+            field, sep, v = value.partition('=')
+            if not sep or not field:
+                raise ValueError("Invalid field: " + value)
+            if field[-1] == '+':
+                add.setdefault(field[:-1], []).append(v)
+            elif field[-1] == '-':
+                remove.setdefault(field[:-1], []).append(v)
+            else:
+                set_fields.setdefault(field, []).append(v)
+        else:
+            raise ValueError("Unsupported option: " + opt)
+
+    return add, remove, set_fields
+
 def parse_location_log(lines):
-    locations = set()
-    
+    '''
+    UUIDs of the repositories that have the content, going by the newest
+    line for each repository
+    '''
+    latest = {}
+
     for line in lines:
         parts = line.split()
-        if parts[1] == '1': 
-            locations.add(parts[2])
-        else:
-            locations.discard(parts[2])
-    
-    return list(locations)
+        if len(parts) < 3:
+            continue
+        timestamp = float(parts[0].rstrip('s'))
+        if parts[2] not in latest or timestamp >= latest[parts[2]][0]:
+            latest[parts[2]] = (timestamp, parts[1] == '1')
+
+    return sorted( uuid for uuid, (_, present) in latest.items() if present )
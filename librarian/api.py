@@ -1,9 +1,19 @@
-from flask import Blueprint, jsonify, request, abort, send_file, Response
+from flask import Blueprint, jsonify, request, abort, send_file, Response, make_response
+import functools
+import hashlib
 import logging
 import shlex
 
+from librarian.annex import parse_metadata_args
+
 logger = logging.getLogger(__name__)
 
+MAX_BATCH = 100
+
+# keys are content hashes so anything addressed by key never changes
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
 def get_request_int(name, default=0):
     s = request.args.get(name)
     if s is None:
@@ -14,21 +24,89 @@ def get_request_int(name, default=0):
     except ValueError:
         return default
 
+def conditional(etag, cache_control, build):
+    '''
+    Answer a conditional GET with a 304 before doing any work, otherwise
+    build the response and attach the validators
+    '''
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+
+        # e.g. still fetching, which mustn't be cached
+        if response.status_code not in (200, 206):
+            return response
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def cached(etag_for, cache_control):
+    '''
+    View decorator - etag_for is called with the view arguments
+    '''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            return conditional(etag_for(*args, **kwargs), cache_control,
+                    lambda: view(*args, **kwargs))
+        return wrapper
+    return decorator
+
+def pending(status=None):
+    '''
+    Response for content that is being fetched from a remote
+    '''
+    response = jsonify(status) if status is not None else Response()
+    response.status_code = 202
+    response.headers['Retry-After'] = '2'
+    return response
 
-def create_api(librarian):
+def create_api(librarian, worker=None):
+    '''
+    If a SyncWorker is given syncs are run in the background, otherwise
+    they run inline with the request.  librarian can also be a Federation
+    with a FederatedWorker.
+    '''
 
     api = Blueprint('api', __name__)
 
+    def sync():
+        if worker is None:
+            return librarian.sync()
+        worker.trigger()
+
+    def update_metadata(keys, add, remove, set_fields):
+        if worker is None:
+            return librarian.update_metadata(keys, add, remove, set_fields)
+        return worker.submit(librarian.__class__.update_metadata, keys, add, remove, set_fields).get()
+
+    @api.before_request
+    def refresh():
+        # pick up anything the worker has committed
+        librarian.db.reopen()
+
+    def for_key(name):
+        return lambda key: "{0}-{1}".format(name, key)
+
+    def for_revision(*args, **kwargs):
+        return "r{0}".format(librarian.revision())
+
     def handle_search(q):
         
         limit = get_request_int('limit', 20)
         offset = get_request_int('offset', 0)
 
         if q:
-            result = librarian.search(q, offset, limit)
+            try:
+                result = librarian.search(q, offset, limit)
+            except ValueError as e:
+                # malformed queries (QueryError) are the client's fault
+                return jsonify({'result': 'error', 'message': str(e)}), 400
             result['q'] = q
         else:
-            result = librarian.db.alldocs(offset, limit)
+            result = librarian.alldocs(offset, limit)
 
         result['limit'] = limit
         result['offset'] = offset
@@ -36,46 +114,166 @@ def create_api(librarian):
         return jsonify(result);
         
     @api.route('/meta/<field>') 
+    @cached(for_revision, REVALIDATE)
     def field_cloud(field):
         return jsonify(librarian.db.field_cloud(field))
 
     @api.route('/meta/<field>/<string:value>')
+    @cached(for_revision, REVALIDATE)
     def search_field(field, value):
         return handle_search("{0}:{1}".format(field, value))
 
     @api.route('/search')
+    @cached(for_revision, REVALIDATE)
     def search_text():
         return handle_search(request.args.get('q'))
 
+    @api.route('/geo/clusters')
+    @cached(for_revision, REVALIDATE)
+    def geo_clusters():
+        try:
+            south, west, north, east = [ float(x) for x in request.args.get('bbox', '-90,-180,90,180').split(',') ]
+        except ValueError:
+            return abort(400)
+
+        precision = get_request_int('precision', 0) or None
+        try:
+            clusters = librarian.db.geo_clusters(south, west, north, east, precision)
+        except ValueError:
+            return abort(400)
+        return jsonify({'clusters': clusters, 'total': sum(c['count'] for c in clusters)})
+
     @api.route('/thumb/<string:key>')
+    @cached(for_key('thumb'), IMMUTABLE)
     def get_thumb(key):
         try:
-            return send_file(librarian.thumb_for_key(key));
+            filename = librarian.thumb_for_key(key, False)
         except:
-            logger.exception("Failed to get preview: " + key);
+            logger.exception("Failed to get thumbnail: " + key);
             return abort(404)
+        return pending() if filename is None else send_file(filename)
+
+    @api.route('/thumbs')
+    def get_thumbs():
+        '''
+        Batched thumbnails for the keys given as repeated `key` parameters.
+        The body is a stream of `<key> <length>\\n` headers, each followed by
+        <length> bytes of jpeg - a length of 0 means the thumbnail failed and
+        -1 that the content is still being fetched.
+        '''
+        keys = request.args.getlist('key')
+        if not keys or len(keys) > MAX_BATCH:
+            return abort(400)
+
+        def build():
+            return Response(generate(), mimetype='application/x-librarian-thumbs')
+
+        def generate():
+            for key, filename in librarian.thumbs_for_keys(keys):
+                if filename is None and librarian.fetching(key):
+                    yield "{0} -1\n".format(key).encode('utf-8')
+                    continue
+                data = b''
+                if filename is not None:
+                    with open(filename, 'rb') as f:
+                        data = f.read()
+                yield "{0} {1:d}\n".format(key, len(data)).encode('utf-8')
+                yield data
+
+        # only cache once every tile has rendered so failures get retried
+        if not all(librarian.has_thumb(key) for key in keys):
+            return build()
+
+        etag = hashlib.sha1(u"\n".join(keys).encode('utf-8')).hexdigest()
+        return conditional("thumbs-" + etag, IMMUTABLE, build)
 
     @api.route('/preview/<string:key>')
+    @cached(for_key('preview'), IMMUTABLE)
     def get_preview(key):
         try:
-            return send_file(librarian.preview_for_key(key));
+            filename = librarian.preview_for_key(key, False)
         except:
             logger.exception("Failed to get preview: " + key);
             return abort(404)
+        return pending() if filename is None else send_file(filename)
 
     @api.route('/item/<string:key>')
+    @cached(for_key('item'), IMMUTABLE)
     def get_blob(key):
+        '''
+        The content for a key, with support for Range requests.  Content
+        that isn't here is fetched in the background - until it arrives the
+        answer is a 202 with the status from /item/<key>/status.
+        '''
         try:
-            return send_file(librarian.file_for_key(key));
+            filename = librarian.file_for_key(key, False)
         except:
             logger.exception("Failed to get file: " + key)
             return abort(404)
 
+        if filename is None:
+            return pending(librarian.fetch_status(key))
+
+        # werkzeug checks If-Range against the etag so it has to be ours
+        return send_file(filename, conditional=True, etag=for_key('item')(key))
+
+    @api.route('/item/<string:key>/status')
+    def get_blob_status(key):
+        return jsonify(librarian.fetch_status(key))
+
+    @api.route('/prefetch', methods=['POST'])
+    def prefetch():
+        '''
+        Start fetching the content for {"keys": [...]} in the background,
+        returns the status of each
+        '''
+        payload = request.get_json()
+        if not payload or not payload.get('keys') or len(payload['keys']) > MAX_BATCH:
+            return abort(400)
+
+        status = {}
+        for key in payload['keys']:
+            try:
+                status[key] = librarian.prefetch(key)
+            except Exception as e:
+                logger.warning("Not prefetching %s: %s", key, e)
+                status[key] = {'state': 'failed', 'error': str(e)}
+
+        return jsonify({'status': status})
+
     @api.route('/data/<string:key>')
+    @cached(for_revision, REVALIDATE)
     def get_data(key):
         data = librarian.get_data(key)
         return jsonify(data)
 
+    @api.route('/metadata', methods=['POST'])
+    def bulk_metadata():
+        '''
+        Change metadata for a set of keys in one go.
+        Payload is {"keys": [...], "args": "-t tag -s field=value"} or
+        {"keys": [...], "add": {...}, "remove": {...}, "set": {...}}
+        '''
+        payload = request.get_json()
+        if not payload or not payload.get('keys'):
+            return abort(400)
+
+        try:
+            if 'args' in payload:
+                add, remove, set_fields = parse_metadata_args(shlex.split(payload['args']))
+            else:
+                add, remove, set_fields = payload.get('add'), payload.get('remove'), payload.get('set')
+        except ValueError as e:
+            return jsonify({'result': 'error', 'message': str(e)}), 400
+
+        try:
+            c = update_metadata(payload['keys'], add, remove, set_fields)
+        except Exception as e:
+            logger.exception("Failed to update metadata")
+            return jsonify({'result': 'error', 'message': str(e)}), 400
+
+        return jsonify({"result": "ok", 'message': 'Updated {0} items'.format(c)})
+
     @api.route('/cli', methods=['POST'])
     def run_command():
         payload = request.get_json()
@@ -90,28 +288,53 @@ def create_api(librarian):
             return abort(400)
  
         if 'keys' not in payload:
+            # a federation has no single repository to run it in
+            if librarian.annex is None:
+                return abort(400)
             try:
                 logger.info("Executing %r", cmd)
                 return jsonify({'result': 'ok', 'message': librarian.annex.git_raw(*cmd)})
-            except Exception, e:
+            except Exception:
                 return abort(400)
 
+        if cmd[:2] == ['annex', 'metadata']:
+            # keys before a failure are already changed, so running it again
+            # key by key could apply those changes twice
+            try:
+                c = update_metadata(payload['keys'], *parse_metadata_args(cmd[2:]))
+            except Exception as e:
+                logger.exception("Failed to update metadata")
+                return jsonify({'result': 'error', 'message': str(e)}), 400
+            return jsonify({"result": "ok", 'message': 'Updated {0} items'.format(c)})
+
         cmd.append('--key')
         c = 0
         for key in payload['keys']:
             try:
                 args = cmd + [key]
-                librarian.annex.git_lines(*args)
+                librarian.annex_for(key).git_lines(*args)
                 c += 1
-            except Exception, e:
+            except Exception:
                 return abort(400)
 
-        librarian.sync()
+        sync()
         return jsonify({"result": "ok", 'message': 'Updated {0} items'.format(c)}) 
 
     @api.route('/sync')
     def sync_librarian():
-        return jsonify({'result': 'ok', 'commit': librarian.sync()})
+        if worker is None:
+            return jsonify({'result': 'ok', 'commit': librarian.sync()})
+
+        status = worker.get_status()
+        status['result'] = 'ok'
+        status['triggered'] = worker.trigger()
+        return jsonify(status)
+
+    @api.route('/sync/status')
+    def sync_status():
+        if worker is None:
+            return jsonify({'state': 'idle', 'commit': librarian.get_head('git-annex')})
+        return jsonify(worker.get_status())
 
     return api
 
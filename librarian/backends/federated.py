@@ -0,0 +1,73 @@
+'''
+Read only index over the indexes of several repositories
+
+Xapian can search any number of databases as one, so the indexes stay
+owned (and written) by their own repositories and searches see them all
+with ranking and paging working as before.
+'''
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+
+import xapian
+
+from librarian.backends.xapian_indexer import XapianIndexer
+
+logger = logging.getLogger(__name__)
+
+class FederatedIndexer(XapianIndexer):
+    '''
+    XapianIndexer over the indexers of several repositories, given as a
+    list of (name, indexer).
+
+    A key can be in more than one repository, in which case searches return
+    it once.  Which repository it belongs to is up to the caller, see
+    Federation.librarian_for.
+    '''
+
+    def __init__(self, indexers):
+        XapianIndexer.__init__(self, None)
+        self.indexers = list(indexers)
+
+    @property
+    def db(self):
+        if self._db is None:
+            db = xapian.Database()
+            for name, indexer in self.indexers:
+                db.add_database(xapian.Database(indexer.path))
+            self._db = db
+
+        return self._db
+
+    def set_writable(self, clear=False):
+        raise RuntimeError("A federated index is read only, write to each repository")
+
+    def unset_writable(self):
+        self._db = None
+
+    def get_revision(self):
+        # a database made of several has no single revision
+        self.reopen()
+        return "-".join( str(indexer.get_revision()) for name, indexer in self.indexers )
+
+    def get_value(self, key):
+        raise KeyError("Metadata belongs to each repository: " + key)
+
+    def exists(self, key):
+        return self.db.get_termfreq("QK{0}".format(key)) > 0
+
+    def get_data(self, key, include_terms=False):
+        '''
+        Data for key from whichever repository has it first, with the docid
+        in the combined database (e.g. for similar_query)
+        '''
+        term = "QK{0}".format(key)
+        for match in self.db.postlist(term):
+            doc = self.db.get_document(match.docid)
+            data = json.loads(doc.get_data())
+            data['_docid'] = match.docid
+            if include_terms:
+                data['_terms'] = [ t.term.decode('utf-8') for t in doc.termlist() ]
+            return data
+        raise KeyError("Key not found")
@@ -0,0 +1,382 @@
+'''
+Index split by key hash across several Xapian databases
+
+Xapian can search any number of databases as one, so reads go through a stub
+database listing the shards and ranking and paging work as before.  Writes
+go to one writer process per shard, so indexing work is spread across cores.
+'''
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import zlib
+import shutil
+import logging
+import multiprocessing
+
+import xapian
+
+from librarian.backends import xapian_indexer
+from librarian.backends.xapian_indexer import XapianIndexer, DB_VERSION
+
+logger = logging.getLogger(__name__)
+
+STUB = 'stub'
+
+try:
+    # the server opens the writers from a sync thread with gevent and other
+    # threads running, so don't fork from there (see inspectors.sandbox)
+    _context = multiprocessing.get_context('forkserver')
+except (AttributeError, ValueError):
+    _context = multiprocessing
+
+def shard_for(key, shards):
+    'Which shard a key belongs in'
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+def count_shards(path):
+    'Number of shards in the stub at path, or None if there is no stub'
+    stub = os.path.join(path, STUB)
+    if not os.path.exists(stub):
+        return None
+    with open(stub) as f:
+        return len([ line for line in f if line.strip() ])
+
+def _writer(path, clear, conn):
+    '''
+    Owns the writable database of one shard, calling XapianIndexer methods
+    for requests of (method, args, reply) until it is told to close.
+
+    After a failure nothing more is written and the error is given as the
+    next reply, so the caller finds out at the next request it waits on.
+    '''
+    indexer = XapianIndexer(path)
+    try:
+        indexer.set_writable(clear)
+    except Exception as e:
+        conn.send((str(e), None))
+        return
+    conn.send((None, None))
+
+    error = None
+    while True:
+        method, args, reply = conn.recv()
+        if method == 'close':
+            break
+
+        result = None
+        if error is None:
+            try:
+                result = getattr(indexer, method)(*args)
+            except Exception as e:
+                if method == 'get_data' and isinstance(e, KeyError):
+                    # not in the index, which the caller expects
+                    result = e
+                else:
+                    logger.exception("Shard %s failed on %s", path, method)
+                    error = "{0}: {1}".format(e.__class__.__name__, e)
+
+        if reply:
+            conn.send((error, result))
+
+    if error is None:
+        indexer.unset_writable()
+    conn.send((error, None))
+
+def _reindex_shard(args):
+    '''
+    Rebuilds the documents that belong in shard from the database at source
+    into a new database at target.  Runs in a worker process.
+    '''
+    source_path, target, shard, shards = args
+
+    indexer = XapianIndexer(target)
+    source = xapian.Database(source_path)
+    out = xapian.WritableDatabase(target, xapian.DB_CREATE_OR_OVERWRITE)
+
+    count = 0
+    for t in source.allterms('QK'):
+        # only load the documents that belong here
+        key = t.term[2:].decode('utf-8')
+        if shard_for(key, shards) != shard:
+            continue
+
+        for p in source.postlist(t.term):
+            data = json.loads(source.get_document(p.docid).get_data())
+            data.pop('_docid', None)
+            out.replace_document(t.term, indexer.make_document(key, data, source))
+
+            count += 1
+            if count % xapian_indexer.REINDEX_BATCH == 0:
+                out.commit()
+
+    out.set_metadata('db:version', DB_VERSION)
+    out.close()
+    return count
+
+class ShardedIndexer(XapianIndexer):
+    '''
+    XapianIndexer over shards 0 to shards - 1 in the directory at path.
+
+    Branch heads and other metadata live in shard 0.  While writable they are
+    held back until every shard has committed, so a head is never recorded
+    for data that didn't make it.
+
+    previous is an unsharded database to build the shards from on the first
+    reindex.
+    '''
+
+    def __init__(self, path, shards, previous=None):
+        XapianIndexer.__init__(self, os.path.join(path, STUB))
+        self.base = path
+        self.shards = shards
+        self.previous = previous
+
+        self._writers = None
+        self._pending_meta = {}
+
+        if not os.path.exists(path):
+            os.mkdir(path, 0o700)
+        if not os.path.exists(self.path):
+            self._write_stub()
+
+    def shard_path(self, i):
+        return os.path.join(self.base, str(i))
+
+    def _write_stub(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for i in range(self.shards):
+                f.write("auto {0:d}\n".format(i))
+        os.rename(tmp, self.path)
+
+    @property
+    def db(self):
+        if self._db is None:
+            found = count_shards(self.base)
+            if found != self.shards:
+                raise RuntimeError("Index has {0:d} shards not {1:d}, run `git librarian reindex`".format(
+                    found, self.shards))
+            if self._unmigrated():
+                raise RuntimeError("Index isn't sharded yet, run `git librarian reindex`")
+            self._db = xapian.Database(self.path)
+            self._check_version()
+
+        return self._db
+
+    def _unmigrated(self):
+        'Whether there is a previous index and no shards built from it yet'
+        return bool(self.previous and os.path.exists(self.previous)
+                and not os.path.exists(self.shard_path(0)))
+
+    def _writer_for(self, key):
+        return self._writers[shard_for(key, self.shards)]
+
+    def _send(self, conn, method, *args):
+        conn.send((method, args, False))
+
+    def _call(self, conn, method, *args):
+        conn.send((method, args, True))
+        error, result = conn.recv()
+        if error is not None:
+            raise RuntimeError("Shard writer failed: " + error)
+        return result
+
+    def set_writable(self, clear=False):
+        if self._writers is not None:
+            self.unset_writable()
+        self._db = None
+
+        # the writers would start empty shards and the old index be forgotten
+        if not clear and self._unmigrated():
+            raise RuntimeError("Index isn't sharded yet, run `git librarian reindex`")
+
+        self._writers = []
+        for i in range(self.shards):
+            parent, child = _context.Pipe()
+            p = _context.Process(target=_writer, args=(self.shard_path(i), clear, child))
+            p.daemon = True
+            p.start()
+            self._writers.append((p, parent))
+
+        for p, conn in self._writers:
+            error, _ = conn.recv()
+            if error is not None:
+                self.kill()
+                raise RuntimeError("Shard writer failed: " + error)
+
+    def unset_writable(self):
+        if self._writers is None:
+            self._db = None
+            return
+
+        writers, self._writers = self._writers, None
+        meta, self._pending_meta = self._pending_meta, {}
+
+        # shard 0 goes last so the heads are only written once the rest is in
+        errors = []
+        for p, conn in writers[1:] + writers[:1]:
+            if p is writers[0][0] and not errors:
+                for name, value in meta.items():
+                    self._send(conn, 'set_value', name, value)
+            conn.send(('close', (), False))
+            error, _ = conn.recv()
+            p.join()
+            if error is not None:
+                errors.append(error)
+
+        self._db = None
+        if errors:
+            raise RuntimeError("Shard writer failed: " + "; ".join(errors))
+
+    def kill(self):
+        'Stops the writers without committing anything more'
+        writers, self._writers = self._writers or [], None
+        self._pending_meta = {}
+        for p, conn in writers:
+            p.terminate()
+            p.join()
+
+    def close(self):
+        self.unset_writable()
+
+    def reopen(self):
+        if self._writers is None:
+            XapianIndexer.reopen(self)
+
+    def get_revision(self):
+        # the stub is several databases, which have no single revision
+        self.reopen()
+        return "-".join( str(xapian.Database(self.shard_path(i)).get_revision())
+                for i in range(self.shards) )
+
+    def get_value(self, key):
+        if key in self._pending_meta:
+            return self._pending_meta[key]
+        return XapianIndexer.get_value(self, key)
+
+    def set_value(self, key, value):
+        if self._writers is None:
+            raise RuntimeError("Index is not writable")
+        self._pending_meta[key] = value
+
+    def get_data(self, key, include_terms=False):
+        if self._writers is None:
+            return XapianIndexer.get_data(self, key, include_terms)
+
+        result = self._call(self._writer_for(key)[1], 'get_data', key, include_terms)
+        if isinstance(result, KeyError):
+            raise result
+        return result
+
+    def exists(self, key):
+        if self._writers is None:
+            return XapianIndexer.exists(self, key)
+        return self._call(self._writer_for(key)[1], 'exists', key)
+
+    def update_data(self, key, info):
+        self._send(self._writer_for(key)[1], 'update_data', key, info)
+
+    def update_branch(self, key, branch, path):
+        self._send(self._writer_for(key)[1], 'update_branch', key, branch, path)
+
+    def put_data(self, key, data):
+        self._send(self._writer_for(key)[1], 'put_data', key, data)
+
+    def delete(self, key):
+        self._send(self._writer_for(key)[1], 'delete', key)
+
+    def gc(self, before, purge=False):
+        # the query runs on the stub, which only sees what the writers have
+        # committed - e.g. a document a sync has just brought back would
+        # still look dropped
+        if self._writers is not None:
+            self.unset_writable()
+            self.set_writable()
+        return XapianIndexer.gc(self, before, purge)
+
+    def tables(self):
+        tables = {}
+        for i in range(self.shards):
+            for table, size in XapianIndexer(self.shard_path(i)).tables().items():
+                tables[table] = tables.get(table, 0) + size
+        return tables
+
+    def compact(self):
+        self.unset_writable()
+
+        before = after = 0
+        for i in range(self.shards):
+            b, a = XapianIndexer(self.shard_path(i)).compact()
+            before += b
+            after += a
+        return before, after
+
+    def reindex(self, workers=None, tick=None):
+        '''
+        Rebuilds every shard in parallel from the data stored in the index -
+        the current shards, or the previous unsharded database if there
+        aren't any yet, which is removed once the shards are in place.  Also
+        how the number of shards is changed.
+        '''
+        self.unset_writable()
+
+        current = [ self.shard_path(i) for i in range(count_shards(self.base) or 0) ]
+        if all( os.path.exists(p) for p in current ):
+            source, locked = self.path, current
+        elif self.previous and os.path.exists(self.previous):
+            source, locked = self.previous, [self.previous]
+        else:
+            raise RuntimeError("Nothing to reindex from")
+        logger.info("Reindexing %s into %d shards", source, self.shards)
+
+        news = [ self.shard_path(i) + '.reindex' for i in range(self.shards) ]
+        for new in news:
+            if os.path.exists(new):
+                shutil.rmtree(new)
+
+        # hold the write locks so nothing changes while we work
+        locks = [ xapian.WritableDatabase(p, xapian.DB_OPEN) for p in locked ]
+        try:
+            pool = _context.Pool(min(workers or self.shards, self.shards))
+            try:
+                count = 0
+                for c in pool.imap_unordered(_reindex_shard,
+                        [ (source, new, i, self.shards) for i, new in enumerate(news) ]):
+                    count += c
+                    if tick:
+                        tick(c)
+            finally:
+                pool.terminate()
+                pool.join()
+
+            db = xapian.Database(source)
+            first = xapian.WritableDatabase(news[0], xapian.DB_OPEN)
+            for name in db.metadata_keys():
+                if name != b'db:version':
+                    first.set_metadata(name, db.get_metadata(name))
+            first.close()
+            db.close()
+        finally:
+            for lock in locks:
+                lock.close()
+
+        for i, new in enumerate(news):
+            self._swap_in(new, self.shard_path(i))
+        self._write_stub()
+
+        # shards left over from having more of them, or the unsharded
+        # index now it has been migrated
+        stale = current[self.shards:]
+        if source == self.previous:
+            logger.info("Removing the unsharded index %s", self.previous)
+            stale.append(self.previous)
+        for p in stale:
+            if os.path.islink(p):
+                shutil.rmtree(os.path.realpath(p))
+                os.remove(p)
+            else:
+                shutil.rmtree(p)
+
+        logger.info("Reindexed %d documents", count)
+        return count
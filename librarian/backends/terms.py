@@ -1,5 +1,5 @@
 
-SCHEMA_VERSION = '0.2'
+SCHEMA_VERSION = '0.4'
 
 '''
 Will be indexed prefixed and unstemmed.
@@ -25,6 +25,10 @@ PREFIXED_UNSTEMMED_BOOLEAN = (
 
     ('state', 'XS'),
     ('inspector', 'XI'),
+    ('failed', 'XF'),
+    ('dhash', 'XH'),
+    ('geohash', 'XG'),
+    ('present', 'XL'), # repository uuids with the content, or "here"
     ('device', 'XD'),
     ('props', 'XP'),
     ('prop', 'XP'),
@@ -53,12 +57,77 @@ STEMMED = (
     ('raw', 'R'),
     ('subject', 'S'), # or title
     ('description', 'S'),
+    ('text', 'XT'), # full text of documents
 )
 
+'''
+Unprefixed searches also look under these prefixes
+'''
+DEFAULT_PREFIXES = ('XT', )
+
+'''
+Only an excerpt of these is kept in the document data - the full value is
+indexed with positions but not stored.  Lengths are in characters.
+'''
+EXCERPTED = (
+    ('text', 200),
+)
+
+'''
+Documents on no branch keep the terms of their excerpted fields under this
+prefix, where searches don't see them, until they are back on a branch
+'''
+HELD_PREFIX = 'XR'
+
+'''
+Perceptual hashes, indexed whole and split into bands for similarity search
+(see librarian.similarity).  The hash is also kept in HASH_SLOT.
+'''
+HASHED = (
+    ('dhash', 'XH', 'XB'),
+)
+HASH_SLOT = 2
+
+'''
+Locations as "lat,lon", indexed as a geohash term at every precision
+(see librarian.geo) with the position kept in LAT_SLOT and LON_SLOT.
+'''
+GEO = (
+    ('location', 'XG'),
+)
+LAT_SLOT = 3
+LON_SLOT = 4
+
+'''
+When a document was dropped from every branch or had its content deleted,
+as an ISO 8601 UTC string, so old ones can be garbage collected.
+'''
+DROPPED_SLOT = 5
+
 
 PREFIXED_UNSTEMMED_BOOLEAN_TERMS = dict(PREFIXED_UNSTEMMED_BOOLEAN)
 PREFIXED_UNSTEMMED_TERMS = dict(PREFIXED_UNSTEMMED)
 STEMMED_TERMS = dict(STEMMED)
+EXCERPTED_FIELDS = dict(EXCERPTED)
+HASHED_FIELDS = dict( (f, (p, b)) for f, p, b in HASHED )
+GEO_FIELDS = dict(GEO)
+
+def prefix_names():
+    '''
+    Dict of prefix => field names for every prefix in the index, including
+    the stemmed forms (Z) and the unique key (QK)
+    '''
+    names = {'QK': ['key'], 'Z': ['stemmed']}
+    fields = (PREFIXED_UNSTEMMED_BOOLEAN + PREFIXED_UNSTEMMED + STEMMED + GEO +
+            tuple( (f, p) for f, p, _ in HASHED ) +
+            tuple( (f + ' bands', b) for f, _, b in HASHED ))
+
+    fields += tuple( (f + ' stemmed', 'Z' + p) for f, p in STEMMED )
+
+    for field, prefix in fields:
+        if field not in names.setdefault(prefix, []):
+            names[prefix].append(field)
+    return names
 
 '''
 Will also be indexed unprefixed and unstemmed: tag
@@ -1,10 +1,17 @@
+from __future__ import absolute_import, division, print_function
+
 import xapian
 import time
 import logging
 import json
 import os
 import itertools
+import re
+import shutil
+import heapq
+import multiprocessing
 from librarian.backends import terms
+from librarian import similarity, geo
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +21,24 @@ DB_VERSION = "{0}.{1}".format(terms.SCHEMA_VERSION, 1)
 
 STEMMING = xapian.QueryParser.STEM_SOME
 
+# queries the query parser can't handle - similar:<key>[~<distance>],
+# near:<lat>,<lon>,<km> and bbox:<south>,<west>,<north>,<east>
+SPECIAL_RE = re.compile(r'\b(similar|near|bbox):(\S+)(?=\s|$)')
+
+GEO_PREFIX = terms.GEO_FIELDS['location']
+
+class QueryError(ValueError):
+    '''
+    A search that can't be run as asked, the message says why
+    '''
+    pass
+
+# documents to write to a reindex partition between commits
+REINDEX_BATCH = 1000
+
+# what is kept of documents garbage collected without purging
+TOMBSTONE_SECTIONS = ('annex', 'meta', 'git')
+
 def encode_sortable_date(d):
     try:
         t = time.strptime(d, ISO_8601)
@@ -51,6 +76,81 @@ def first_of(d, *args):
             pass
     raise KeyError("No provided key in dict")
 
+def _reindex_partition(args):
+    '''
+    Rebuilds documents first to last (by docid) of the database at path into
+    a new database at target, keeping their docids.  Runs in a worker process.
+    '''
+    path, target, first, last = args
+
+    indexer = XapianIndexer(path)
+    source = xapian.Database(path)
+    out = xapian.WritableDatabase(target, xapian.DB_CREATE_OR_OVERWRITE)
+
+    # start at the partition rather than walking every document before it
+    postings = source.postlist('')
+    try:
+        postings = itertools.chain([postings.skip_to(first)], postings)
+    except StopIteration:
+        postings = []
+
+    count = 0
+    for p in postings:
+        if p.docid > last:
+            break
+
+        doc = source.get_document(p.docid)
+        key = doc.get_value(0).decode('utf-8')
+        data = json.loads(doc.get_data())
+        data.pop('_docid', None)
+
+        out.replace_document(p.docid, indexer.make_document(key, data, source))
+
+        count += 1
+        if count % REINDEX_BATCH == 0:
+            out.commit()
+
+    out.close()
+    return count
+
+class HashDecider(xapian.MatchDecider):
+    'Accepts documents with a perceptual hash within distance of h'
+
+    def __init__(self, h, distance):
+        xapian.MatchDecider.__init__(self)
+        self.h = h
+        self.distance = distance
+
+    def __call__(self, doc):
+        value = doc.get_value(terms.HASH_SLOT)
+        if not value:
+            return False
+        return similarity.hamming(self.h, int(value, 16)) <= self.distance
+
+class GeoDecider(xapian.MatchDecider):
+    'Accepts documents whose location passes check(lat, lon)'
+
+    def __init__(self, check):
+        xapian.MatchDecider.__init__(self)
+        self.check = check
+
+    def __call__(self, doc):
+        lat = doc.get_value(terms.LAT_SLOT)
+        lon = doc.get_value(terms.LON_SLOT)
+        if not lat or not lon:
+            return False
+        return self.check(xapian.sortable_unserialise(lat), xapian.sortable_unserialise(lon))
+
+class AllDecider(xapian.MatchDecider):
+    'Accepts documents accepted by all of the given deciders'
+
+    def __init__(self, deciders):
+        xapian.MatchDecider.__init__(self)
+        self.deciders = deciders
+
+    def __call__(self, doc):
+        return all(d(doc) for d in self.deciders)
+
 class XapianIndexer:
 
     _db = None
@@ -73,11 +173,15 @@ class XapianIndexer:
         for field, prefix in terms.PREFIXED_UNSTEMMED_BOOLEAN:
             self.query_parser.add_boolean_prefix(field, prefix)
 
+        self.query_parser.add_prefix('', '')
+        for prefix in terms.DEFAULT_PREFIXES:
+            self.query_parser.add_prefix('', prefix)
+
     def _check_version(self):
         current = self._db.get_metadata('db:version').decode('utf-8')
         logger.debug("Database version: %s", current)
         if current and current != DB_VERSION:
-            raise RuntimeError("Need to upgrade database to " + DB_VERSION)
+            raise RuntimeError("Need to upgrade database to {0}, run `git librarian reindex`".format(DB_VERSION))
 
     @property
     def db(self):
@@ -97,6 +201,13 @@ class XapianIndexer:
         self._check_version()
 
         
+    def reopen(self):
+        '''
+        Pick up changes committed by other writers
+        '''
+        if self._db is not None:
+            self._db.reopen()
+
     def unset_writable(self):
 
         if self._db is not None:
@@ -108,6 +219,256 @@ class XapianIndexer:
     def close(self):
         self.unset_writable()
 
+    def reindex(self, workers=None, tick=None):
+        '''
+        Rebuilds every document from the data stored in it, for when the
+        terms change, without having to replay the git history.  The index is
+        split into partitions rebuilt in parallel, which are merged into a new
+        database that is then swapped in.  Returns the number of documents.
+
+        Terms copied over from the old documents (the full text of excerpted
+        fields) are kept as they are.
+        '''
+        workers = workers or multiprocessing.cpu_count()
+        self.unset_writable()
+
+        # hold the write lock so nothing changes while we work
+        lock = xapian.WritableDatabase(self.path, xapian.DB_OPEN)
+        try:
+            source = xapian.Database(self.path)
+            lastdocid = source.get_lastdocid()
+
+            work = self.path + '.reindex'
+            if os.path.exists(work):
+                shutil.rmtree(work)
+            os.mkdir(work)
+
+            size = lastdocid // workers + 1
+            partitions = [ (self.path, os.path.join(work, str(i)), i * size + 1, (i + 1) * size)
+                    for i in range(workers) ]
+
+            pool = multiprocessing.Pool(workers)
+            try:
+                count = 0
+                for c in pool.imap_unordered(_reindex_partition, partitions):
+                    count += c
+                    if tick:
+                        tick(c)
+            finally:
+                pool.terminate()
+                pool.join()
+
+            merged = xapian.Database()
+            for _, target, _, _ in partitions:
+                merged.add_database(xapian.Database(target))
+
+            new = os.path.join(work, 'db')
+            merged.compact(new, xapian.DBCOMPACT_NO_RENUMBER)
+            merged.close()
+
+            db = xapian.WritableDatabase(new, xapian.DB_OPEN)
+            for name in source.metadata_keys():
+                db.set_metadata(name, source.get_metadata(name))
+            db.set_metadata('db:version', DB_VERSION)
+            db.close()
+            source.close()
+        finally:
+            lock.close()
+
+        self._swap_in(new)
+        shutil.rmtree(work)
+
+        logger.info("Reindexed %d documents", count)
+        return count
+
+    def compact(self):
+        '''
+        Rewrites the database without the free space left behind by updates
+        and deletes.  Returns the size in bytes before and after.
+        '''
+        self.unset_writable()
+        before = self.size()
+
+        new = self.path + '.compact'
+        if os.path.exists(new):
+            shutil.rmtree(new)
+
+        lock = xapian.WritableDatabase(self.path, xapian.DB_OPEN)
+        try:
+            source = xapian.Database(self.path)
+            source.compact(new)
+            source.close()
+        finally:
+            lock.close()
+
+        self._swap_in(new)
+        after = self.size()
+
+        logger.info("Compacted from %d to %d bytes", before, after)
+        return before, after
+
+    def _swap_in(self, new, path=None):
+        '''
+        Replaces the database (or the one at path) with the one at new.  The
+        database path is made a symlink to a directory beside it so the swap
+        is a single rename - readers see either the old database or the new
+        one.
+        '''
+        self._db = None
+        path = path or self.path
+
+        target = "{0}.{1:d}".format(path, int(time.time() * 1000))
+        os.rename(new, target)
+
+        link = path + '.link'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(target), link)
+
+        if os.path.islink(path):
+            old = os.path.realpath(path)
+        elif os.path.exists(path):
+            # still a plain directory so this one time it can't be atomic
+            old = path + '.old'
+            os.rename(path, old)
+        else:
+            old = None
+
+        os.rename(link, path)
+        if old is not None:
+            shutil.rmtree(old)
+
+    def size(self):
+        'Size of the database on disk in bytes'
+        return sum(self.tables().values())
+
+    def tables(self):
+        'Dict of table name => size on disk in bytes'
+        tables = {}
+        for f in os.listdir(self.path):
+            table = f.split('.')[0]
+            tables[table] = tables.get(table, 0) + os.path.getsize(os.path.join(self.path, f))
+        return tables
+
+    def stats(self, top=10):
+        '''
+        What the index is made of: document count and data sizes, the
+        largest documents, the size of each table on disk and the number of
+        terms and postings for each prefix in terms.py.
+        '''
+        db = self.db
+
+        tables = self.tables()
+
+        names = terms.prefix_names()
+        known = sorted(names, key=len, reverse=True)
+
+        prefixes = {}
+        for t in db.allterms():
+            term = t.term.decode('utf-8')
+            prefix = '?' if term[:1].isupper() else ''
+            for p in known:
+                if term.startswith(p):
+                    prefix = p
+                    break
+            count = prefixes.setdefault(prefix, {'prefix': prefix, 'fields': names.get(prefix, []),
+                    'terms': 0, 'postings': 0})
+            count['terms'] += 1
+            count['postings'] += t.termfreq
+
+        sizes = []
+        total = 0
+        for p in db.postlist(''):
+            doc = db.get_document(p.docid)
+            size = len(doc.get_data())
+            total += size
+            sizes.append((size, p.docid))
+
+        largest = []
+        for size, docid in heapq.nlargest(top, sizes):
+            doc = db.get_document(docid)
+            largest.append({
+                'key': doc.get_value(0).decode('utf-8'),
+                'docid': docid,
+                'data': size,
+                'terms': doc.termlist_count(),
+            })
+
+        doccount = db.get_doccount()
+        return {
+            'documents': doccount,
+            'last_docid': db.get_lastdocid(),
+            'size': sum(tables.values()),
+            'tables': tables,
+            'data_total': total,
+            'data_average': total / doccount if doccount else 0,
+            'average_length': db.get_avlength(),
+            'prefixes': sorted(prefixes.values(), key=lambda c: c['postings'], reverse=True),
+            'largest': largest,
+        }
+
+    def gc(self, before, purge=False):
+        '''
+        Collects documents that were dropped from every branch or had their
+        content deleted before `before` (ISO 8601 UTC) and are on no branch
+        now - deleted content that is still on a branch is still searched
+        for, so it keeps everything it has.  They are cut down to
+        tombstones that keep the key, annex and metadata sections (so the
+        metadata is still there if the file comes back) or with purge deleted
+        altogether.  Returns (collected, stamped), where stamped is the number
+        of documents from before dropped times were recorded which have just
+        been given one.
+        '''
+        gone = xapian.Query(xapian.Query.OP_OR, ['XSdropped', 'XSdeleted'])
+        stamped = xapian.Query(xapian.Query.OP_VALUE_GE, terms.DROPPED_SLOT, '')
+
+        collected = 0
+        expired = xapian.Query(xapian.Query.OP_FILTER, gone,
+                xapian.Query(xapian.Query.OP_VALUE_LE, terms.DROPPED_SLOT, before))
+        for docid, key, data in self._matching(xapian.Query(xapian.Query.OP_AND_NOT, expired, 'XSok')):
+            if purge:
+                self.delete(key)
+            elif not data.get('_tombstone'):
+                tombstone = dict( (s, data[s]) for s in TOMBSTONE_SECTIONS if s in data )
+                tombstone.update(_dropped=data['_dropped'], _tombstone=True)
+                self.put_data(key, tombstone)
+            else:
+                continue
+            collected += 1
+
+        unstamped = self._matching(xapian.Query(xapian.Query.OP_AND_NOT, gone, stamped))
+        for docid, key, data in unstamped:
+            self.put_data(key, data)
+
+        logger.info("Collected %d documents, stamped %d", collected, len(unstamped))
+        return collected, len(unstamped)
+
+    def _matching(self, query):
+        'List of (docid, key, data) for every document matching query'
+        enquire = xapian.Enquire(self.db)
+        enquire.set_query(query)
+        enquire.set_docid_order(xapian.Enquire.ASCENDING)
+        enquire.set_weighting_scheme(xapian.BoolWeight())
+
+        result = []
+        for m in enquire.get_mset(0, self.db.get_doccount()):
+            doc = m.document
+            data = json.loads(doc.get_data())
+            data.pop('_docid', None)
+            result.append((m.docid, doc.get_value(0).decode('utf-8'), data))
+        return result
+
+    def benchmark(self, querystring=None, runs=5):
+        'Best time in seconds of runs of a search (the default page by default)'
+        best = None
+        for i in range(runs):
+            start = time.time()
+            self.search(querystring, 0, 20)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
     def exists(self, key):
         term = "QK{0}".format(key)
 
@@ -115,6 +476,19 @@ class XapianIndexer:
         if c > 1: raise KeyError("Key is not unique!")
         return c == 1
 
+    def keys(self):
+        '''
+        Set of every key in the index, for checking a lot of keys at once
+        '''
+        return set( t.term[2:].decode('utf-8') for t in self.db.allterms('QK') )
+
+    def get_revision(self):
+        '''
+        Revision of the index, picking up any commits made since it was opened
+        '''
+        self.reopen()
+        return self.db.get_revision()
+
     def get_value(self, key):
         return self.db.get_metadata(key).decode('utf-8')
 
@@ -151,7 +525,29 @@ class XapianIndexer:
         self.put_data(key, data)
 
     def put_data(self, key, data):
+        doc = self.make_document(key, data)
+        self.db.replace_document("QK{0}".format(key), doc)
+
+    def update_branch(self, key, branch, path):
+        'Records the path of key on a branch, or that it has left it if path is None'
+        data = self.get_or_create_data(key)
+        branches = data.setdefault('git', {}).setdefault('branch', {})
 
+        if path is None:
+            del(branches[branch])
+        else:
+            branches[branch] = path
+        self.put_data(key, data)
+
+    def delete(self, key):
+        self.db.delete_document("QK{0}".format(key))
+
+    def make_document(self, key, data, source=None):
+        '''
+        Builds the document for key from its data.  Terms that only exist in
+        the index (see _index_excerpted) are copied from source, by default
+        the current database.
+        '''
         try:
             data['_date'] = first_of(data,
                     'meta.date',
@@ -170,6 +566,7 @@ class XapianIndexer:
 
         git = data.get('git', {})
 
+        excerpts = []
 
         if git.get('branch'):
 
@@ -199,12 +596,38 @@ class XapianIndexer:
 
                     prefix = None
 
+                    if field[0] == '_': continue
+
                     # handle arrays and straight values
                     if isinstance(values, (dict, )):
                         values = list(values)
                     if not isinstance(values, (list, tuple)):
                         values = [values]
 
+                    # handle perceptual hashes
+                    if field in terms.HASHED_FIELDS:
+                        prefix, band_prefix = terms.HASHED_FIELDS[field]
+                        for value in values:
+                            doc.add_term(prefix + value.lower(), 0)
+                            for t in similarity.band_terms(band_prefix, int(value, 16)):
+                                doc.add_term(t, 0)
+                            doc.add_value(terms.HASH_SLOT, value.lower())
+                        continue
+
+                    # handle locations
+                    if field in terms.GEO_FIELDS:
+                        try:
+                            lat, lon = geo.parse_location(values[0])
+                        except ValueError:
+                            logger.warning("Bad location for %s: %r", key, values)
+                            continue
+                        geohash = geo.encode(lat, lon)
+                        for i in range(1, len(geohash) + 1):
+                            doc.add_term(terms.GEO_FIELDS[field] + geohash[:i], 0)
+                        doc.add_value(terms.LAT_SLOT, xapian.sortable_serialise(lat))
+                        doc.add_value(terms.LON_SLOT, xapian.sortable_serialise(lon))
+                        continue
+
                     # handle prefixed unstemmed boolean terms
                     if field in terms.PREFIXED_UNSTEMMED_BOOLEAN_TERMS:
                         field = terms.PREFIXED_UNSTEMMED_BOOLEAN_TERMS[field]
@@ -228,6 +651,13 @@ class XapianIndexer:
                             doc.add_term(field + value.lower(), 0)
                         continue
 
+                    # handle full text that is only stored as an excerpt
+                    if field in terms.EXCERPTED_FIELDS:
+                        excerpt = self._index_excerpted(doc, key, data[section], field, values, source)
+                        if excerpt is not None:
+                            excerpts.append((section, field, excerpt))
+                        continue
+
                     # handle free terms
                     if field in terms.STEMMED_TERMS:
 
@@ -238,19 +668,91 @@ class XapianIndexer:
             doc.add_term('XSok')
         else:
             doc.add_term('XSdropped')
+
+            # full text that only exists as terms mustn't be lost on the way
+            # to another path, e.g. when a file is moved
+            for section, fields in data.items():
+                if section[0] == '_' or not isinstance(fields, dict):
+                    continue
+                for field in fields.get('_excerpt', ()):
+                    prefix = terms.STEMMED_TERMS[field]
+                    self._copy_terms(doc, key, (prefix, 'Z' + prefix), source, hold=True)
+
+        # remember when it went so it can be garbage collected later
+        if not git.get('branch') or (data.get('annex') or {}).get('state') == 'deleted':
+            data.setdefault('_dropped', time.strftime(ISO_8601, time.gmtime()))
+            doc.add_value(terms.DROPPED_SLOT, data['_dropped'])
+        else:
+            data.pop('_dropped', None)
+            data.pop('_tombstone', None)
+
+        for section, field, excerpt in excerpts:
+            data[section][field] = excerpt
+            cut = data[section].setdefault('_excerpt', [])
+            if field not in cut:
+                cut.append(field)
        
         doc.set_data(json.dumps(data))
         doc.add_value(0, key)
         doc.add_value(1, sortvalue)
 
-        idterm = "QK{0}".format(key)
-        doc.add_boolean_term(idterm)
+        doc.add_boolean_term("QK{0}".format(key))
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Data: %r", data)
             logger.debug("Terms: %r", [ x.term for x in doc.termlist() ])
 
-        self.db.replace_document(idterm, doc)
+        return doc
+
+    def _index_excerpted(self, doc, key, section, field, values, source=None):
+        '''
+        Indexes the full text for a field that only keeps an excerpt in the
+        document data.  Returns the excerpt if the text needs cutting down.
+
+        Once cut down the full text only exists as terms so they are carried
+        over from the current document until a new value arrives (the whole
+        section is replaced when that happens).  Documents dropped from every
+        branch hold on to them under HELD_PREFIX.
+        '''
+        prefix = terms.STEMMED_TERMS[field]
+
+        if field in section.get('_excerpt', ()):
+            self._copy_terms(doc, key, (prefix, 'Z' + prefix), source)
+            return None
+
+        text = u"\n".join(values)
+        self.term_generator.index_text(text, 1, prefix)
+        self.term_generator.increase_termpos()
+
+        limit = terms.EXCERPTED_FIELDS[field]
+        if len(text) > limit:
+            return text[:limit]
+        return None
+
+    def _copy_terms(self, doc, key, prefixes, source=None, hold=False):
+        '''
+        Copies terms with the given prefixes from the current document for
+        key, whether they are held there or not.  With hold they are copied
+        as held terms (see terms.HELD_PREFIX).
+        '''
+        prefixes = tuple( p.encode('utf-8') for p in prefixes )
+        held = terms.HELD_PREFIX.encode('utf-8')
+        source = source or self.db
+
+        for match in source.postlist("QK{0}".format(key)):
+            for t in source.get_document(match.docid).termlist():
+                term = t.term[len(held):] if t.term.startswith(held) else t.term
+                if not term.startswith(prefixes):
+                    continue
+                if hold:
+                    term = held + term
+
+                positions = list(t.positer)
+                if positions:
+                    for pos in positions:
+                        doc.add_posting(term, pos)
+                else:
+                    doc.add_term(term, t.wdf)
 
     def search(self, querystring, offset=0, pagesize=10, raw=False):
 
@@ -258,11 +760,37 @@ class XapianIndexer:
             querystring = "state:ok"
 
         logger.debug("QUERY: %s", querystring)
-        if raw:
+
+        specials = []
+        if not raw and not isinstance(querystring, xapian.Query):
+            specials = SPECIAL_RE.findall(querystring)
+            # on their own they filter the default search, not everything
+            querystring = SPECIAL_RE.sub('', querystring).strip() or "state:ok"
+
+        if isinstance(querystring, xapian.Query):
+            query = querystring
+        elif raw:
             query = xapian.Query(querystring)
+        elif querystring:
+            try:
+                query = self.query_parser.parse_query(querystring,
+                            xapian.QueryParser.FLAG_PURE_NOT | xapian.QueryParser.FLAG_WILDCARD | xapian.QueryParser.FLAG_BOOLEAN | xapian.QueryParser.FLAG_LOVEHATE)
+            except xapian.QueryParserError as e:
+                raise QueryError("Invalid query {0}: {1}".format(querystring, e))
         else:
-            query = self.query_parser.parse_query(querystring,
-                        xapian.QueryParser.FLAG_PURE_NOT | xapian.QueryParser.FLAG_WILDCARD | xapian.QueryParser.FLAG_BOOLEAN | xapian.QueryParser.FLAG_LOVEHATE)
+            query = xapian.Query.MatchAll
+
+        deciders = []
+        for name, arg in specials:
+            probe, decider = self.special_query(name, arg)
+            query = xapian.Query(xapian.Query.OP_FILTER, query, probe)
+            deciders.append(decider)
+
+        decider = None
+        if len(deciders) == 1:
+            decider = deciders[0]
+        elif deciders:
+            decider = AllDecider(deciders)
 
         # allow for re-open
         retries = 2
@@ -275,25 +803,16 @@ class XapianIndexer:
             enquire.set_query(query)
 
             try:
-                mset = enquire.get_mset(offset, pagesize)
+                mset = enquire.get_mset(offset, pagesize, 0, None, decider)
                 break
             except xapian.DatabaseModifiedError:
                 logger.debug("Database error - retrying")
                 self._db = None
 
-        matches = []
-        for match in mset:
-            doc = match.document
-            matches.append({
-                'rank': match.rank + 1,
-                'key': doc.get_value(0).decode('utf-8'),
-                'date': decode_sortable_date(doc.get_value(1)),
-            })
-
         result = {
-            'matches': matches,
-            'start': offset+1 if len(matches) else 0,
-            'end': offset + len(matches),
+            'matches': [ self._match(match) for match in mset ],
+            'start': offset+1 if len(mset) else 0,
+            'end': offset + len(mset),
             'total': mset.get_matches_estimated(),
         }
 
@@ -301,6 +820,132 @@ class XapianIndexer:
         # Finally, make sure we log the query and displayed results
         return result
 
+    def _match(self, match):
+        'Search result for a match'
+        doc = match.document
+        annex = json.loads(doc.get_data()).get('annex') or {}
+        return {
+            'rank': match.rank + 1,
+            'key': doc.get_value(0).decode('utf-8'),
+            'date': decode_sortable_date(doc.get_value(1)),
+            'local': 'here' in annex.get('present', []),
+        }
+
+    def special_query(self, name, arg):
+        '''
+        Query and match decider for one of the special queries, raises
+        QueryError for malformed arguments or keys that can't be looked up
+        '''
+        try:
+            if name == 'similar':
+                key, _, distance = arg.rpartition('~')
+                if not key or not distance.isdigit():
+                    return self.similar_query(arg)
+                return self.similar_query(key, int(distance))
+
+            values = [ float(x) for x in arg.split(',') ]
+            if name == 'near':
+                return self.near_query(*values)
+            if name == 'bbox':
+                return self.bbox_query(*values)
+        except (TypeError, ValueError, KeyError) as e:
+            raise QueryError("Invalid query {0}:{1} ({2})".format(name, arg, e))
+
+        raise QueryError("Invalid query {0}:{1}".format(name, arg))
+
+    def near_query(self, lat, lon, km):
+        '''
+        Query and match decider for documents within km of a point
+        '''
+        cells = geo.cover(*geo.circle_box(lat, lon, km))
+        probe = xapian.Query(xapian.Query.OP_OR, [ GEO_PREFIX + c for c in cells ])
+        return probe, GeoDecider(lambda a, b: geo.distance(lat, lon, a, b) <= km)
+
+    def bbox_query(self, south, west, north, east):
+        '''
+        Query and match decider for documents in a bounding box
+        '''
+        cells = geo.cover(south, west, north, east)
+        probe = xapian.Query(xapian.Query.OP_OR, [ GEO_PREFIX + c for c in cells ])
+        return probe, GeoDecider(lambda a, b: geo.in_box(a, b, south, west, north, east))
+
+    def geo_clusters(self, south, west, north, east, precision=None):
+        '''
+        Count of documents in each geohash cell covering a bounding box,
+        taken straight from the term frequencies.  Returns a list of
+        dicts with the cell, its centre and bounds and the count.
+        '''
+        if precision is not None:
+            precision = max(1, min(precision, geo.PRECISION))
+            if geo.count_cells(south, west, north, east, precision) > geo.MAX_CLUSTER_CELLS:
+                raise ValueError("Too many cells at precision {0}".format(precision))
+
+        result = []
+        for cell in geo.cover(south, west, north, east, precision):
+            count = self.db.get_termfreq(GEO_PREFIX + cell)
+            if not count:
+                continue
+            lat, lon = geo.centre(cell)
+            result.append({
+                'geohash': cell,
+                'count': count,
+                'lat': lat,
+                'lon': lon,
+                'bounds': geo.bounds(cell),
+            })
+        return result
+
+    def similar_query(self, key, distance=similarity.DISTANCE):
+        '''
+        Query and match decider for documents with a perceptual hash within
+        distance bits of the one for key.  The query only looks up the
+        bands that could match, the decider checks the actual distance.
+        '''
+        doc = self.db.get_document(self.get_data(key)['_docid'])
+        value = doc.get_value(terms.HASH_SLOT).decode('utf-8')
+        if not value:
+            raise KeyError("No hash for {0}".format(key))
+        h = int(value, 16)
+
+        _, band_prefix = terms.HASHED_FIELDS['dhash']
+        probe = xapian.Query(xapian.Query.OP_OR,
+                similarity.probe_terms(band_prefix, h, distance))
+
+        return probe, HashDecider(h, distance)
+
+    def hashes(self):
+        '''
+        Dict of key => perceptual hash for every hashed document
+        '''
+        result = {}
+        prefix, _ = terms.HASHED_FIELDS['dhash']
+        for t in self.db.allterms(prefix):
+            h = int(t.term[len(prefix):], 16)
+            for p in self.db.postlist(t.term):
+                key = self.db.get_document(p.docid).get_value(0).decode('utf-8')
+                result[key] = h
+        return result
+
+    def stale_query(self, inspectors):
+        '''
+        Query for documents that an inspector applies to (by extension)
+        but that haven't been inspected by its current version.
+        inspectors is a list of (name, version, extensions) tuples.
+        '''
+        stale = []
+        for name, version, extensions in inspectors:
+            if '.*' in extensions:
+                applies = xapian.Query.MatchAll
+            else:
+                applies = xapian.Query(xapian.Query.OP_OR,
+                        [ 'E' + ext.lstrip('.').lower() for ext in extensions ])
+
+            current = xapian.Query('XI{0}-{1}'.format(name, version).lower())
+            stale.append(xapian.Query(xapian.Query.OP_AND_NOT, applies, current))
+
+        return xapian.Query(xapian.Query.OP_FILTER,
+                xapian.Query(xapian.Query.OP_OR, stale), xapian.Query('XSok'))
+
     def alldocs(self, offset=0, pagesize=10):
 
         return self.search(None, offset, pagesize)
@@ -0,0 +1,171 @@
+'''
+Several annex repositories served as one
+
+Each repository keeps its own Librarian and index, searches go through a
+FederatedIndexer over all of them, and anything addressed by key is
+handed to the repository that holds it.  The repositories share one
+thumbnail pool, one fetch pool and one cache directory - keys are content
+hashes, so a thumbnail rendered for one repository is good for all of them.
+'''
+from __future__ import absolute_import, division, print_function
+
+import os.path
+import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from librarian.backends.federated import FederatedIndexer
+
+logger = logging.getLogger(__name__)
+
+def repo_name(path):
+    'Name a repository is known by, the name of its directory'
+    return os.path.basename(os.path.abspath(path).rstrip(os.sep))
+
+class Federation:
+    '''
+    The parts of the Librarian interface the api uses, over a list of
+    librarians.  The first librarian's config and cache directory are used
+    for all of them.
+
+    Without share the librarians keep their own pools and caches, which is
+    all a federation that only writes (see FederatedWorker) needs.
+    '''
+
+    # commands that don't name keys have no repository to run in
+    annex = None
+
+    _fetch_pool = None
+
+    def __init__(self, librarians, share=True):
+        self.librarians = OrderedDict()
+        for l in librarians:
+            name = repo_name(l.base_path)
+            if name in self.librarians:
+                raise ValueError("Two repositories called {0}".format(name))
+            self.librarians[name] = l
+
+        self._first = first = librarians[0]
+        self.config = first.config
+        self.cache_dir = first.cache_dir
+
+        self._pool = first._pool
+        if share:
+            self._fetch_pool = ThreadPool(self.config['FETCH_CONCURRENCY'])
+            for l in librarians:
+                l.cache_dir = self.cache_dir
+                if l._pool is not self._pool:
+                    l._pool.kill()
+                l._pool = self._pool
+                l._fetch_pool = self._fetch_pool
+
+        self.db = FederatedIndexer([ (name, l.db) for name, l in self.librarians.items() ])
+
+    def repo_for(self, key):
+        '''
+        Name of the repository holding a key - the first that has its
+        content here, otherwise the first that knows about it.  Everything
+        about a key (data, metadata changes, content) comes from there.
+        '''
+        for name, l in self.librarians.items():
+            if l.annex.is_local(key):
+                return name
+        for name, l in self.librarians.items():
+            if l.db.exists(key):
+                return name
+        raise KeyError("Key not found: {0}".format(key))
+
+    def librarian_for(self, key):
+        return self.librarians[self.repo_for(key)]
+
+    def annex_for(self, key):
+        return self.librarian_for(key).annex
+
+    def sync(self):
+        return dict( (name, l.sync()) for name, l in self.librarians.items() )
+
+    def get_head(self, branch):
+        return dict( (name, l.get_head(branch)) for name, l in self.librarians.items() )
+
+    def update_metadata(self, keys, add=None, remove=None, set_fields=None):
+        'Librarian.update_metadata in each repository for the keys it holds'
+        by_repo = OrderedDict()
+        for key in keys:
+            by_repo.setdefault(self.librarian_for(key), []).append(key)
+
+        return sum( l.update_metadata(repo_keys, add, remove, set_fields)
+                for l, repo_keys in by_repo.items() )
+
+    def _route(self, result):
+        'Says which repository each match is from'
+        for match in result['matches']:
+            match['repo'] = self.repo_for(match['key'])
+            match['local'] = self.librarians[match['repo']].annex.is_local(match['key'])
+        return result
+
+    def search(self, terms, offset=0, pagesize=20):
+        return self._route(self.db.search(terms, offset, pagesize))
+
+    def alldocs(self, offset=0, pagesize=20):
+        return self._route(self.db.alldocs(offset, pagesize))
+
+    def get_data(self, key):
+        name = self.repo_for(key)
+        data = self.librarians[name].get_data(key)
+        data['_repo'] = name
+        return data
+
+    def revision(self):
+        return self.db.get_revision()
+
+    def has_thumb(self, key):
+        # the cache is shared so any librarian can tell
+        return self._first.has_thumb(key)
+
+    def thumb_for_key(self, key, wait=True):
+        return self.librarian_for(key).thumb_for_key(key, wait)
+
+    def preview_for_key(self, key, wait=True):
+        return self.librarian_for(key).preview_for_key(key, wait)
+
+    def thumbs_for_keys(self, keys):
+        'See Librarian.thumbs_for_keys'
+        # xapian databases aren't thread safe, so the indexes are asked who
+        # holds each key here and the pool only renders
+        jobs = []
+        for key in keys:
+            try:
+                jobs.append((key, self.librarian_for(key)))
+            except KeyError:
+                jobs.append((key, None))
+        return zip(keys, self._pool.imap(self._safe_thumb, jobs))
+
+    def _safe_thumb(self, job):
+        key, librarian = job
+        if librarian is None:
+            return None
+        try:
+            return librarian.thumb_for_key(key, False)
+        except Exception:
+            logger.exception("Failed to render thumbnail: %s", key)
+            return None
+
+    def file_for_key(self, key, wait=True):
+        return self.librarian_for(key).file_for_key(key, wait)
+
+    def fetching(self, key):
+        return any( l.fetching(key) for l in self.librarians.values() )
+
+    def fetch_status(self, key):
+        return self.librarian_for(key).fetch_status(key)
+
+    def prefetch(self, key):
+        return self.librarian_for(key).prefetch(key)
+
+    def close(self):
+        for l in self.librarians.values():
+            l.close()
+        self._fetch_pool = None
+
+    def __repr__(self):
+        return "<Annex Federation: {0}>".format(", ".join(self.librarians))
@@ -0,0 +1,167 @@
+'''
+Geohash helpers for spatial search
+
+A geohash names a cell on the map and every prefix of it names the cell that
+contains it, so indexing each prefix as a term lets a bounding box be turned
+into an OR of a handful of cell terms.  Anything in those cells that is just
+outside the box is weeded out by checking the actual position.
+'''
+from __future__ import absolute_import, division, print_function
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# 8 characters is a cell around 38m x 19m
+PRECISION = 8
+
+# most cells to OR together for a query
+MAX_CELLS = 64
+
+# most cells to count for a map
+MAX_CLUSTER_CELLS = 1024
+
+EARTH_RADIUS = 6371.0
+
+def encode(lat, lon, precision=PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+
+    chars = []
+    ch = bit = 0
+    even = True
+
+    while len(chars) < precision:
+        r, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (r[0] + r[1]) / 2
+        if value >= mid:
+            ch = (ch << 1) | 1
+            r[0] = mid
+        else:
+            ch = ch << 1
+            r[1] = mid
+        even = not even
+
+        bit += 1
+        if bit == 5:
+            chars.append(BASE32[ch])
+            ch = bit = 0
+
+    return ''.join(chars)
+
+def bounds(geohash):
+    '(south, west, north, east) of a cell'
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for c in geohash:
+        n = BASE32.index(c)
+        for mask in (16, 8, 4, 2, 1):
+            r = lon_range if even else lat_range
+            mid = (r[0] + r[1]) / 2
+            if n & mask:
+                r[0] = mid
+            else:
+                r[1] = mid
+            even = not even
+
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+def centre(geohash):
+    south, west, north, east = bounds(geohash)
+    return (south + north) / 2, (west + east) / 2
+
+def cell_size(precision):
+    '(height, width) of a cell in degrees'
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+def _span(low, high, origin, size, limit):
+    first = int(math.floor((low - origin) / size))
+    last = int(math.floor((high - origin) / size))
+    return max(first, 0), min(last, limit - 1)
+
+def _cells(south, west, north, east, precision):
+    h, w = cell_size(precision)
+    i0, i1 = _span(south, north, -90.0, h, int(round(180.0 / h)))
+    j0, j1 = _span(west, east, -180.0, w, int(round(360.0 / w)))
+
+    return [ encode(-90.0 + (i + 0.5) * h, -180.0 + (j + 0.5) * w, precision)
+            for i in range(i0, i1 + 1) for j in range(j0, j1 + 1) ]
+
+def _boxes(south, west, north, east):
+    # split boxes that cross the antimeridian
+    if west > east:
+        return [(south, west, north, 180.0), (south, -180.0, north, east)]
+    return [(south, west, north, east)]
+
+def count_cells(south, west, north, east, precision):
+    h, w = cell_size(precision)
+    total = 0
+    for s, w_, n, e in _boxes(south, west, north, east):
+        i0, i1 = _span(s, n, -90.0, h, int(round(180.0 / h)))
+        j0, j1 = _span(w_, e, -180.0, w, int(round(360.0 / w)))
+        total += (i1 - i0 + 1) * (j1 - j0 + 1)
+    return total
+
+def precision_for(south, west, north, east, max_cells=MAX_CELLS):
+    'Finest precision that covers the box with no more than max_cells cells'
+    for precision in range(PRECISION, 1, -1):
+        if count_cells(south, west, north, east, precision) <= max_cells:
+            return precision
+    return 1
+
+def cover(south, west, north, east, precision=None, max_cells=MAX_CELLS):
+    '''
+    Geohash cells covering a bounding box.  Without a precision the finest
+    one that needs no more than max_cells is used.
+    '''
+    if precision is None:
+        precision = precision_for(south, west, north, east, max_cells)
+
+    cells = []
+    for box in _boxes(south, west, north, east):
+        cells.extend(_cells(*(box + (precision, ))))
+    return cells
+
+def in_box(lat, lon, south, west, north, east):
+    if not south <= lat <= north:
+        return False
+    if west > east:
+        return lon >= west or lon <= east
+    return west <= lon <= east
+
+def distance(lat1, lon1, lat2, lon2):
+    'Great circle distance in km'
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+            math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def circle_box(lat, lon, km):
+    '(south, west, north, east) box containing a circle'
+    dlat = math.degrees(km / EARTH_RADIUS)
+    south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+
+    if south == -90.0 or north == 90.0:
+        return south, -180.0, north, 180.0
+
+    dlon = math.degrees(km / (EARTH_RADIUS * math.cos(math.radians(max(abs(south), abs(north))))))
+    if dlon >= 180.0:
+        return south, -180.0, north, 180.0
+
+    west, east = lon - dlon, lon + dlon
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return south, west, north, east
+
+def parse_location(value):
+    '"lat,lon" as a pair of floats'
+    lat, lon = [ float(x) for x in value.split(',') ]
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError("Location out of range: {0}".format(value))
+    return lat, lon
@@ -0,0 +1,122 @@
+'''
+Cooperative Annex for the gevent server
+
+A plain Annex blocks the whole server while git runs, so one slow
+`annex get` from a remote holds up every other request.
+'''
+from __future__ import absolute_import, division, print_function
+
+import threading
+import logging
+
+import gevent
+from gevent import subprocess as gsubprocess
+from gevent.lock import BoundedSemaphore
+from gevent.threadpool import ThreadPool
+
+from librarian.annex import Annex, AnnexError, noop
+
+logger = logging.getLogger(__name__)
+
+# commands that talk to remotes and can take as long as they like
+FETCH_COMMANDS = (
+    ('annex', 'get'),
+    ('annex', 'copy'),
+    ('annex', 'sync'),
+)
+
+class GreenAnnex(Annex):
+    '''
+    Annex that runs git under gevent so waiting on git only blocks the
+    calling greenlet.
+
+    At most concurrency git commands run at once.  Commands that fetch from
+    remotes have their own smaller limit and a timeout so a slow remote
+    can't take every slot.  Killing the greenlet (or the timeout) kills the
+    git process too.
+
+    The limits also apply to calls from other threads (e.g. the thumbnail
+    and background fetch workers), which run git as normal and have it
+    killed when a fetch times out.
+    '''
+
+    def __init__(self, path, concurrency=8, fetches=2, fetch_timeout=None):
+        Annex.__init__(self, path)
+        self._hub_thread = threading.current_thread()
+        self._limit = BoundedSemaphore(concurrency)
+        self._fetch_limit = BoundedSemaphore(fetches)
+        self.fetch_timeout = fetch_timeout
+
+        # pooled batch processes are shared with other threads so the
+        # server talks to them from threads of its own
+        self._threads = ThreadPool(concurrency)
+        self._local = threading.local()
+
+    def _green(self):
+        return threading.current_thread() is self._hub_thread
+
+    def _popen(self, cmd, **kwargs):
+        if self._green():
+            return gsubprocess.Popen(cmd, **kwargs)
+
+        p = Annex._popen(self, cmd, **kwargs)
+        started = getattr(self._local, 'started', None)
+        if started is not None:
+            started.append(p)
+        return p
+
+    def _fetching(self, call, what):
+        '''
+        call() for a command that fetches from remotes, under the fetch limit
+        and timeout
+        '''
+        error = AnnexError(u"Timed out running " + what)
+
+        if self._green():
+            with self._fetch_limit, gevent.Timeout(self.fetch_timeout, error):
+                return call()
+
+        # a native thread can't be interrupted, so kill what it runs instead
+        with self._fetch_limit:
+            self._local.started = started = []
+            expired = threading.Event()
+            timer = None
+            if self.fetch_timeout:
+                timer = threading.Timer(self.fetch_timeout, self._expire, (started, expired))
+                timer.start()
+            try:
+                return call()
+            except Exception:
+                if expired.is_set():
+                    raise error
+                raise
+            finally:
+                self._local.started = None
+                if timer is not None:
+                    timer.cancel()
+
+    def _expire(self, started, expired):
+        expired.set()
+        for p in started:
+            if p.poll() is None:
+                p.kill()
+
+    def git_raw(self, *args, **kwargs):
+        if tuple(args[:2]) in FETCH_COMMANDS:
+            return self._fetching(lambda: Annex.git_raw(self, *args, **kwargs), " ".join(args))
+
+        with self._limit:
+            return Annex.git_raw(self, *args, **kwargs)
+
+    def get_key(self, key, progress=noop):
+        return self._fetching(lambda: Annex.get_key(self, key, progress), u"annex get --key " + key)
+
+    def _execute(self, batch, line):
+        with self._limit:
+            if self._green():
+                return self._threads.apply(Annex._execute, (self, batch, line))
+            return Annex._execute(self, batch, line)
+
+    def close(self):
+        Annex.close(self)
+        self._threads.kill()
@@ -0,0 +1,74 @@
+'''
+Cache of annex keys for files outside the annex
+
+Working out the key for a file means hashing all of it, which is slow for a
+big import folder that gets checked again and again.  Keys are remembered
+against the file's (device, inode, size, mtime) so a file that hasn't
+changed only needs a stat.
+'''
+from __future__ import absolute_import, division, print_function
+
+import os
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+# commit every so often so an interrupted run keeps most of its work
+COMMIT_EVERY = 1000
+
+def stat_key(filename):
+    '(device, inode, size, mtime in ns) for a file'
+    st = os.stat(filename)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+class HashCache:
+    '''
+    sqlite backed map of stat_key => annex key
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, key TEXT,
+            PRIMARY KEY (dev, ino))''')
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, stat):
+        'Key for a stat_key, or None if the file is new or has changed'
+        dev, ino, size, mtime_ns = stat
+        row = self.conn.execute('SELECT size, mtime_ns, key FROM hashes WHERE dev = ? AND ino = ?',
+                (dev, ino)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return row[2]
+
+    def put(self, stat, key):
+        '''
+        Remember the key for a file.  stat should be taken before hashing so
+        a file that changes while it is being hashed is hashed again next time.
+        '''
+        self.conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', tuple(stat) + (key, ))
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
@@ -3,15 +3,51 @@ from __future__ import absolute_import, division, print_function
 import os.path
 import logging
 import time
-import json
-import sys
-import subprocess
-import codecs
 import importlib
+import threading
 from librarian.progress import getProgress
+from librarian.keys import parse_key
+from librarian.annex import InfoWriter
+from librarian.inspectors.sandbox import Sandbox, TIMEOUT, MEMORY
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 logger = logging.getLogger(__name__)
 
+# how many fetched files can be waiting for inspection
+PREFETCH = 10
+
+def prefetch(source, size=PREFETCH):
+    '''
+    Runs a generator on a background thread, buffering up to size items
+    so the consumer can work while the generator waits on remotes
+    '''
+    q = Queue(maxsize=size)
+    end = object()
+
+    def produce():
+        try:
+            for item in source:
+                q.put((item, None))
+        except Exception as e:
+            q.put((None, e))
+        q.put((end, None))
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+
+    while True:
+        item, e = q.get()
+        if e is not None:
+            raise e
+        if item is end:
+            break
+        yield item
+
 
 class Inspector(object):
     '''Collection of inspection methods
@@ -22,6 +58,7 @@ class Inspector(object):
     def __init__(self, *enable):
         self._inspectors = {}
         self._extensions = []
+        self._options = {}
 
         for e in enable:
             #getattr(self, 'enable_%s' % e)()
@@ -56,76 +93,175 @@ class Inspector(object):
             ext = ext.lower()
             self._extensions.append((ext, name))
 
-    def inspect_file(self, filename):
+    def set_options(self, name, **options):
+        '''
+        Keyword arguments to call an inspector with, e.g. the poppler
+        inspector's budget.  They go to the worker processes with the rest
+        of the inspector.
+        '''
+        self._options.setdefault(name, {}).update(options)
+
+    def versions(self):
+        '''
+        List of (name, version, extensions) for the enabled inspectors
+        '''
+        result = []
+        for name, m in sorted(self._inspectors.items()):
+            extensions = [ ext for ext, i in self._extensions if i == name ]
+            result.append((name, getattr(m, 'version', '0.0.1'), extensions))
+        return result
 
+    def applicable(self, filename):
+        '''
+        Names of the inspectors that will be run for a file
+        '''
         f = filename.lower()
+        return [ i for ext, i in self._extensions if ext == ".*" or f.endswith(ext) ]
 
-        data = {'librarian': {'inspector': []}}
+    def needs_content(self, filename):
+        '''
+        Whether any of the applicable inspectors need to read the file,
+        some can work from the key alone
+        '''
+        return any(getattr(self._inspectors[i], 'needs_content', True) for i in self.applicable(filename))
 
-        for ext, inspector in self._extensions:
-            if ext == ".*" or f.endswith(ext):
-                logger.debug("Running %s inspector...", inspector)
+    def estimate(self, annex, keys):
+        '''
+        Estimate the cost of inspecting a list of keys without doing it
+        '''
+        result = {'total': len(keys), 'content': 0, 'fetch': 0, 'bytes': 0}
+
+        for key in keys:
+            if not self.needs_content(key):
+                continue
+            result['content'] += 1
+
+            if not os.path.exists(annex.content_for_key(key)):
+                result['fetch'] += 1
                 try:
-                    m = self._inspectors[inspector]
-                    data[inspector] = m(filename) or {}
-                    data['librarian']['inspector'].append("{0}-{1}".format(inspector, getattr(m, 'version', '0.0.1')))
-                except:
-                    data[inspector] = {}
-                    logger.exception("Inspection failed")
+                    result['bytes'] += parse_key(key).get('size', 0)
+                except ValueError:
+                    pass
+
+        return result
+
+    def _version(self, inspector):
+        return "{0}-{1}".format(inspector, getattr(self._inspectors[inspector], 'version', '0.0.1'))
+
+    def inspect_file(self, filename):
+
+        data = {'librarian': {'inspector': []}}
+
+        for inspector in self.applicable(filename):
+            logger.debug("Running %s inspector...", inspector)
+            version = self._version(inspector)
+            data['librarian']['inspector'].append(version)
+            try:
+                data[inspector] = self._inspectors[inspector](filename, **self._options.get(inspector, {})) or {}
+            except Exception as e:
+                # still record the version so it isn't retried every run
+                data[inspector] = {}
+                data['librarian'].setdefault('failed', []).append(version)
+                data['librarian'].setdefault('error', []).append("{0}: {1}".format(inspector, str(e) or e.__class__.__name__))
+                logger.exception("Inspection failed")
 
         return data
 
-    def inspect_items(self, annex, items, keys=False):
+    def failed(self, filename, reason):
+        '''
+        Data recording every applicable inspector as failed
+        '''
+        versions = [ self._version(i) for i in self.applicable(filename) ]
+        return {'librarian': {
+            'inspector': versions,
+            'failed': versions,
+            'error': [ "{0}: {1}".format(i, reason) for i in self.applicable(filename) ],
+        }}
+
+    def inspect_files(self, filenames, workers=1, timeout=TIMEOUT, memory=MEMORY):
+        '''Inspects a list of files, yielding (filename, data) tuples
+
+        Files are fanned out over sandboxed worker processes that are killed
+        if they take longer than timeout seconds or use more than memory
+        bytes, and results are yielded in the order they complete.  With no
+        workers everything runs in this process without any limits.
+        '''
+        if workers < 1:
+            for f in filenames:
+                yield f, self.inspect_file(f)
+            return
+
+        sandbox = Sandbox(self, workers, timeout, memory)
+        for result in sandbox.imap_unordered(filenames):
+            yield result
+
+    def inspect_items(self, annex, items, keys=False, workers=1, drop=False,
+            timeout=TIMEOUT, memory=MEMORY, batch=0, interval=0, on_commit=None):
         '''Runs inspector on annexed files (or keys) and updates the .info files
-            
+
+        Content is fetched on a background thread and each file is inspected
+        as soon as it arrives.  With drop, content that had to be fetched is
+        dropped again once it has been inspected.
+
+        Everything goes through a single fast-import session which commits
+        every batch items or interval seconds (or just once at the end) and
+        on_commit is called with (commit, parent, [(key, data), ...]) for each
+        commit so it can be indexed without a full sync.
         '''
         c = 0
+        commits = 0
 
         pbar = getProgress()
 
-        head = annex.git_line('rev-list', '--max-count=1', 'git-annex')
-        user = annex.git_line('config', 'user.name')
-        email = annex.git_line('config', 'user.email')
-        message = "Inspecting files."
+        # only fetch content if an inspector is actually going to read it
+        needed = [ i for i in items if self.needs_content(i) ]
+        keyonly = [ i for i in items if not self.needs_content(i) ]
 
-        logger.debug("HEAD: %s", head)
+        if keys:
+            source = annex.iter_resolve_keys(needed)
+            location = annex.content_for_key
+        else:
+            source = annex.iter_resolve_links(needed)
+            location = annex.content_for_link
 
-        cmd = annex.git_cmd(('fast-import', '--date-format=now', '--quiet'))
-        p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-        #s = io.TextIOWrapper(p.stdin, "utf-8")
-        s = codecs.getwriter('utf-8')(p.stdin)
+        fetched = set()
 
-        s.write("commit refs/heads/git-annex\n")
-        s.write("committer {0} <{1}> now\n".format(user, email))
-        s.write("data {0}\n{1}\n".format(len(message), message))
-        s.write("from {0}\n".format(head))
+        def resolved():
+            for i in keyonly:
+                yield location(i)
 
-        pbar.init(len(items), "Resolving files...")
-        if keys:
-            items = annex.resolve_keys(items, pbar.tick)
-        else:
-            items = annex.resolve_links(items, pbar.tick)
+            for i, f, was_fetched in prefetch(source):
+                if was_fetched:
+                    fetched.add(f)
+                yield f
 
         pbar.init(len(items), 'Inspecting...')
 
-        for i, f in items:
-            key = annex.key_for_link(f);
-            doc = self.inspect_file(f)
-            annex_location = annex.git_line('annex', 'examinekey', '--format', '${hashdirlower}${key}.info', key)
-            logger.debug("Writing to %s", annex_location)
+        with InfoWriter(annex) as writer:
+
+            def checkpoint(final=False):
+                result = writer.checkpoint(final)
+                if result is not None and on_commit is not None:
+                    on_commit(*result)
+                return result is not None
+
+            last = time.time()
+
+            for f, doc in self.inspect_files(resolved(), workers, timeout, memory):
+                key = annex.key_for_link(f);
+                writer.write(key, doc)
 
-            s.write("M 100644 inline {0}\n".format(annex_location))
-            s.write("data <<EOT\n")
-            json.dump(doc, s)
-            s.write("\nEOT\n")
+                if drop and f in fetched:
+                    annex.drop_key(key)
 
-            c += 1
-            pbar.tick()
+                c += 1
+                pbar.tick()
 
-        s.close()
-        p.wait()
+                if (batch and len(writer.pending) >= batch) or (interval and time.time() - last >= interval):
+                    commits += checkpoint()
+                    last = time.time()
 
-        if p.returncode != 0:
-            raise subprocess.CalledProcessError(p.returncode, cmd, "fast-import failed")
+            # raises if anything couldn't be written
+            commits += checkpoint(True)
 
-        return {'total': len(items), 'inspected': c}
+        return {'total': len(items), 'inspected': c, 'commits': commits}
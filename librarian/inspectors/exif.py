@@ -1,23 +1,26 @@
-import exifread
 import logging
-from fractions import Fraction
+from librarian.inspectors.image import read_image_meta, exif_date_to_iso
 
 logger = logging.getLogger(__name__)
 
-def date_to_iso(d):
-    return d[:10].replace(':', '-') + "T" + d[11:]
+def exif_inspector(filename):
+    'Date and device from the EXIF headers only'
 
-def exif_inspector(filename, meta):
-    with open(filename, 'rb') as f:
-        tags = exifread.process_file(f, details=False)
+    meta = read_image_meta(filename)
+    info = {}
 
-    try:
-        created = date_to_iso(str(tags['EXIF DateTimeOriginal']))
-        meta['date'] = [created]
-    except:
+    if meta.get('created'):
+        info['date'] = [exif_date_to_iso(meta['created'])]
+    else:
         logger.debug("Failed to parse create time")
 
-    try:
-        meta['device'] = [str(tags['Image Make']), str(tags['Image Model'])]
-    except KeyError:
+    device = [ meta[k] for k in ('make', 'model') if meta.get(k) ]
+    if device:
+        info['device'] = device
+    else:
         logger.debug("Failed to read device info")
+
+    return info
+
+exif_inspector.extensions = ['.jpg', '.jpeg', '.tiff', '.tif']
+exif_inspector.version = '1.0.0'
@@ -1,12 +1,18 @@
 import os
 import mimetypes
+from librarian.keys import parse_key
 
 def file_inspector(filename):
     'Reports posix filesystem attributes for a file'
 
     _, ext = os.path.splitext(filename)
 
-    s = os.stat(filename)
+    # content is named after the key so we can usually avoid reading it
+    try:
+        size = parse_key(os.path.basename(filename))['size']
+    except (ValueError, KeyError):
+        size = os.stat(filename).st_size
+
     content_type, encoding = mimetypes.guess_type(filename)
 
     # ignoreing ctime as rarely relevant
@@ -14,7 +20,8 @@ def file_inspector(filename):
         #'created': [time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(s.st_ctime))],
         'extension': [ext[1:].lower()],
         'mimetype': content_type.split('/'),
-        'size': ["{0:d}kB".format(int(s.st_size/1000))]
+        'size': ["{0:d}kB".format(int(size/1000))]
     }
 file_inspector.extensions = [".*"]
 file_inspector.version = '1.0.0'
+file_inspector.needs_content = False
@@ -1,4 +1,5 @@
 import logging
+import mmap
 from PIL import Image
 from fractions import Fraction
 
@@ -16,41 +17,91 @@ except ImportError:
 def exif_date_to_iso(d):
     return d[:10].replace(':', '-') + "T" + d[11:]
 
+def gps_to_degrees(tag, ref):
+    'Degrees, minutes and seconds rationals to signed decimal degrees'
+    d, m, s = [ float(r.num) / r.den for r in tag.values ]
+    degrees = d + m / 60 + s / 3600
+    return -degrees if str(ref) in ('S', 'W') else degrees
+
+def read_image_meta(filename):
+    '''
+    Reads the image headers in a single pass.
+
+    The file is opened once and mapped so both PIL and exifread share the same
+    buffer and only the pages holding the headers are ever read - nothing is
+    decoded.  Returns a dict with width, height and mode plus created,
+    orientation, resolution, make, model, latitude and longitude if the EXIF
+    data has them.
+    '''
+    meta = {}
+
+    with open(filename, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # can't map empty files
+            buf = f
+
+        try:
+            im = Image.open(buf)
+            meta['width'], meta['height'] = im.size
+            meta['mode'] = im.mode
+
+            if HAS_EXIF:
+                # DateTimeOriginal is the last tag we want from the EXIF IFD
+                exif = exifread.process_file(buf, details=False, stop_tag='DateTimeOriginal')
+
+                for name, tag in (('created', 'EXIF DateTimeOriginal'),
+                        ('make', 'Image Make'), ('model', 'Image Model')):
+                    if tag in exif:
+                        meta[name] = str(exif[tag])
+
+                for name, tag in (('orientation', 'Image Orientation'),
+                        ('resolution', 'Image XResolution')):
+                    if tag in exif:
+                        meta[name] = exif[tag].values[0]
+
+                # the stop tag only cuts short the EXIF IFD, GPS is still read
+                try:
+                    meta['latitude'] = gps_to_degrees(exif['GPS GPSLatitude'], exif['GPS GPSLatitudeRef'])
+                    meta['longitude'] = gps_to_degrees(exif['GPS GPSLongitude'], exif['GPS GPSLongitudeRef'])
+                except (KeyError, ValueError, ZeroDivisionError):
+                    meta.pop('latitude', None)
+        finally:
+            if buf is not f:
+                buf.close()
+
+    return meta
 
 def image_inspector(filename):
-    
-    im = Image.open(filename)
-   
+
+    meta = read_image_meta(filename)
+
     info = {}
 
     props = info.setdefault('props', [])
 
-    width, height = im.size
+    width, height = meta['width'], meta['height']
 
     if HAS_EXIF:
-        with open(filename, 'rb') as f:
-            exif = exifread.process_file(f, details=False)
-
-        created = exif.get('EXIF DateTimeOriginal')
+        created = meta.get('created')
         if created:
-            info['created'] = [ exif_date_to_iso(str(created)) ]
+            info['created'] = [ exif_date_to_iso(created) ]
 
-        o = exif.get('Image Orientation')
-        if o:
-            if o.values[0] in [6, 8]:
-                width, height = height, width
+        if meta.get('orientation') in [6, 8]:
+            width, height = height, width
 
-        res = exif.get('Image XResolution')
+        res = meta.get('resolution')
         if res:
-            props.append("{0}dpi".format(res.values[0]))
+            props.append("{0}dpi".format(res))
+
+        if 'longitude' in meta:
+            info['location'] = [ "{0:.6f},{1:.6f}".format(meta['latitude'], meta['longitude']) ]
 
         device = info.setdefault('device', [])
-        make = exif.get('Image Make')
-        if make:
-            device.append(str(make))
-        model = exif.get('Image Model')
-        if model:
-            device.append(str(model))
+        for k in ('make', 'model'):
+            if meta.get(k):
+                device.append(meta[k])
 
     orientation = 'landscape' if width > height else 'portrait'
     props.append(orientation)
@@ -69,7 +120,7 @@ def image_inspector(filename):
         size = 'lowres'
     props.append(size)
 
-    mode = im.mode
+    mode = meta['mode']
     if mode == '1':
         mode = 'BW'
     props.append(mode)
@@ -79,4 +130,4 @@ def image_inspector(filename):
     return info
 
 image_inspector.extensions = ['.jpg', '.jpeg', '.tif', '.png', '.gif']
-image_inspector.version = '1.0.0'
+image_inspector.version = '1.1.0'
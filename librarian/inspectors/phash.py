@@ -0,0 +1,36 @@
+import logging
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# dHash compares each pixel with its neighbour in a HASH_SIZE + 1 x HASH_SIZE
+# greyscale thumbnail which gives a HASH_SIZE ** 2 bit hash
+HASH_SIZE = 8
+
+def dhash(filename):
+    '''
+    Difference hash of an image as an integer.  Survives resizing and
+    re-encoding, and visually similar images have a small hamming distance.
+    '''
+    im = Image.open(filename)
+
+    # let the jpeg decoder scale down as it goes, it is much faster
+    im.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+
+    im = im.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(im.getdata())
+
+    h = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            h = (h << 1) | (left > right)
+    return h
+
+def phash_inspector(filename):
+    'Perceptual hash for finding near duplicate images'
+    return {'dhash': "{0:016x}".format(dhash(filename))}
+
+phash_inspector.extensions = ['.jpg', '.jpeg', '.tif', '.tiff', '.png', '.gif']
+phash_inspector.version = '1.0.0'
@@ -1,10 +1,19 @@
 import subprocess
+from multiprocessing.pool import ThreadPool
 from dateutil.parser import parse
 
 FULL_TEXT = True
 
+# default budget for the text stored in the .info file, see the PDF_* config
+MAX_PAGES = 100
+MAX_TEXT = 64 * 1024
+
+# longer documents have their pages extracted in parallel
+PARALLEL_PAGES = 8
+WORKERS = 4
+
 def run_pdfinfo(filename):
-    
+
     info = {}
 
     output = subprocess.check_output(['pdfinfo', filename]).decode('utf-8').rstrip()
@@ -17,19 +26,68 @@ def run_pdfinfo(filename):
     for k in ('Author', 'Creator', 'Pages', 'PDF version'):
         if k in props:
             info[k.lower().replace(' ', '_')] = props.get(k, '').strip()
-    
+
     return info
 
-def run_pdftotext(filename):
+def page_text(filename, page, limit=MAX_TEXT):
+    '''
+    Text for a single page, reading no more than limit bytes of output
+    '''
+    p = subprocess.Popen(['pdftotext', '-q', '-f', str(page), '-l', str(page), filename, '-'],
+            stdout=subprocess.PIPE)
+    data = p.stdout.read(limit)
+    p.stdout.close()
+    if p.poll() is None:
+        p.kill()
+    p.wait()
+    return data
 
+def run_pdftotext(filename, pages, max_pages=MAX_PAGES, max_text=MAX_TEXT, workers=WORKERS):
+    '''
+    Extracts the text page by page until the page or byte budget is used up
+    '''
     info = {}
 
-    info['text'] = subprocess.check_output(['pdftotext', filename, '-']).decode('utf-8').rstrip()
+    if pages > max_pages:
+        info['truncated'] = True
+    pages = range(1, min(pages, max_pages) + 1)
+
+    pool = None
+    if len(pages) > PARALLEL_PAGES and workers > 1:
+        pool = ThreadPool(workers)
+        texts = pool.imap(lambda page: page_text(filename, page, max_text), pages)
+    else:
+        texts = ( page_text(filename, page, max_text) for page in pages )
+
+    result = []
+    size = 0
+    try:
+        for data in texts:
+            result.append(data[:max_text - size])
+            size += len(result[-1])
+            if size >= max_text:
+                info['truncated'] = True
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    info['text'] = b''.join(result).decode('utf-8', 'ignore').rstrip()
 
     return info
 
-def poppler_inspector(filename):
+def poppler_inspector(filename, max_pages=MAX_PAGES, max_text=MAX_TEXT, workers=WORKERS):
+    '''
+    PDF properties and up to max_pages pages or max_text bytes of text,
+    extracted by up to workers pdftotext processes at a time
+    '''
     info = run_pdfinfo(filename)
-    if FULL_TEXT: info.update(run_pdftotext(filename))
+    if FULL_TEXT:
+        try:
+            pages = int(info.get('pages'))
+        except (TypeError, ValueError):
+            pages = max_pages
+        info.update(run_pdftotext(filename, pages, max_pages, max_text, workers))
     return info
 poppler_inspector.extensions = ['.pdf']
+poppler_inspector.version = '1.1.0'
@@ -0,0 +1,197 @@
+'''
+Runs inspectors in separate worker processes
+
+A file that hangs an inspector or blows up its memory only takes out the
+worker handling it.  The worker is killed along with anything it started
+(e.g. pdftotext) and replaced, and a failure is returned for that file so
+it gets recorded in the .info rather than retried on every run.
+'''
+from __future__ import absolute_import, division, print_function
+
+import os
+import select
+import signal
+import time
+import logging
+import multiprocessing
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+logger = logging.getLogger(__name__)
+
+# seconds allowed for all the inspectors to run on a single file
+TIMEOUT = 60
+
+# address space limit for a worker and anything it runs, in bytes
+MEMORY = 1024 * 1024 * 1024
+
+# workers are replaced after this many files so leaks can't build up
+MAX_TASKS = 200
+
+try:
+    # workers get replaced while other threads (e.g. the prefetch thread) are
+    # running, so they are forked from a clean single threaded server rather
+    # than from us where another thread could be holding a lock
+    _context = multiprocessing.get_context('forkserver')
+except (AttributeError, ValueError):
+    # python 2 or no fork server on this platform
+    _context = multiprocessing
+
+def _serve(conn, inspector, memory):
+    # own process group so a kill also takes out any child processes
+    os.setpgrp()
+
+    # RLIMIT_RSS isn't enforced by linux so limit the address space instead,
+    # which is inherited by anything the inspectors run
+    if memory and HAS_RESOURCE:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    while True:
+        filename = conn.recv()
+        if filename is None:
+            break
+        conn.send(inspector.inspect_file(filename))
+
+    conn.close()
+
+
+class Worker(object):
+    'A worker process inspecting one file at a time'
+
+    def __init__(self, inspector, memory):
+        self.conn, child = _context.Pipe()
+        self.process = _context.Process(target=_serve, args=(child, inspector, memory))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+        self.tasks = 0
+        self.filename = None
+        self.started = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def send(self, filename):
+        self.filename = filename
+        self.started = time.time()
+        self.tasks += 1
+        self.conn.send(filename)
+
+    def recv(self):
+        return self.conn.recv()
+
+    def pause(self, seconds):
+        'Leave seconds nobody was waiting on the worker out of its timeout'
+        self.started += seconds
+
+    def overdue(self, timeout):
+        return time.time() - self.started > timeout
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.process.join(1)
+        except (IOError, OSError):
+            pass
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                # not in its own group yet
+                self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class Sandbox(object):
+    '''
+    Fans files out over a set of worker processes with a wall clock timeout
+    per file, a memory limit and recycling of workers.
+    '''
+
+    def __init__(self, inspector, workers=1, timeout=TIMEOUT, memory=MEMORY, max_tasks=MAX_TASKS):
+        self.inspector = inspector
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.memory = memory
+        self.max_tasks = max_tasks
+
+    def _spawn(self):
+        return Worker(self.inspector, self.memory)
+
+    def imap_unordered(self, filenames):
+        '''
+        Yields (filename, data) tuples in the order they complete
+        '''
+        filenames = iter(filenames)
+        idle = [ self._spawn() for i in range(self.workers) ]
+        busy = []
+        pending = True
+
+        try:
+            while True:
+                # keep every worker busy
+                while idle and pending:
+                    try:
+                        filename = next(filenames)
+                    except StopIteration:
+                        pending = False
+                        break
+                    w = idle.pop()
+                    w.send(filename)
+                    busy.append(w)
+
+                if not busy:
+                    break
+
+                wait = min(w.started for w in busy) + self.timeout - time.time()
+                ready, _, _ = select.select(busy, [], [], max(0, wait))
+
+                # take everything that finished before looking for timeouts
+                results = []
+                for w in ready:
+                    busy.remove(w)
+                    filename = w.filename
+                    try:
+                        data = w.recv()
+                    except (EOFError, IOError, OSError):
+                        logger.warning("Inspector died on %s", filename)
+                        data = self.inspector.failed(filename, 'crashed')
+                        w.kill()
+                        w = self._spawn()
+                    else:
+                        if w.tasks >= self.max_tasks:
+                            logger.debug("Recycling worker %d", w.process.pid)
+                            w.stop()
+                            w = self._spawn()
+                    idle.append(w)
+                    results.append((filename, data))
+
+                for w in [ w for w in busy if w.overdue(self.timeout) ]:
+                    busy.remove(w)
+                    logger.warning("Inspection of %s timed out", w.filename)
+                    w.kill()
+                    idle.append(self._spawn())
+                    results.append((w.filename, self.inspector.failed(w.filename, 'timeout')))
+
+                for result in results:
+                    yielded = time.time()
+                    yield result
+
+                    # the clock only runs while we are waiting on a worker,
+                    # not while the consumer deals with a result
+                    for w in busy:
+                        w.pause(time.time() - yielded)
+        finally:
+            for w in idle:
+                w.stop()
+            for w in busy:
+                w.kill()
@@ -0,0 +1,88 @@
+'''
+Native handling of git-annex keys
+
+Saves running `git annex examinekey` for things that are a pure function
+of the key itself e.g. the hash directories content and logs live under.
+
+Keys are of the form BACKEND[-sSIZE][-mMTIME][-SCHUNKSIZE-CCHUNKNUM]--NAME
+'''
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import struct
+
+FIELDS = {
+    's': 'size',
+    'm': 'mtime',
+    'S': 'chunksize',
+    'C': 'chunknumber',
+}
+
+# alphabet used by git-annex for the mixed case hash directories
+MIXED_CHARS = "0123456789zqjxkmvwgpfZQJXKMVWGPF"
+
+def _split(key):
+    head, sep, name = key.partition('--')
+    parts = head.split('-')
+
+    if not sep or not name or not parts[0]:
+        raise ValueError("Invalid key: " + key)
+
+    for p in parts[1:]:
+        if len(p) < 2 or p[0] not in FIELDS or not p[1:].isdigit():
+            raise ValueError("Invalid key: " + key)
+
+    return parts[0], parts[1:], name
+
+def parse_key(key):
+    '''
+    Returns a dict with the backend, name and any of size, mtime, chunksize
+    and chunknumber that are present in the key, plus the extension for
+    backends that record one (SHA256E etc).
+    '''
+    backend, fields, name = _split(key)
+
+    result = {'backend': backend, 'name': name}
+
+    for f in fields:
+        result[FIELDS[f[0]]] = int(f[1:])
+
+    if backend.endswith('E') and '.' in name:
+        result['extension'] = name[name.index('.') + 1:]
+
+    return result
+
+def non_chunk_key(key):
+    '''
+    The key with any chunk fields removed, which is what the hash
+    directories are calculated from
+    '''
+    backend, fields, name = _split(key)
+    fields = [ f for f in fields if f[0] not in 'SC' ]
+    return "-".join([backend] + fields) + "--" + name
+
+def _md5(key):
+    return hashlib.md5(non_chunk_key(key).encode('utf-8'))
+
+def hashdirlower(key):
+    'e.g. 1a2/b3c/'
+    h = _md5(key).hexdigest()
+    return "{0}/{1}/".format(h[:3], h[3:6])
+
+def hashdirmixed(key):
+    'e.g. Xy/Z1/'
+    chars = []
+    for word in struct.unpack('<4I', _md5(key).digest()):
+        c = [ MIXED_CHARS[(word >> (6 * i)) & 31] for i in range(8) ]
+        # pairs are swapped and only the first 6 characters used
+        for i in range(0, 6, 2):
+            chars.extend((c[i + 1], c[i]))
+    return "{0}/{1}/".format(''.join(chars[:2]), ''.join(chars[2:4]))
+
+def content_location(key):
+    'Path to the content relative to the repo'
+    return ".git/annex/objects/{0}{1}/{1}".format(hashdirmixed(key), key)
+
+def info_location(key):
+    'Path to the .info file in the git-annex branch'
+    return "{0}{1}.info".format(hashdirlower(key), key)
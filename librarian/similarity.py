@@ -0,0 +1,86 @@
+'''
+Near duplicate detection for perceptual hashes
+
+Hashes are 64 bit integers (16 hex digits when stored).  To avoid comparing
+everything with everything each hash is split into BANDS bands which are
+indexed as exact terms - if two hashes are within distance d of each other
+then at least one band is within d // BANDS bits of the other (multi-index
+hashing) so only hashes sharing a nearby band need to be compared.
+'''
+from __future__ import absolute_import, division, print_function
+
+import itertools
+
+BITS = 64
+BANDS = 4
+BAND_BITS = BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+# default maximum hamming distance for two images to be considered similar
+DISTANCE = 8
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def bands(h):
+    'The value of each band, lowest first'
+    return [ (h >> (i * BAND_BITS)) & BAND_MASK for i in range(BANDS) ]
+
+def variants(value, radius):
+    'All band values within radius bits of value'
+    yield value
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), r):
+            v = value
+            for b in bits:
+                v ^= 1 << b
+            yield v
+
+def band_term(prefix, i, value):
+    return "{0}{1}{2:04x}".format(prefix, i, value)
+
+def band_terms(prefix, h):
+    'Terms to index for a hash'
+    return [ band_term(prefix, i, v) for i, v in enumerate(bands(h)) ]
+
+def probe_terms(prefix, h, distance=DISTANCE):
+    'Terms to look up to find every hash within distance of h'
+    radius = distance // BANDS
+    return [ band_term(prefix, i, v)
+            for i, value in enumerate(bands(h))
+            for v in variants(value, radius) ]
+
+def clusters(hashes, distance=DISTANCE):
+    '''
+    Groups of keys whose hashes are within distance of each other (single
+    linkage), largest first.  hashes is a dict of key => integer hash.
+    '''
+    radius = distance // BANDS
+
+    buckets = [ {} for i in range(BANDS) ]
+    for key, h in hashes.items():
+        for i, value in enumerate(bands(h)):
+            buckets[i].setdefault(value, []).append(key)
+
+    parent = dict( (k, k) for k in hashes )
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for key, h in hashes.items():
+        for i, value in enumerate(bands(h)):
+            for v in variants(value, radius):
+                for other in buckets[i].get(v, ()):
+                    if other == key or find(other) == find(key):
+                        continue
+                    if hamming(h, hashes[other]) <= distance:
+                        parent[find(other)] = find(key)
+
+    groups = {}
+    for k in hashes:
+        groups.setdefault(find(k), []).append(k)
+
+    return sorted([ sorted(g) for g in groups.values() if len(g) > 1 ], key=len, reverse=True)
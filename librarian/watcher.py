@@ -1,33 +1,119 @@
 from gevent import Greenlet, GreenletExit, sleep
+from gevent.select import select
 import os
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
-class FileWatcher(Greenlet):
+try:
+    from inotify_simple import INotify, flags
+    HAS_INOTIFY = True
+except ImportError:
+    HAS_INOTIFY = False
 
-    mtime = None
+class RefWatcher(Greenlet):
+    '''
+    Calls cb whenever any of the given branches change.
 
-    def __init__(self, f, cb, seconds=10):
+    Git updates a ref by renaming a lock file over it (or by rewriting
+    packed-refs) so with inotify we watch for those renames and writes
+    on the containing directories. A burst of updates (e.g. `git annex sync`)
+    is debounced into a single callback.  Falls back to polling mtimes if
+    inotify_simple is not installed.
+    '''
+
+    def __init__(self, git_dir, branches, cb, debounce=0.2, max_delay=1.0, seconds=10):
         Greenlet.__init__(self)
-        self.f = f
+        self.git_dir = git_dir
+        self.refs = [ os.path.join(git_dir, 'refs', 'heads', b) for b in branches ]
+        self.refs.append(os.path.join(git_dir, 'packed-refs'))
         self.cb = cb
+        self.debounce = debounce
+        self.max_delay = max_delay
         self.seconds = seconds
 
     def _run(self):
-        logger.info("Watching %s", self.f)
-        while True:
-            s = os.stat(self.f)
-            if s.st_mtime != self.mtime:
-                logger.debug("Change detected on %s", self.f)
-                self.mtime = s.st_mtime
-                try:
-                    self.cb()
-                except:
-                    logger.exception("Failed to execute callaback")
+        logger.info("Watching %s", ", ".join(self.refs))
+
+        # always start from a known state
+        self._notify()
+
+        try:
+            if HAS_INOTIFY:
+                self._watch()
+            else:
+                self._poll()
+        except GreenletExit:
+            pass
+
+        logger.info("Finished watching %s", self.git_dir)
+
+    def _notify(self):
+        try:
+            self.cb()
+        except:
+            logger.exception("Failed to execute callback")
+
+    def _watch(self):
+        inotify = INotify()
+        mask = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE
+
+        # watch descriptor => names we care about in that directory
+        names = {}
+        for ref in self.refs:
+            d, name = os.path.split(ref)
+            if not os.path.isdir(d):
+                logger.warning("Unable to watch %s", ref)
+                continue
+            wd = inotify.add_watch(d, mask)
+            names.setdefault(wd, set()).add(name)
+
+        fd = inotify.fileno()
+
+        try:
+            while True:
+                select([fd], [], [])
+                if not self._relevant(inotify.read(timeout=0), names):
+                    continue
+
+                # wait for things to go quiet, but not forever
+                deadline = time.time() + self.max_delay
+                while True:
+                    remaining = min(self.debounce, deadline - time.time())
+                    if remaining <= 0:
+                        break
+                    ready, _, _ = select([fd], [], [], remaining)
+                    if not ready:
+                        break
+                    inotify.read(timeout=0)
+
+                logger.debug("Change detected in refs")
+                self._notify()
+        finally:
+            inotify.close()
+
+    def _relevant(self, events, names):
+        for event in events:
+            if event.name in names.get(event.wd, ()):
+                return True
+        return False
+
+    def _mtimes(self):
+        result = []
+        for ref in self.refs:
             try:
-                sleep(self.seconds)
-            except GreenletExit:
-                break
-        logger.info("Finished watching %s", self.f)
-        
+                result.append(os.stat(ref).st_mtime)
+            except OSError:
+                result.append(None)
+        return result
+
+    def _poll(self):
+        mtimes = self._mtimes()
+        while True:
+            sleep(self.seconds)
+            current = self._mtimes()
+            if current != mtimes:
+                logger.debug("Change detected in refs")
+                mtimes = current
+                self._notify()
@@ -0,0 +1,155 @@
+'''
+Background worker for the server
+
+All index writes happen on native threads with their own Librarian so
+request handlers only ever hold a read-only database and are never
+stalled by a sync.
+'''
+from __future__ import absolute_import, division, print_function
+
+from gevent.threadpool import ThreadPool
+import threading
+import logging
+import time
+from collections import OrderedDict
+
+from librarian import Librarian
+from librarian.federation import Federation
+
+logger = logging.getLogger(__name__)
+
+ISO_8601 = "%Y-%m-%dT%H:%M:%S"
+
+def now():
+    return time.strftime(ISO_8601)
+
+class SyncWorker(object):
+    '''
+    Runs syncs off the request path.
+
+    Triggers that arrive while a sync is already waiting to run are
+    coalesced into it, so a burst of changes causes at most one extra sync.
+    '''
+
+    def __init__(self, librarian, threads=2):
+        self.librarian = Librarian(librarian.base_path, librarian.config)
+        self.pool = ThreadPool(threads)
+
+        # xapian only allows one writer at a time
+        self._write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._queued = False
+
+        self.status = {
+            'state': 'idle',
+            'commit': None,
+            'started': None,
+            'finished': None,
+            'error': None,
+            'syncs': 0,
+        }
+
+    def trigger(self):
+        '''
+        Request a sync. Returns False if one was already queued.
+        '''
+        with self._lock:
+            if self._queued:
+                logger.debug("Sync already queued")
+                return False
+            self._queued = True
+
+        self.pool.spawn(self._sync)
+        return True
+
+    def submit(self, fn, *args):
+        '''
+        Run fn(librarian, *args) with the writable index.
+        Returns an AsyncResult the calling greenlet can wait on.
+        '''
+        return self.pool.spawn(self._write, fn, *args)
+
+    def get_status(self):
+        status = dict(self.status)
+        status['queued'] = self._queued
+        return status
+
+    def close(self):
+        self.pool.kill()
+        self.librarian.close()
+
+    def _write(self, fn, *args):
+        with self._write_lock:
+            return fn(self.librarian, *args)
+
+    def _sync(self):
+        with self._write_lock:
+            # anything triggered from here on needs another pass
+            with self._lock:
+                self._queued = False
+
+            self.status.update(state='syncing', started=now())
+            try:
+                commit = self.librarian.sync()
+                self.status.update(commit=commit, error=None)
+            except Exception as e:
+                logger.exception("Sync failed")
+                self.status['error'] = str(e)
+            finally:
+                self.status['syncs'] += 1
+                self.status.update(state='idle', finished=now())
+
+class FederatedWorker(object):
+    '''
+    SyncWorker for each repository of a Federation.  Writes through submit
+    hold every repository's write lock and get a Federation of the workers'
+    librarians.
+    '''
+
+    def __init__(self, federation, threads=2):
+        self.workers = OrderedDict( (name, SyncWorker(l, threads))
+                for name, l in federation.librarians.items() )
+        self.federation = Federation([ w.librarian for w in self.workers.values() ], share=False)
+        self.pool = ThreadPool(threads)
+
+    def trigger(self, name=None):
+        '''
+        Request a sync of one repository, or all of them.  Returns False if
+        they were all queued already.
+        '''
+        if name is not None:
+            return self.workers[name].trigger()
+        return any([ w.trigger() for w in self.workers.values() ])
+
+    def submit(self, fn, *args):
+        '''
+        Run fn(federation, *args) with the writable indexes.
+        '''
+        return self.pool.spawn(self._write, fn, *args)
+
+    def get_status(self):
+        repos = OrderedDict( (name, w.get_status()) for name, w in self.workers.items() )
+        syncing = [ s for s in repos.values() if s['state'] == 'syncing' ]
+        return {
+            'state': 'syncing' if syncing else 'idle',
+            'queued': any( s['queued'] for s in repos.values() ),
+            'syncs': sum( s['syncs'] for s in repos.values() ),
+            'error': next(( s['error'] for s in repos.values() if s['error'] ), None),
+            'repos': repos,
+        }
+
+    def close(self):
+        self.pool.kill()
+        for w in self.workers.values():
+            w.close()
+
+    def _write(self, fn, *args):
+        # always taken in the same order so writes can't deadlock
+        locks = [ w._write_lock for w in self.workers.values() ]
+        for lock in locks:
+            lock.acquire()
+        try:
+            return fn(self.federation, *args)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
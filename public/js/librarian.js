@@ -11,6 +11,16 @@ const state = {
 }
 
 var select_mode = false;
+var thumbUrls = [];
+var thumbGeneration = 0;
+var currentImages = [];
+
+// ms between checks on thumbnails that are being fetched
+const THUMB_RETRY = 2000;
+const PREVIEW_TRIES = 30;
+
+// originals after the one being viewed to start fetching
+const PREFETCH = 3;
 
 $(document).on('ready', () => {
     console.log("Document loaded");
@@ -117,24 +127,17 @@ function update(cb) {
 }
 
 function displayImages(images) {
+    currentImages = images;
     var imageGrid = $('<div/>');
+    var previews = {};
 
     images.map((image) => {
 
         var preview = $('<div class="preview"/>');
-        preview.attr('title', image.date || "unknown");
+        preview.attr('title', (image.repo ? image.repo + ": " : "") + (image.date || "unknown"));
         preview.attr('data-key', image.key);
-
-        var uri = "/api/thumb/" + image.key;
-        $('<img/>').attr('src', uri)
-        .on('load', () => {
-            console.log("LOADED");
-            preview.css('background-image', 'url("' + uri + '")');
-        })
-        .on('error', (e) => {
-            console.log("ERROR", e);
-        });
-
+        preview.toggleClass('remote', !image.local);
+        previews[image.key] = preview;
         
         preview.on('click', (e) => {
             if (select_mode) {
@@ -148,6 +151,57 @@ function displayImages(images) {
     });
 
     $('#image-grid').html(imageGrid);
+
+    thumbUrls.map((uri) => URL.revokeObjectURL(uri));
+    thumbUrls = [];
+    thumbGeneration++;
+
+    if (images.length == 0) return;
+
+    loadThumbs(images.map((image) => image.key), thumbGeneration, (key, blob) => {
+        var uri = URL.createObjectURL(blob);
+        thumbUrls.push(uri);
+        previews[key].css('background-image', 'url("' + uri + '")');
+    });
+}
+
+function loadThumbs(keys, generation, cb) {
+    var url = '/api/thumbs?' + keys.map((key) => 'key=' + encodeURIComponent(key)).join('&');
+
+    fetch(url).then((response) => {
+        if (response.status != 200) {
+            throw new Error("Failed to load thumbnails");
+        }
+        return response.arrayBuffer();
+    }).then((buffer) => {
+        // stream of "<key> <length>\n<data>" records
+        var bytes = new Uint8Array(buffer);
+        var pos = 0;
+        var fetching = [];
+        while (pos < bytes.length) {
+            var eol = bytes.indexOf(10, pos);
+            var header = String.fromCharCode.apply(null, bytes.subarray(pos, eol));
+            var split = header.lastIndexOf(' ');
+            var size = parseInt(header.substr(split + 1));
+            pos = eol + 1;
+            if (size < 0) {
+                // still being fetched from a remote
+                fetching.push(header.substr(0, split));
+                continue;
+            }
+            if (size) {
+                cb(header.substr(0, split), new Blob([bytes.subarray(pos, pos + size)], {type: 'image/jpeg'}));
+            }
+            pos += size;
+        }
+
+        // unless the grid has been replaced since
+        if (fetching.length && generation == thumbGeneration) {
+            setTimeout(() => loadThumbs(fetching, generation, cb), THUMB_RETRY);
+        }
+    }).catch((e) => {
+        console.log("ERROR", e);
+    });
 }
 
 function setStatus(text, icon) {
@@ -173,16 +227,18 @@ function sendCommand(cmd) {
         keys.push($(this).data('key'));
     });
 
-    var payload = {cmd}
+    var url = '/api/cli';
+    var payload = {cmd};
     if (keys.length) {
-        payload['keys'] = keys;
-        payload['cmd'] = 'annex metadata ' + cmd;
+        // metadata for a selection goes through the bulk api in one request
+        url = '/api/metadata';
+        payload = {keys, args: cmd};
     }
     console.log(payload);
 
     setActionsEnabled(false);
     
-    fetch('/api/cli', {
+    fetch(url, {
         method: 'POST',
         headers: new Headers({'Content-Type': 'application/json'}),
         body: JSON.stringify(payload)
@@ -206,15 +262,45 @@ function sendCommand(cmd) {
 
 }
 
+function prefetch(images) {
+    var keys = images.filter((image) => !image.local).map((image) => image.key);
+    if (keys.length == 0) return;
+
+    fetch('/api/prefetch', {
+        method: 'POST',
+        headers: new Headers({'Content-Type': 'application/json'}),
+        body: JSON.stringify({keys})
+    }).catch((e) => {
+        console.log("ERROR", e);
+    });
+}
+
 function showDetail(image) {
     $('#detail').modal('show').data('for', image.key);
     $('#detail-title').html(image.key);
+    $('#detail-original').attr('href', '/api/item/' + image.key);
+
+    // the next few are likely to be opened too
+    var i = currentImages.indexOf(image);
+    prefetch(currentImages.slice(i + 1, i + 1 + PREFETCH));
 
     var el = $('#detail-image');
+    var tries = 0;
     el.hide()
         .attr('src', '/api/preview/' + image.key)
+        .off('load error')
         .on('load', () => {
             el.slideDown();
+        })
+        .on('error', () => {
+            // a 202 while the content is fetched, try again for a while
+            if (++tries < PREVIEW_TRIES) {
+                setTimeout(() => {
+                    if ($('#detail').data('for') == image.key) {
+                        el.attr('src', '/api/preview/' + image.key + '?try=' + tries);
+                    }
+                }, THUMB_RETRY);
+            }
         });
 
     var tags = $('<div/>');
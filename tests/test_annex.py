@@ -1,16 +1,79 @@
 import unittest
+import os
+import shutil
+import tempfile
 from tests import RepoBase
-from librarian import annex
+from librarian import annex, keys, hashcache
 from subprocess import CalledProcessError
 
 #import logging
 #logging.basicConfig(level=logging.DEBUG)
 
+KEY = "SHA256E-s7--724c531a3bc130eb46fbc4600064779552682ef4f351976fe75d876d94e8088c.txt"
+
+class MovingAnnex(annex.Annex):
+    '''
+    Annex where something else commits to the git-annex branch while the
+    first `moves` .info commits are being made
+    '''
+
+    def __init__(self, path, moves):
+        annex.Annex.__init__(self, path)
+        self.moves = moves
+        self.parents = 0
+        self.others = []
+
+    def git_line(self, *args, **kwargs):
+        line = annex.Annex.git_line(self, *args, **kwargs)
+        if args == ('rev-parse', 'refs/heads/git-annex'):
+            self.parents += 1
+            # every other call is InfoWriter looking for the parent
+            if self.parents % 2 == 1 and len(self.others) < self.moves:
+                tree = annex.Annex.git_line(self, 'rev-parse', line + '^{tree}')
+                other = annex.Annex.git_line(self, 'commit-tree', tree, '-p', line, '-m', 'other')
+                self.git_raw('update-ref', 'refs/heads/git-annex', other)
+                self.others.append(other)
+        return line
+
 class AnnexTestCase(RepoBase, unittest.TestCase):
 
     def test_key_for_content(self):
         self.assertEqual(annex.key_for_content('/foo/bar/sha-xxx.key'), 'sha-xxx.key')
 
+    def test_parse_key(self):
+        self.assertDictEqual(keys.parse_key(KEY), {
+            'backend': 'SHA256E',
+            'size': 7,
+            'name': '724c531a3bc130eb46fbc4600064779552682ef4f351976fe75d876d94e8088c.txt',
+            'extension': 'txt',
+        })
+
+        self.assertDictEqual(keys.parse_key('WORM-s10-m1500000000--foo.bar'), {
+            'backend': 'WORM',
+            'size': 10,
+            'mtime': 1500000000,
+            'name': 'foo.bar',
+        })
+
+        chunked = keys.parse_key('SHA256E-s1048576-S262144-C2--abc.tar.gz')
+        self.assertEqual(chunked['chunksize'], 262144)
+        self.assertEqual(chunked['chunknumber'], 2)
+        self.assertEqual(chunked['extension'], 'tar.gz')
+
+        for bad in ('foo', 'SHA256--', '-s1--x', 'SHA256E-x7--a'):
+            self.assertRaises(ValueError, keys.parse_key, bad)
+
+    def test_hashdirs(self):
+        self.assertEqual(keys.hashdirmixed(KEY), '9Z/jj/')
+        self.assertEqual(keys.non_chunk_key('SHA256E-s1048576-S262144-C2--abc.tar.gz'),
+                'SHA256E-s1048576--abc.tar.gz')
+
+        l = self.clone_repo()
+
+        for key in (KEY, 'WORM-s10-m1500000000--foo.bar', 'SHA256E-s1048576-S262144-C2--abc.tar.gz'):
+            expected = l.annex.git_line('annex', 'examinekey', '--format', '${hashdirmixed} ${hashdirlower}', key)
+            self.assertEqual("{0} {1}".format(keys.hashdirmixed(key), keys.hashdirlower(key)), expected)
+
     def test_batch(self):
         l = self.clone_repo()
 
@@ -19,9 +82,81 @@ class AnnexTestCase(RepoBase, unittest.TestCase):
             self.assertEqual(info['key'], "SHA256E-s7--724c531a3bc130eb46fbc4600064779552682ef4f351976fe75d876d94e8088c.txt")
 
 
+    def test_pooled_batch(self):
+        l = self.clone_repo()
+
+        link = os.readlink(l.relative_path('dir_1/test_1.txt'))
+        self.assertEqual(l.annex.cat_file('HEAD:dir_1/test_1.txt').decode('utf-8'), link)
+
+        with self.assertRaises(annex.GitError):
+            l.annex.cat_file('HEAD:missing.txt')
+
+        # the same process is reused and restarted if it dies
+        batch = l.annex._batches[('cat-file', )]
+        batch.p.kill()
+        batch.p.wait()
+        self.assertEqual(l.annex.cat_file('HEAD:dir_1/test_1.txt').decode('utf-8'), link)
+        self.assertEqual(len(l.annex._batches), 1)
+
+        self.assertEqual(l.annex.calckey(l.relative_path('dir_1/test_1.txt')), KEY)
+
+        l.close()
+        self.assertEqual(l.annex._batches, {})
+
+    def test_info_branch_moved(self):
+        self.clone_repo()
+        a = MovingAnnex(self.repo, 1)
+
+        with annex.InfoWriter(a) as writer:
+            writer.write(KEY, {'file': {'name': ['test_1.txt']}})
+
+        # written on top of the other commit at the final checkpoint
+        self.assertEqual(len(a.others), 1)
+        a.git_raw('merge-base', '--is-ancestor', a.others[0], 'git-annex')
+        info = a.git_line('show', 'git-annex:' + annex.info_location(KEY))
+        self.assertIn('test_1.txt', info)
+
+    def test_info_branch_keeps_moving(self):
+        self.clone_repo()
+        a = MovingAnnex(self.repo, 100)
+
+        with self.assertRaisesRegex(annex.AnnexError, KEY):
+            with annex.InfoWriter(a) as writer:
+                writer.write(KEY, {})
+
     def test_bad_batch(self):
         l = self.clone_repo()
 
         with self.assertRaisesRegex(CalledProcessError, 'non-zero exit status 1'):
             with l.annex.git_batch(['foo']) as batch:
                 pass
+
+    def test_missing(self):
+        l = self.clone_repo()
+        l.sync()
+
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+
+        known = os.path.join(outside, 'known.txt')
+        with open(known, 'w') as f:
+            f.write("Hello 1")
+        new = os.path.join(outside, 'new.txt')
+        with open(new, 'w') as f:
+            f.write("Not in the annex")
+
+        self.assertEqual(list(l.missing([known, new])), [new])
+
+        # second time round the keys come from the cache
+        with hashcache.HashCache(l.hashes_path) as cache:
+            self.assertEqual(cache.get(hashcache.stat_key(known)), KEY)
+
+        l.annex.calckeys = None
+        self.assertEqual(list(l.missing([known, new])), [new])
+
+        # changing a file means hashing it again
+        with open(new, 'w') as f:
+            f.write("Still not in the annex")
+        os.utime(new, (0, 0))
+        with hashcache.HashCache(l.hashes_path) as cache:
+            self.assertIsNone(cache.get(hashcache.stat_key(new)))
@@ -0,0 +1,177 @@
+import unittest
+import tempfile
+import shutil
+import os
+from flask import Flask
+from librarian.api import create_api
+
+class FakeIndex:
+
+    def reopen(self):
+        pass
+
+class FakeLibrarian:
+    '''
+    Just enough of a Librarian for the api, serving files from a directory
+    '''
+
+    def __init__(self, d):
+        self.d = d
+        self.db = FakeIndex()
+        self.remote = set()
+        self.updated = []
+        self.annexed = []
+
+    def path(self, key):
+        return os.path.join(self.d, key)
+
+    def has_thumb(self, key):
+        return os.path.exists(self.path(key))
+
+    def fetching(self, key):
+        return key in self.remote
+
+    def file_for_key(self, key, wait=True):
+        if key in self.remote:
+            return None
+        return self.path(key)
+
+    def fetch_status(self, key):
+        return {'state': 'fetching' if key in self.remote else 'local'}
+
+    def revision(self):
+        return 1
+
+    def search(self, q, offset, limit):
+        if q.startswith('near:'):
+            # what XapianIndexer's QueryError is
+            raise ValueError("Invalid query " + q)
+        return {'matches': []}
+
+    def update_metadata(self, keys, add=None, remove=None, set_fields=None):
+        # part way through, like a batch that fails on a key
+        for key in keys:
+            if key == 'BAD':
+                raise Exception("Unable to update metadata for key: BAD")
+            self.updated.append((key, add, remove, set_fields))
+        return len(keys)
+
+    def annex_for(self, key):
+        self.annexed.append(key)
+        raise AssertionError("Ran a command per key")
+
+    def thumbs_for_keys(self, keys):
+        return [ (key, self.path(key) if self.has_thumb(key) else None) for key in keys ]
+
+class ApiTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.librarian = FakeLibrarian(self.d)
+
+        app = Flask(__name__)
+        app.register_blueprint(create_api(self.librarian), url_prefix='/api')
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def write(self, key, data):
+        with open(self.librarian.path(key), 'wb') as f:
+            f.write(data)
+
+    def test_thumbs(self):
+        self.write('K1', b'jpeg one')
+        self.write('K3', b'3')
+        self.librarian.remote.add('K2')
+
+        r = self.client.get('/api/thumbs?key=K1&key=K2&key=K3&key=K4')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, 'application/x-librarian-thumbs')
+        self.assertEqual(r.data, b'K1 8\njpeg oneK2 -1\nK3 1\n3K4 0\n')
+
+        # not cached until every thumbnail is there
+        self.assertNotIn('ETag', r.headers)
+
+    def test_thumbs_cached(self):
+        self.write('K1', b'jpeg one')
+
+        r = self.client.get('/api/thumbs?key=K1')
+        self.assertEqual(r.data, b'K1 8\njpeg one')
+        etag = r.headers['ETag']
+
+        r = self.client.get('/api/thumbs?key=K1', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+    def test_thumbs_batch(self):
+        self.assertEqual(self.client.get('/api/thumbs').status_code, 400)
+        keys = "&".join( "key=K{0:d}".format(i) for i in range(101) )
+        self.assertEqual(self.client.get('/api/thumbs?' + keys).status_code, 400)
+
+    def test_item(self):
+        self.write('K1', b'0123456789')
+
+        r = self.client.get('/api/item/K1')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'0123456789')
+        self.assertEqual(r.headers['ETag'], '"item-K1"')
+        self.assertIn('immutable', r.headers['Cache-Control'])
+
+        r = self.client.get('/api/item/K1', headers={'If-None-Match': '"item-K1"'})
+        self.assertEqual(r.status_code, 304)
+
+    def test_item_range(self):
+        self.write('K1', b'0123456789')
+
+        r = self.client.get('/api/item/K1', headers={'Range': 'bytes=2-5'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, b'2345')
+        self.assertEqual(r.headers['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(r.headers['ETag'], '"item-K1"')
+
+        # resuming with the etag we gave out
+        r = self.client.get('/api/item/K1', headers={'Range': 'bytes=6-', 'If-Range': '"item-K1"'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, b'6789')
+
+        # anything else gets the whole thing
+        r = self.client.get('/api/item/K1', headers={'Range': 'bytes=6-', 'If-Range': '"other"'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'0123456789')
+
+    def test_item_pending(self):
+        self.librarian.remote.add('K2')
+
+        r = self.client.get('/api/item/K2')
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r.get_json(), {'state': 'fetching'})
+        self.assertNotIn('ETag', r.headers)
+        self.assertNotIn('Cache-Control', r.headers)
+
+    def test_search_invalid(self):
+        r = self.client.get('/api/search?q=tag:x')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json()['q'], 'tag:x')
+
+        r = self.client.get('/api/search?q=near:nowhere')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.get_json()['result'], 'error')
+        self.assertNotIn('ETag', r.headers)
+
+    def test_cli_metadata(self):
+        r = self.client.post('/api/cli', json={'cmd': 'annex metadata -t blue -s gallery=mine', 'keys': ['K1', 'K2']})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json()['message'], 'Updated 2 items')
+        self.assertEqual(self.librarian.updated, [
+            ('K1', {'tag': ['blue']}, {}, {'gallery': ['mine']}),
+            ('K2', {'tag': ['blue']}, {}, {'gallery': ['mine']}),
+        ])
+
+    def test_cli_metadata_failed(self):
+        r = self.client.post('/api/cli', json={'cmd': 'annex metadata -t blue', 'keys': ['K1', 'BAD', 'K2']})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.get_json(), {'result': 'error', 'message': 'Unable to update metadata for key: BAD'})
+
+        # K1 is changed already and mustn't be changed again
+        self.assertEqual([ u[0] for u in self.librarian.updated ], ['K1'])
+        self.assertEqual(self.librarian.annexed, [])
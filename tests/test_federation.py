@@ -0,0 +1,103 @@
+import unittest
+import tempfile
+import time
+import threading
+import gevent
+from librarian.federation import Federation
+from librarian.worker import FederatedWorker
+from tests import RepoBase, clone_repo, destroy_repo
+
+K0 = u'SHA256E-s7--6a85a2eca1195e5201b6118281f27a581ac9c34e0caa849e40331bbbfbba3f7e.txt'
+K1 = u'SHA256E-s7--724c531a3bc130eb46fbc4600064779552682ef4f351976fe75d876d94e8088c.txt'
+
+class FederationTestCase(RepoBase, unittest.TestCase):
+    '''
+    Two clones of the same repository, only the second has the content
+    for K1
+    '''
+
+    def setUp(self):
+        RepoBase.setUp(self)
+        self.other = tempfile.mkdtemp()
+        self.addCleanup(destroy_repo, self.other)
+
+        self.first = clone_repo(self.origin, self.repo)
+        self.second = clone_repo(self.origin, self.other)
+        self.second.annex.git_raw('annex', 'get', 'dir_1')
+        self.first.sync()
+        self.second.sync()
+
+        self.federation = Federation([self.first, self.second])
+        self.addCleanup(self.federation.close)
+        self.names = list(self.federation.librarians)
+
+    def test_routing(self):
+        # content that is here wins, otherwise the first that knows the key
+        self.assertIs(self.federation.librarian_for(K1), self.second)
+        self.assertIs(self.federation.librarian_for(K0), self.first)
+        self.assertRaises(KeyError, self.federation.librarian_for, u'SHA256E-s1--missing.txt')
+
+        self.assertEqual(self.federation.get_data(K1)['_repo'], self.names[1])
+        self.assertEqual(self.federation.file_for_key(K1, False), self.second.annex.content_for_key(K1))
+
+    def test_thumbs(self):
+        # keys are only looked up in the indexes from this thread
+        threads = []
+        repo_for = self.federation.repo_for
+        def recording(key):
+            threads.append(threading.current_thread())
+            return repo_for(key)
+        self.federation.repo_for = recording
+
+        missing = u'SHA256E-s1--missing.txt'
+        result = list(self.federation.thumbs_for_keys([K0, missing]))
+        self.assertEqual(result, [(K0, None), (missing, None)])
+        self.assertEqual(set(threads), set([threading.current_thread()]))
+
+    def test_search(self):
+        r = self.federation.alldocs(0, 10)
+        found = dict( (m['key'], (m['repo'], m['local'])) for m in r['matches'] )
+        self.assertEqual(len(found), 3)
+        self.assertEqual(found[K0], (self.names[0], False))
+        self.assertEqual(found[K1], (self.names[1], True))
+
+    def test_update_metadata(self):
+        self.assertEqual(self.federation.update_metadata([K0, K1], add={'tag': ['split']}), 2)
+
+        # each key changed in the repository it is routed to
+        self.assertEqual(self.first.get_data(K0)['meta']['tag'], ['split'])
+        self.assertNotIn('tag', self.first.get_data(K1)['meta'])
+        self.assertEqual(self.second.get_data(K1)['meta']['tag'], ['split'])
+
+        # and that is where its details come from
+        self.assertEqual(self.federation.get_data(K1)['meta']['tag'], ['split'])
+
+    def test_worker(self):
+        worker = FederatedWorker(self.federation)
+        self.addCleanup(worker.close)
+
+        status = worker.get_status()
+        self.assertEqual(list(status['repos']), self.names)
+        self.assertEqual(status['state'], 'idle')
+
+        # writes wait for every repository's lock
+        lock = worker.workers[self.names[1]]._write_lock
+        lock.acquire()
+        result = worker.submit(Federation.update_metadata, [K0], {'tag': ['locked']})
+        gevent.sleep(0.5)
+        self.assertFalse(result.ready())
+        lock.release()
+        self.assertEqual(result.get(), 1)
+        self.first.db.reopen()
+        self.assertEqual(self.first.get_data(K0)['meta']['tag'], ['locked'])
+
+        # syncs are per repository
+        self.assertTrue(worker.trigger(self.names[0]))
+        deadline = time.time() + 10
+        while worker.get_status()['syncs'] < 1 and time.time() < deadline:
+            gevent.sleep(0.1)
+
+        status = worker.get_status()
+        self.assertEqual(status['repos'][self.names[0]]['syncs'], 1)
+        self.assertEqual(status['repos'][self.names[1]]['syncs'], 0)
+        self.assertIsNone(status['error'])
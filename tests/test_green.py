@@ -0,0 +1,106 @@
+import unittest
+import tempfile
+import shutil
+import subprocess
+import threading
+import time
+import os
+import gevent
+from librarian.annex import AnnexError
+from librarian.green import GreenAnnex
+
+class SleepyAnnex(GreenAnnex):
+    '''
+    GreenAnnex where every git command is a sleep
+    '''
+
+    def __init__(self, path, seconds, **kwargs):
+        GreenAnnex.__init__(self, path, **kwargs)
+        self.seconds = seconds
+        self.processes = []
+
+    def _popen(self, cmd, **kwargs):
+        p = GreenAnnex._popen(self, ['sleep', str(self.seconds)], **kwargs)
+        self.processes.append(p)
+        return p
+
+class GreenAnnexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        subprocess.check_output(['git', '-C', self.d, 'init'], stderr=subprocess.STDOUT)
+        os.mkdir(os.path.join(self.d, '.git', 'annex'))
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def assertKilled(self, p):
+        p.wait()
+        self.assertLess(p.returncode, 0)
+
+    def test_concurrency(self):
+        annex = SleepyAnnex(self.d, 0.3, concurrency=2)
+
+        # the hub keeps running while git does
+        ticks = []
+        ticker = gevent.spawn(lambda: [ (gevent.sleep(0.05), ticks.append(1)) for i in range(10) ])
+
+        start = time.time()
+        gevent.joinall([ gevent.spawn(annex.git_raw, 'status') for i in range(6) ], raise_error=True)
+        elapsed = time.time() - start
+
+        # three rounds of two
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertLess(elapsed, 1.5)
+        ticker.join()
+        self.assertEqual(len(ticks), 10)
+
+    def test_cancel(self):
+        annex = SleepyAnnex(self.d, 30)
+
+        g = gevent.spawn(annex.git_raw, 'annex', 'get', 'foo')
+        gevent.sleep(0.2)
+        g.kill()
+
+        self.assertEqual(len(annex.processes), 1)
+        self.assertKilled(annex.processes[0])
+
+    def test_fetch_timeout(self):
+        annex = SleepyAnnex(self.d, 30, fetch_timeout=0.2)
+
+        with self.assertRaisesRegex(AnnexError, 'Timed out'):
+            annex.get_key('SHA256E-s1--foo')
+        self.assertKilled(annex.processes[0])
+
+    def test_thread_fetch_timeout(self):
+        annex = SleepyAnnex(self.d, 30, fetch_timeout=0.2)
+
+        # fetches from other threads are timed out too
+        errors = []
+        def fetch():
+            try:
+                annex.get_key('SHA256E-s1--foo')
+            except AnnexError as e:
+                errors.append(str(e))
+        t = threading.Thread(target=fetch)
+        t.start()
+        t.join(5)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertIn('Timed out', errors[0])
+        self.assertKilled(annex.processes[0])
+
+    def test_pooled(self):
+        with open(os.path.join(self.d, 'hello.txt'), 'w') as f:
+            f.write("Hello")
+        subprocess.check_output(['git', '-C', self.d, 'add', 'hello.txt'])
+        subprocess.check_output(['git', '-C', self.d, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+            'commit', '-m', 'hello'])
+
+        # the shared cat-file process is used from the server's own threads
+        annex = GreenAnnex(self.d, concurrency=2)
+        jobs = [ gevent.spawn(annex.cat_file, 'HEAD:hello.txt') for i in range(4) ]
+        gevent.joinall(jobs, raise_error=True)
+        self.assertEqual([ j.value for j in jobs ], [b'Hello'] * 4)
+        annex.close()
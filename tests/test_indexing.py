@@ -3,7 +3,9 @@ import tempfile
 import shutil
 import json
 import os
-from librarian.backends.xapian_indexer import XapianIndexer
+from librarian.backends.xapian_indexer import XapianIndexer, QueryError
+from librarian.backends.sharded import ShardedIndexer, shard_for
+from librarian.backends.federated import FederatedIndexer
 
 #import logging
 #logging.basicConfig(level=logging.DEBUG)
@@ -89,3 +91,447 @@ class IndexingTestCase(unittest.TestCase):
     def test_dropped(self):
         self.assertSearch('state:dropped', ['R3'])
         self.assertSearch('mimetype:image', ['R1', 'R2', 'R0'])
+
+    def test_stale_inspections(self):
+        self.assertSearch(self.indexer.stale_query([('file', '1.0.0', ['.*'])]), ['R1'])
+        self.assertSearch(self.indexer.stale_query([('file', '1.0.1', ['.*'])]), ['R2', 'R0'])
+        self.assertSearch(self.indexer.stale_query([('image', '1.0.0', ['.jpg'])]), [])
+        self.assertSearch(self.indexer.stale_query([('image', '1.0.1', ['.jpg']),
+            ('pdf', '1.0.0', ['.pdf'])]), ['R1', 'R2', 'R0'])
+
+
+    def test_stats(self):
+        stats = self.indexer.stats(2)
+        self.assertEqual(stats['documents'], 3)
+        self.assertGreater(stats['tables']['postlist'], 0)
+        self.assertEqual(len(stats['largest']), 2)
+
+        prefixes = dict( (p['prefix'], p) for p in stats['prefixes'] )
+        self.assertEqual(prefixes['QK']['terms'], 3)
+        self.assertEqual(prefixes['QK']['fields'], ['key'])
+        self.assertEqual(prefixes['XS']['fields'], ['state'])
+
+
+class TextIndexingTestCase(unittest.TestCase):
+
+    TEXT = u"The quick brown fox jumps over the lazy dog. " * 10 + u"Finally an aardvark appears."
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.indexer = XapianIndexer(os.path.join(self.d, 'db'))
+        self.indexer.set_writable()
+        self.indexer.put_data('T0', {
+            'git': {'branch': {'master': 'docs/fox.pdf'}},
+            'poppler': {'pages': '1', 'text': self.TEXT},
+        })
+
+    def tearDown(self):
+        self.indexer.unset_writable()
+        shutil.rmtree(self.d)
+
+    def assertSearch(self, query, records):
+        r = self.indexer.search(query)
+        result = [ m['key'] for m in r['matches'] ]
+        self.assertListEqual(result, records, "Search failed: %s => %r" % (query, result))
+
+    def test_excerpt(self):
+        data = self.indexer.get_data('T0')
+        self.assertEqual(data['poppler']['text'], self.TEXT[:200])
+        self.assertEqual(data['poppler']['_excerpt'], ['text'])
+
+    def test_search(self):
+        self.assertSearch('aardvark', ['T0'])
+        self.assertSearch('text:aardvark', ['T0'])
+        self.assertSearch('"lazy dog"', ['T0'])
+        self.assertSearch('subject:aardvark', [])
+
+    def test_update(self):
+        # other changes keep the text that is no longer stored
+        self.indexer.update_data('T0', {'meta': {'tag': ['animals']}})
+        self.assertSearch('aardvark', ['T0'])
+        self.assertSearch('tag:animals', ['T0'])
+
+        # a new inspection replaces it
+        self.indexer.update_data('T0', {'poppler': {'pages': '1', 'text': u'Zebra'}})
+        self.assertSearch('aardvark', [])
+        self.assertSearch('zebra', ['T0'])
+
+    def test_move(self):
+        # a move drops the old path before the new one is added
+        self.indexer.update_branch('T0', 'master', None)
+        self.assertSearch('aardvark', [])
+        self.assertSearch('state:dropped', ['T0'])
+
+        self.indexer.update_branch('T0', 'master', 'archive/fox.pdf')
+        self.assertSearch('aardvark', ['T0'])
+        self.assertSearch('"lazy dog"', ['T0'])
+        self.assertSearch('filename:fox', ['T0'])
+
+    def test_reindex(self):
+        self.indexer.put_data('T1', {'git': {'branch': {'master': 'docs/cat.pdf'}}})
+        self.indexer.set_value('head:master', 'abc')
+        self.indexer.db.delete_document('QKT1')
+        self.indexer.put_data('T2', {'git': {'branch': {'master': 'docs/dog.pdf'}}})
+        self.indexer.unset_writable()
+
+        self.assertEqual(self.indexer.reindex(2), 2)
+
+        # docids, metadata and the text that is no longer stored all survive
+        self.assertSearch('aardvark', ['T0'])
+        self.assertSearch('"lazy dog"', ['T0'])
+        self.assertSearch('filename:dog', ['T2'])
+        self.assertEqual(self.indexer.get_data('T2')['_docid'], 3)
+        self.assertEqual(self.indexer.get_value('head:master'), 'abc')
+        self.assertFalse(os.path.exists(self.indexer.path + '.reindex'))
+
+        self.indexer.set_writable()
+
+
+class ShardedTestCase(unittest.TestCase):
+
+    KEYS = [ 'S{0:d}'.format(i) for i in range(8) ]
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.previous = os.path.join(self.d, 'db')
+        self.indexer = ShardedIndexer(os.path.join(self.d, 'shards'), 3, self.previous)
+        self.indexer.set_writable()
+        for key in self.KEYS:
+            self.indexer.put_data(key, {
+                'git': {'branch': {'master': 'pics/{0}.jpg'.format(key)}},
+                'meta': {'tag': ['sharded']},
+            })
+        self.indexer.set_value('head:master', 'abc')
+
+    def tearDown(self):
+        self.indexer.kill()
+        shutil.rmtree(self.d)
+
+    def assertKeys(self, indexer, query, keys):
+        r = indexer.search(query, pagesize=100)
+        self.assertEqual(sorted( m['key'] for m in r['matches'] ), sorted(keys))
+
+    def test_spread(self):
+        self.assertGreater(len(set( shard_for(key, 3) for key in self.KEYS )), 1)
+
+    def test_search(self):
+        # reads while writable go to the writers
+        self.assertTrue(self.indexer.exists('S3'))
+        self.assertEqual(self.indexer.get_data('S3')['git']['branch']['master'], 'pics/S3.jpg')
+        self.indexer.unset_writable()
+
+        self.assertKeys(self.indexer, 'tag:sharded', self.KEYS)
+        self.assertKeys(self.indexer, 'filename:S5', ['S5'])
+        self.assertEqual(self.indexer.get_value('head:master'), 'abc')
+
+    def test_revision(self):
+        self.indexer.unset_writable()
+        revision = self.indexer.get_revision()
+        self.assertEqual(len(revision.split('-')), 3)
+
+        # moves on when any shard changes
+        self.indexer.set_writable()
+        self.indexer.put_data('S1', {'meta': {'tag': ['changed']}})
+        self.indexer.unset_writable()
+        self.assertNotEqual(self.indexer.get_revision(), revision)
+
+        # and so does a federation of sharded indexes
+        federated = FederatedIndexer([('sharded', self.indexer)])
+        self.assertEqual(federated.get_revision(), self.indexer.get_revision())
+
+    def test_update_branch(self):
+        self.indexer.update_branch('S1', 'master', None)
+        self.indexer.unset_writable()
+
+        self.assertEqual(self.indexer.get_data('S1')['git']['branch'], {})
+        self.assertIn('_dropped', self.indexer.get_data('S1'))
+
+    def test_gc(self):
+        self.indexer.update_branch('S1', 'master', None)
+        self.indexer.update_branch('S2', 'master', None)
+        self.indexer.unset_writable()
+
+        # S1 comes back in the same session the gc runs in
+        self.indexer.set_writable()
+        self.indexer.update_branch('S1', 'master', 'pics/S1.jpg')
+        self.assertEqual(self.indexer.gc('2999-01-01T00:00:00'), (1, 0))
+        self.indexer.unset_writable()
+
+        self.assertNotIn('_tombstone', self.indexer.get_data('S1'))
+        self.assertTrue(self.indexer.get_data('S2')['_tombstone'])
+        self.assertKeys(self.indexer, 'tag:sharded', [ k for k in self.KEYS if k != 'S2' ])
+
+    def test_reshard(self):
+        self.indexer.unset_writable()
+
+        resharded = ShardedIndexer(os.path.join(self.d, 'shards'), 2, self.previous)
+        self.assertRaises(RuntimeError, lambda: resharded.db)
+        self.assertEqual(resharded.reindex(2), len(self.KEYS))
+
+        self.assertKeys(resharded, 'tag:sharded', self.KEYS)
+        self.assertEqual(resharded.get_value('head:master'), 'abc')
+        self.assertFalse(os.path.exists(resharded.shard_path(2)))
+
+    def test_from_previous(self):
+        self.indexer.kill()
+        shutil.rmtree(os.path.join(self.d, 'shards'))
+
+        single = XapianIndexer(self.previous)
+        single.set_writable()
+        for key in self.KEYS:
+            single.put_data(key, {'meta': {'tag': ['single']}})
+        single.set_value('head:master', 'def')
+        single.unset_writable()
+
+        indexer = ShardedIndexer(os.path.join(self.d, 'shards'), 3, self.previous)
+        self.assertRaises(RuntimeError, lambda: indexer.db)
+        # a sync before the reindex mustn't start empty shards
+        self.assertRaises(RuntimeError, indexer.set_writable)
+        self.assertFalse(os.path.exists(indexer.shard_path(0)))
+
+        self.assertEqual(indexer.reindex(), len(self.KEYS))
+
+        self.assertKeys(indexer, 'tag:single', self.KEYS)
+        self.assertEqual(indexer.get_value('head:master'), 'def')
+        self.assertFalse(os.path.exists(self.previous))
+
+
+class FederatedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+
+        photos = XapianIndexer(os.path.join(self.d, 'photos'))
+        photos.set_writable()
+        photos.put_data('F0', {'git': {'branch': {'master': 'boats/canoe.jpg'}}, 'meta': {'tag': ['boat']}})
+        photos.put_data('F1', {'git': {'branch': {'master': 'cats/tom.jpg'}}, 'meta': {'tag': ['cat']}})
+        photos.unset_writable()
+
+        scans = ShardedIndexer(os.path.join(self.d, 'scans'), 2)
+        scans.set_writable()
+        for i in range(2, 6):
+            scans.put_data('F{0:d}'.format(i), {'git': {'branch': {'master': 'scan{0:d}.jpg'.format(i)}}, 'meta': {'tag': ['scan']}})
+        scans.put_data('F0', {'git': {'branch': {'master': 'old/canoe.jpg'}}, 'meta': {'tag': ['boat', 'scan']}})
+        scans.unset_writable()
+
+        self.indexer = FederatedIndexer([('photos', photos), ('scans', scans)])
+
+    def tearDown(self):
+        self.indexer.close()
+        shutil.rmtree(self.d)
+
+    def assertKeys(self, query, keys):
+        r = self.indexer.search(query, pagesize=100)
+        self.assertEqual(sorted( m['key'] for m in r['matches'] ), keys)
+
+    def test_search(self):
+        self.assertKeys('tag:cat', ['F1'])
+        self.assertKeys('tag:scan', ['F0', 'F2', 'F3', 'F4', 'F5'])
+
+    def test_duplicates(self):
+        # the same content in both is one result
+        self.assertKeys('tag:boat', ['F0'])
+        self.assertTrue(self.indexer.exists('F0'))
+        self.assertEqual(self.indexer.get_data('F0')['git']['branch']['master'], 'boats/canoe.jpg')
+
+    def test_read_only(self):
+        self.assertRaises(RuntimeError, self.indexer.set_writable)
+        self.assertRaises(KeyError, self.indexer.get_data, 'F9')
+
+
+class GarbageCollectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.indexer = XapianIndexer(os.path.join(self.d, 'db'))
+        self.indexer.set_writable()
+        self.indexer.put_data('K0', {
+            'git': {'branch': {'master': 'boats/canoe.jpg'}},
+            'meta': {'tag': ['boat']},
+        })
+        self.indexer.put_data('K1', {
+            'git': {'branch': {}},
+            'meta': {'tag': ['boat']},
+            'image': {'props': ['landscape']},
+        })
+
+    def tearDown(self):
+        self.indexer.unset_writable()
+        shutil.rmtree(self.d)
+
+    def test_dropped_time(self):
+        self.assertNotIn('_dropped', self.indexer.get_data('K0'))
+        dropped = self.indexer.get_data('K1')['_dropped']
+
+        # kept while it stays dropped, cleared when it comes back
+        self.indexer.update_data('K1', {'meta': {'tag': ['canoe']}})
+        self.assertEqual(self.indexer.get_data('K1')['_dropped'], dropped)
+        self.indexer.update_data('K1', {'git': {'branch': {'master': 'canoe.jpg'}}})
+        self.assertNotIn('_dropped', self.indexer.get_data('K1'))
+
+    def test_retention(self):
+        self.assertEqual(self.indexer.gc('2000-01-01T00:00:00'), (0, 0))
+        self.assertIn('image', self.indexer.get_data('K1'))
+
+    def test_tombstone(self):
+        self.assertEqual(self.indexer.gc('2999-01-01T00:00:00'), (1, 0))
+
+        data = self.indexer.get_data('K1')
+        self.assertTrue(data['_tombstone'])
+        self.assertEqual(data['meta']['tag'], ['boat'])
+        self.assertNotIn('image', data)
+        self.assertTrue(self.indexer.exists('K1'))
+
+        # only collected once
+        self.assertEqual(self.indexer.gc('2999-01-01T00:00:00'), (0, 0))
+
+    def test_deleted_on_branch(self):
+        # content gone, but still on a branch so still searched for
+        self.indexer.put_data('K2', {
+            'git': {'branch': {'master': 'boats/kayak.jpg'}},
+            'annex': {'state': 'deleted'},
+            'image': {'props': ['portrait']},
+        })
+        self.assertIn('_dropped', self.indexer.get_data('K2'))
+
+        self.assertEqual(self.indexer.gc('2999-01-01T00:00:00'), (1, 0))
+        data = self.indexer.get_data('K2')
+        self.assertNotIn('_tombstone', data)
+        self.assertEqual(data['image']['props'], ['portrait'])
+
+        # only K1 goes
+        self.assertEqual(self.indexer.gc('2999-01-01T00:00:00', True), (1, 0))
+        self.assertFalse(self.indexer.exists('K1'))
+        self.assertTrue(self.indexer.exists('K2'))
+
+    def test_purge(self):
+        self.assertEqual(self.indexer.gc('2999-01-01T00:00:00', True), (1, 0))
+        self.assertFalse(self.indexer.exists('K1'))
+        self.assertTrue(self.indexer.exists('K0'))
+
+        before, after = self.indexer.compact()
+        self.assertGreater(after, 0)
+        self.assertTrue(self.indexer.exists('K0'))
+        self.indexer.set_writable()
+
+
+class SimilarityTestCase(unittest.TestCase):
+
+    HASHES = {
+        'H0': 'cc1e46c4d032c6ee',
+        'H1': 'cc1e46c4d032c6ef', # 1 bit
+        'H2': 'cc1e46c4d032c611', # 8 bits
+        'H3': '3c1e46c4d032c6ee', # 4 bits, different band
+        'H4': '8781a486cd2c3fb7', # unrelated
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.d = tempfile.mkdtemp()
+        cls.indexer = XapianIndexer(cls.d)
+        cls.indexer.set_writable()
+        for key, h in sorted(cls.HASHES.items()):
+            cls.indexer.put_data(key, {
+                'git': {'branch': {'master': key + '.jpg'}},
+                'phash': {'dhash': h},
+            })
+        cls.indexer.unset_writable()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.d)
+
+    def assertSimilar(self, query, records):
+        r = self.indexer.search(query, 0, 10)
+        self.assertEqual(sorted(m['key'] for m in r['matches']), records)
+
+    def test_exact(self):
+        self.assertSimilar('dhash:cc1e46c4d032c6ee', ['H0'])
+
+    def test_similar(self):
+        self.assertSimilar('similar:H0', ['H0', 'H1', 'H2', 'H3'])
+        self.assertSimilar('similar:H0~4', ['H0', 'H1', 'H3'])
+        self.assertSimilar('similar:H0~0', ['H0'])
+        self.assertSimilar('similar:H4', ['H4'])
+        self.assertSimilar('similar:H0~4 state:dropped', [])
+
+    def test_dropped(self):
+        self.indexer.set_writable()
+        self.indexer.put_data('H5', {
+            'git': {'branch': {}},
+            'phash': {'dhash': self.HASHES['H0']},
+        })
+        try:
+            self.assertSimilar('similar:H0~0', ['H0'])
+            self.assertSimilar('similar:H0~0 state:dropped', ['H5'])
+        finally:
+            self.indexer.delete('H5')
+            self.indexer.unset_writable()
+
+    def test_invalid(self):
+        self.assertRaises(QueryError, self.indexer.search, 'similar:H9', 0, 10)
+        self.assertRaises(QueryError, self.indexer.search, 'similar:H0~far', 0, 10)
+
+    def test_clusters(self):
+        from librarian.similarity import clusters
+        hashes = self.indexer.hashes()
+        self.assertEqual(len(hashes), 5)
+        self.assertEqual(clusters(hashes, 4), [['H0', 'H1', 'H3']])
+        self.assertEqual(clusters(hashes, 1), [['H0', 'H1']])
+
+
+class GeoTestCase(unittest.TestCase):
+
+    LOCATIONS = {
+        'G0': '51.502500,-0.125000', # Westminster
+        'G1': '51.476900,0.000500', # Greenwich, 9km away
+        'G2': '48.856600,2.352200', # Paris
+        'G3': '-17.700000,179.900000', # either side of the antimeridian
+        'G4': '-17.700000,-179.900000',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.d = tempfile.mkdtemp()
+        cls.indexer = XapianIndexer(cls.d)
+        cls.indexer.set_writable()
+        for key, location in sorted(cls.LOCATIONS.items()):
+            cls.indexer.put_data(key, {
+                'git': {'branch': {'master': key + '.jpg'}},
+                'image': {'location': [location]},
+            })
+        cls.indexer.unset_writable()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.d)
+
+    def assertFound(self, query, records):
+        r = self.indexer.search(query, 0, 10)
+        self.assertEqual(sorted(m['key'] for m in r['matches']), records)
+
+    def test_near(self):
+        self.assertFound('near:51.5,-0.12,5', ['G0'])
+        self.assertFound('near:51.5,-0.12,10', ['G0', 'G1'])
+        self.assertFound('near:51.5,-0.12,400', ['G0', 'G1', 'G2'])
+        self.assertFound('near:-17.7,180,20', ['G3', 'G4'])
+
+    def test_bbox(self):
+        self.assertFound('bbox:51,-1,52,0', ['G0'])
+        self.assertFound('bbox:48,-1,52,3', ['G0', 'G1', 'G2'])
+        self.assertFound('bbox:-18,179,-17,-179', ['G3', 'G4'])
+        self.assertFound('bbox:48,-1,52,3 state:dropped', [])
+
+    def test_invalid(self):
+        self.assertRaises(QueryError, self.indexer.search, 'near:51.5,west,5', 0, 10)
+        self.assertRaises(QueryError, self.indexer.search, 'near:51.5,-0.12', 0, 10)
+        self.assertRaises(QueryError, self.indexer.search, 'bbox:48,-1,52', 0, 10)
+
+    def test_geohash(self):
+        self.assertFound('geohash:gcpu', ['G0'])
+        self.assertFound('geohash:u', ['G1', 'G2'])
+
+    def test_clusters(self):
+        clusters = self.indexer.geo_clusters(40, -10, 60, 10, 1)
+        self.assertEqual([ (c['geohash'], c['count']) for c in clusters ], [('g', 1), ('u', 2)])
+        self.assertEqual(sum(c['count'] for c in self.indexer.geo_clusters(-90, -180, 90, 180)), 5)
@@ -0,0 +1,267 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+import threading
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+from librarian.inspectors import Inspector, prefetch
+
+def good_inspector(filename):
+    if 'slow' in filename:
+        time.sleep(0.5)
+    return {'name': [os.path.basename(filename)]}
+good_inspector.version = '1.0.0'
+
+def broken_inspector(filename):
+    if 'hang' in filename:
+        time.sleep(30)
+    if 'crash' in filename:
+        os._exit(1)
+    raise ValueError("Bad file")
+broken_inspector.version = '1.0.0'
+
+def options_inspector(filename, limit=1):
+    return {'limit': [str(limit)]}
+options_inspector.version = '1.0.0'
+
+# held by another thread while workers are started
+_busy = threading.Lock()
+
+def locking_inspector(filename):
+    with _busy:
+        return {'name': [os.path.basename(filename)]}
+locking_inspector.version = '1.0.0'
+
+class SandboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.inspector = Inspector()
+        self.inspector.add_inspector('good', good_inspector, ['.txt'])
+        self.inspector.add_inspector('broken', broken_inspector, ['.bad'])
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def inspect(self, names, workers=2):
+        files = [ os.path.join(self.d, n) for n in names ]
+        for f in files:
+            with open(f, 'w') as fh:
+                fh.write("test")
+        return dict( (os.path.basename(f), data) for f, data in
+                self.inspector.inspect_files(files, workers, timeout=1) )
+
+    def test_success(self):
+        r = self.inspect(['a.txt', 'b.txt'])
+        self.assertEqual(r['a.txt']['good'], {'name': ['a.txt']})
+        self.assertEqual(r['b.txt']['librarian'], {'inspector': ['good-1.0.0']})
+
+    def test_failures(self):
+        r = self.inspect(['a.txt', 'error.bad', 'hang.bad', 'crash.bad', 'b.txt'])
+        self.assertEqual(len(r), 5)
+        self.assertEqual(r['b.txt']['good'], {'name': ['b.txt']})
+
+        for name, error in (('error.bad', 'Bad file'), ('hang.bad', 'timeout'), ('crash.bad', 'crashed')):
+            librarian = r[name]['librarian']
+            self.assertEqual(librarian['inspector'], ['broken-1.0.0'])
+            self.assertEqual(librarian['failed'], ['broken-1.0.0'])
+            self.assertEqual(librarian['error'], ['broken: ' + error])
+
+    def test_slow_consumer(self):
+        files = [ os.path.join(self.d, 'slow{0:d}.txt'.format(i)) for i in range(4) ]
+        for f in files:
+            with open(f, 'w') as fh:
+                fh.write("test")
+
+        # workers that finish while we are busy with a result aren't timed out
+        results = {}
+        for f, data in self.inspector.inspect_files(files, 2, timeout=1):
+            results[os.path.basename(f)] = data
+            time.sleep(1.5)
+
+        self.assertEqual(len(results), 4)
+        for name, data in results.items():
+            self.assertNotIn('failed', data['librarian'])
+            self.assertEqual(data['good'], {'name': [name]})
+
+    def test_same_as_serial(self):
+        self.inspector.enable('file')
+        self.inspector.enable('image')
+        names = ['a.txt', 'b.txt', 'error.bad', 'c.txt', 'boat.jpg']
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'files', 'boat.jpg'), self.d)
+
+        files = [ os.path.join(self.d, n) for n in names ]
+        for f in files[:-1]:
+            with open(f, 'w') as fh:
+                fh.write("test")
+
+        serial = list(self.inspector.inspect_files(files, 0))
+        self.assertEqual([ f for f, data in serial ], files)
+
+        parallel = list(self.inspector.inspect_files(files, 3, timeout=10))
+        self.assertEqual(sorted(parallel), sorted(serial))
+
+    def test_options(self):
+        self.inspector.add_inspector('options', options_inspector, ['.opt'])
+        self.inspector.set_options('options', limit=5)
+
+        # in process and in the workers
+        for workers in (0, 2):
+            r = self.inspect(['a.opt'], workers)
+            self.assertEqual(r['a.opt']['options'], {'limit': ['5']})
+
+    def test_other_threads(self):
+        # a fork would copy the lock as it is, held, and the worker would hang
+        self.inspector.add_inspector('locking', locking_inspector, ['.lock'])
+        release = threading.Event()
+        def hold():
+            with _busy:
+                release.wait()
+        t = threading.Thread(target=hold)
+        t.start()
+        try:
+            r = self.inspect(['a.lock', 'crash.bad', 'b.lock'], 1)
+        finally:
+            release.set()
+            t.join()
+
+        self.assertEqual(r['a.lock']['locking'], {'name': ['a.lock']})
+        self.assertEqual(r['b.lock']['locking'], {'name': ['b.lock']})
+
+    def test_in_process(self):
+        r = self.inspect(['a.txt', 'error.bad'], 0)
+        self.assertEqual(r['a.txt']['good'], {'name': ['a.txt']})
+        self.assertEqual(r['error.bad']['librarian']['failed'], ['broken-1.0.0'])
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def test_prefetch(self):
+        produced = []
+        def source():
+            for i in range(20):
+                produced.append(i)
+                yield i
+
+        items = prefetch(source(), 5)
+        self.assertEqual(next(items), 0)
+
+        # runs ahead, but no further than the queue allows
+        time.sleep(0.2)
+        self.assertGreater(len(produced), 1)
+        self.assertLessEqual(len(produced), 7)
+
+        self.assertEqual(list(items), list(range(1, 20)))
+
+    def test_prefetch_error(self):
+        def source():
+            yield 1
+            raise ValueError("No remote")
+
+        items = prefetch(source())
+        self.assertEqual(next(items), 1)
+        with self.assertRaisesRegex(ValueError, 'No remote'):
+            next(items)
+
+@unittest.skipUnless(which('pdftotext'), "needs poppler-utils")
+class PopplerTestCase(unittest.TestCase):
+
+    PDF = os.path.join(os.path.dirname(__file__), 'files', 'monty_quotes.pdf')
+
+    def test_budget(self):
+        from librarian.inspectors.poppler import poppler_inspector
+
+        info = poppler_inspector(self.PDF)
+        self.assertGreater(len(info['text']), 50)
+
+        info = poppler_inspector(self.PDF, max_text=50)
+        self.assertLessEqual(len(info['text'].encode('utf-8')), 50)
+        self.assertTrue(info['truncated'])
+
+        info = poppler_inspector(self.PDF, max_pages=0)
+        self.assertEqual(info['text'], '')
+        self.assertTrue(info['truncated'])
+
+class ImageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def write_jpeg(self, gps=None):
+        from PIL import Image
+        from PIL.TiffImagePlugin import IFDRational
+
+        exif = Image.Exif()
+        exif[0x010f] = 'Maker' # Image Make
+        if gps:
+            ifd = exif.get_ifd(0x8825)
+            for tag, (ref, dms) in zip((1, 3), gps):
+                ifd[tag] = ref
+                ifd[tag + 1] = tuple( IFDRational(int(round(x * 100)), 100) for x in dms )
+
+        filename = os.path.join(self.d, 'test.jpg')
+        Image.new('RGB', (40, 30)).save(filename, exif=exif)
+        return filename
+
+    def test_gps(self):
+        from librarian.inspectors.image import image_inspector
+
+        # Sydney Opera House
+        filename = self.write_jpeg([('S', (33, 51, 35.44)), ('E', (151, 12, 30.24))])
+        info = image_inspector(filename)
+        self.assertEqual(info['location'], ['-33.859844,151.208400'])
+        self.assertEqual(info['device'], ['Maker'])
+
+        filename = self.write_jpeg([('N', (51, 30, 9)), ('W', (0, 7, 30))])
+        self.assertEqual(image_inspector(filename)['location'], ['51.502500,-0.125000'])
+
+    def test_no_gps(self):
+        from librarian.inspectors.image import image_inspector
+
+        info = image_inspector(self.write_jpeg())
+        self.assertNotIn('location', info)
+        self.assertEqual(info['props'], ['landscape', '4:3', 'lowres', 'RGB'])
+
+class PhashTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image, ImageDraw
+
+        self.d = tempfile.mkdtemp()
+        self.image = Image.new('RGB', (400, 300), 'white')
+        draw = ImageDraw.Draw(self.image)
+        for i in range(8):
+            x, y = i * 45, (i * 70) % 220
+            draw.ellipse((x, y, x + 80, y + 80), fill=(30 * i, 255 - 30 * i, 120))
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def save(self, name, im):
+        filename = os.path.join(self.d, name)
+        im.save(filename)
+        return filename
+
+    def test_dhash(self):
+        from PIL import Image
+        from librarian.inspectors.phash import phash_inspector, dhash
+        from librarian.similarity import hamming
+
+        original = self.save('original.jpg', self.image)
+        info = phash_inspector(original)
+        self.assertRegex(info['dhash'], '^[0-9a-f]{16}$')
+        self.assertEqual(int(info['dhash'], 16), dhash(original))
+
+        # survives resizing and re-encoding
+        smaller = self.save('smaller.png', self.image.resize((200, 150)))
+        self.assertLessEqual(hamming(dhash(original), dhash(smaller)), 2)
+
+        # but a different picture is far away
+        flipped = self.save('flipped.jpg', self.image.transpose(Image.FLIP_LEFT_RIGHT))
+        self.assertGreater(hamming(dhash(original), dhash(flipped)), 16)
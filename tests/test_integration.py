@@ -1,6 +1,7 @@
 import unittest
 import os, os.path
 import stat
+import time
 from librarian import Librarian
 from librarian.inspectors import Inspector
 from librarian.annex import AnnexError
@@ -26,6 +27,11 @@ DNOW = ''.join(NOW.split('T')[0].split('-'))
 def now(chars):
     return NOW[:chars].replace('-', '')
 
+def content_inspector(filename):
+    with open(filename) as f:
+        return {'body': [f.read()]}
+content_inspector.version = '1.0.0'
+
 class MockBackend:
 
     def __init__(self):
@@ -104,10 +110,14 @@ class IntegrationTestCase(RepoBase, unittest.TestCase):
         #self.skipTest("Need to finish updating this...")
 
         inspector = Inspector('file')
-        r = inspector.inspect_items(l.annex, ALL_DOCS[:2], True)
+        r = inspector.inspect_items(l.annex, ALL_DOCS[:2], True, batch=1, on_commit=l.apply_info)
         #r = l.run_indexer(ALL_DOCS[:2], True) # test_0 and test_1
         self.assertEqual(r['inspected'], 2)
         self.assertEqual(r['total'], 2)
+        self.assertEqual(r['commits'], 2)
+
+        # applied directly so there is nothing left to sync
+        self.assertEqual(l.get_head('git-annex'), l.annex.git_line('rev-parse', 'git-annex'))
         l.sync()
 
         #self.assertSearchResult(l.db.search('state:noinfo'), [])
@@ -145,6 +155,8 @@ class IntegrationTestCase(RepoBase, unittest.TestCase):
             'Tplain', 'Ttext',
             'XIfile-1.0.0',
             'XK0kb',
+            'XL' + l.annex.uuid,
+            'XLhere',
             'XSnew',
             'XSok',
             'XSuntagged',
@@ -167,6 +179,9 @@ class IntegrationTestCase(RepoBase, unittest.TestCase):
             'Pdir_2',
             'QKSHA256E-s7--e31ee1d0324634d01318e9631c4e7691f5e6f3df483b4a2c15c610f8055ff13e.txt',
             'XInone',
+            'XK0kb',
+            'XL' + l.annex.uuid,
+            'XLhere',
             'XSok',
             'XStagged',
             'Y2001',
@@ -273,6 +288,78 @@ class IntegrationTestCase(RepoBase, unittest.TestCase):
         data = l.db.get_data(DOC_KEYS['test_1'])
         self.assertEqual(data['_docid'], 2)
 
+        # the clone has nothing yet
+        self.assertSearchResult(l.search('present:here'), [])
+        self.assertSearchResult(l.search('present:' + data['annex']['present'][0]), ALL_DOCS)
+        self.assertFalse(l.annex.is_local(DOC_KEYS['test_1']))
+
+        progress = []
+        p = l.annex.get_key(DOC_KEYS['test_1'], lambda done, total: progress.append(total))
+        self.assertEqual(p, l.annex.content_for_key(DOC_KEYS['test_1']))
+        # at least the final report, always with the size of the key
+        self.assertTrue(progress)
+        self.assertEqual(set(progress), set([7]))
+        l.sync()
+        self.assertSearchResult(l.search('present:here'), [DOC_KEYS['test_1']])
+        self.assertTrue(l.annex.is_local(DOC_KEYS['test_1']))
+
+    def test_inspect_drop(self):
+        l = clone_repo(self.origin, self.repo)
+        l.annex.git_raw('annex', 'get', 'dir_1')
+
+        inspector = Inspector()
+        inspector.add_inspector('content', content_inspector, ['.txt'])
+        r = inspector.inspect_items(l.annex, ALL_DOCS, True, drop=True)
+        self.assertEqual(r['inspected'], 3)
+
+        # what was fetched for inspection is gone again, what was here stays
+        self.assertFalse(l.annex.is_local(DOC_KEYS['test_0']))
+        self.assertTrue(l.annex.is_local(DOC_KEYS['test_1']))
+        self.assertFalse(l.annex.is_local(DOC_KEYS['test_2']))
+
+        l.sync()
+        self.assertEqual(l.db.get_data(DOC_KEYS['test_2'])['content']['body'], ['Hello 2'])
+
+    def test_fetch_failed(self):
+        l = clone_repo(self.origin, self.repo)
+        l.config['FETCH_RETRY'] = 1
+        missing = u'SHA256E-s1--missing.txt'
+
+        l.fetch_in_background(missing)
+        deadline = time.time() + 10
+        while l.fetch_status(missing)['state'] == 'fetching' and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(l.fetch_status(missing)['state'], 'failed')
+        with self.assertRaisesRegex(AnnexError, 'Unable to fetch key'):
+            l.fetch_in_background(missing)
+
+        # forgotten once it can be retried
+        time.sleep(1.1)
+        self.assertEqual(l.fetch_status(missing), {'state': 'remote'})
+        self.assertEqual(l._fetch_failed, {})
+
+    def test_update_metadata(self):
+        l = create_repo(self.repo)
+        l.sync()
+
+        keys = [ DOC_KEYS['test_1'], DOC_KEYS['test_2'] ]
+        self.assertEqual(l.update_metadata(keys, add={'tag': ['boat', 'blue']}), 2)
+
+        # visible without a sync
+        self.assertSearchResult(l.search('tag:boat'), keys)
+        meta = l.db.get_data(DOC_KEYS['test_1'])['meta']
+        self.assertEqual(meta['state'], ['tagged'])
+        self.assertEqual(sorted(meta['tag']), ['blue', 'boat'])
+
+        l.update_metadata(keys[:1], remove={'tag': ['blue']}, set_fields={'gallery': ['mine']})
+        self.assertSearchResult(l.search('tag:blue'), keys[1:])
+
+        # and the sync of the same changes leaves things as they were
+        l.sync()
+        self.assertSearchResult(l.search('tag:boat'), keys)
+        self.assertSearchResult(l.search('tag:blue'), keys[1:])
+        self.assertEqual(sorted(l.db.get_data(DOC_KEYS['test_1'])['meta']['gallery']), ['mine'])
+
     def test_unannex(self):
         l = create_repo(self.repo)
         l.sync()
@@ -1,5 +1,6 @@
 import unittest
 import librarian
+from librarian.annex import parse_metadata_args
 
 TEST_DATA = u'''
 1501483673.556634875s date +2014-01-18T14:08:44 device +Canon +!Q2Fub24gRU9TIDYwMEQ= extension +jpg indexers +exif +file mimetype +image +jpeg orientation +landscape size +6774188
@@ -52,3 +53,15 @@ class MetaTestCase(unittest.TestCase):
         expected = dict(INDEXED_META)
         expected['state'] = ['ok']
         self.assertDictEqual(meta, expected)
+
+    def test_parse_metadata_args(self):
+        add, remove, values = parse_metadata_args(['-t', 'foo', '-u', 'bar', '-s', 'date=2001',
+            '-s', 'gallery+=mine', '--set', 'gallery-=yours'])
+        self.assertDictEqual(add, {'tag': ['foo'], 'gallery': ['mine']})
+        self.assertDictEqual(remove, {'tag': ['bar'], 'gallery': ['yours']})
+        self.assertDictEqual(values, {'date': ['2001']})
+
+    def test_parse_bad_metadata_args(self):
+        self.assertRaises(ValueError, parse_metadata_args, ['-t'])
+        self.assertRaises(ValueError, parse_metadata_args, ['--force', 'x'])
+        self.assertRaises(ValueError, parse_metadata_args, ['-s', 'foo'])
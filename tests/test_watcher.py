@@ -0,0 +1,79 @@
+import unittest
+import tempfile
+import shutil
+import time
+import os
+import gevent
+from librarian import watcher
+from librarian.watcher import RefWatcher
+
+class RefWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.d, 'refs', 'heads'))
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def watch(self, **kwargs):
+        w = RefWatcher(self.d, ['master'], lambda: self.calls.append(time.time()), **kwargs)
+        w.start()
+        self.addCleanup(w.kill)
+
+        # the first callback is for the state we start from
+        gevent.sleep(0.1)
+        self.assertEqual(len(self.calls), 1)
+        del self.calls[:]
+        return w
+
+    def update_ref(self, branch='master'):
+        # the way git does it, through a lock file renamed over the ref
+        ref = os.path.join(self.d, 'refs', 'heads', branch)
+        with open(ref + '.lock', 'w') as f:
+            f.write("{0}\n".format(time.time()))
+        os.rename(ref + '.lock', ref)
+
+    @unittest.skipUnless(watcher.HAS_INOTIFY, "needs inotify_simple")
+    def test_debounce(self):
+        self.watch(debounce=0.2, max_delay=5)
+
+        # a burst is one callback once it has gone quiet
+        for i in range(5):
+            self.update_ref()
+            gevent.sleep(0.05)
+        gevent.sleep(0.5)
+        self.assertEqual(len(self.calls), 1)
+
+        # other refs don't count
+        self.update_ref('other')
+        gevent.sleep(0.5)
+        self.assertEqual(len(self.calls), 1)
+
+    @unittest.skipUnless(watcher.HAS_INOTIFY, "needs inotify_simple")
+    def test_max_delay(self):
+        self.watch(debounce=0.2, max_delay=0.5)
+
+        # something that never goes quiet still gets a callback now and then
+        start = time.time()
+        while time.time() - start < 1.6:
+            self.update_ref()
+            gevent.sleep(0.05)
+        self.assertGreaterEqual(len(self.calls), 2)
+        self.assertLess(self.calls[0] - start, 1.0)
+
+    def test_poll(self):
+        watcher.HAS_INOTIFY, has_inotify = False, watcher.HAS_INOTIFY
+        try:
+            self.watch(seconds=0.1)
+        finally:
+            watcher.HAS_INOTIFY = has_inotify
+
+        self.update_ref()
+        gevent.sleep(0.3)
+        self.assertEqual(len(self.calls), 1)
+
+        # nothing changed, nothing to do
+        gevent.sleep(0.3)
+        self.assertEqual(len(self.calls), 1)
@@ -0,0 +1,88 @@
+import unittest
+import threading
+import time
+import gevent
+from librarian.worker import SyncWorker
+from tests import RepoBase
+
+class SyncWorkerTestCase(RepoBase, unittest.TestCase):
+
+    def setUp(self):
+        RepoBase.setUp(self)
+        self.worker = SyncWorker(self.create_repo())
+
+        # syncs wait to be let go so we can see what happens meanwhile
+        self.go = threading.Event()
+        self.sync = self.worker.librarian.sync
+        self.worker.librarian.sync = self.slow_sync
+
+    def tearDown(self):
+        self.go.set()
+        self.worker.close()
+        RepoBase.tearDown(self)
+
+    def slow_sync(self):
+        self.go.wait(10)
+        return self.sync()
+
+    def wait_for(self, name, value):
+        deadline = time.time() + 10
+        while self.worker.get_status()[name] != value and time.time() < deadline:
+            gevent.sleep(0.05)
+        return self.worker.get_status()
+
+    def test_coalesce(self):
+        # a sync waiting to run takes any more triggers with it
+        self.worker._write_lock.acquire()
+        self.assertTrue(self.worker.trigger())
+        self.assertFalse(self.worker.trigger())
+        self.assertFalse(self.worker.trigger())
+
+        status = self.worker.get_status()
+        self.assertTrue(status['queued'])
+        self.assertEqual(status['state'], 'idle')
+        self.assertEqual(status['syncs'], 0)
+
+        self.worker._write_lock.release()
+        self.go.set()
+        self.wait_for('syncs', 1)
+        gevent.sleep(0.3)
+
+        status = self.worker.get_status()
+        self.assertEqual(status['syncs'], 1)
+        self.assertFalse(status['queued'])
+        self.assertEqual(status['state'], 'idle')
+        self.assertIsNone(status['error'])
+        self.assertIsNotNone(status['finished'])
+
+    def test_trigger_while_syncing(self):
+        self.assertTrue(self.worker.trigger())
+        status = self.wait_for('state', 'syncing')
+        self.assertFalse(status['queued'])
+        self.assertIsNotNone(status['started'])
+
+        # changes after a sync started need another one, but only one
+        self.assertTrue(self.worker.trigger())
+        self.assertFalse(self.worker.trigger())
+
+        self.go.set()
+        status = self.wait_for('syncs', 2)
+        self.assertEqual(status['syncs'], 2)
+        self.assertEqual(self.wait_for('state', 'idle')['state'], 'idle')
+
+    def test_error(self):
+        def broken():
+            raise RuntimeError("Broken")
+        self.worker.librarian.sync = broken
+
+        self.worker.trigger()
+        self.wait_for('syncs', 1)
+        status = self.wait_for('state', 'idle')
+        self.assertEqual(status['error'], 'Broken')
+        self.assertEqual(status['state'], 'idle')
+
+        # cleared by the next sync that works
+        self.worker.librarian.sync = self.sync
+        self.worker.trigger()
+        status = self.wait_for('syncs', 2)
+        self.assertIsNone(status['error'])